@@ -0,0 +1,50 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import json
+from .BaseAction import BaseAction
+from .SnapshotManifest import SnapshotManifest, SnapshotManifestException
+
+class ActionConvertSnapshot(BaseAction):
+	def run(self):
+		(basename, extension) = os.path.splitext(self._args.src)
+		if extension == ".json":
+			dst_filename = basename + ".snap"
+		elif extension == ".snap":
+			dst_filename = basename + ".json"
+		else:
+			raise SnapshotManifestException("Do not know how to convert snapshot file %s, expected a .json or .snap file." % (self._args.src))
+		if os.path.exists(dst_filename) and (not self._args.force):
+			raise SnapshotManifestException("Refusing to overwrite already existing snapshot file: %s" % (dst_filename))
+
+		if extension == ".json":
+			with open(self._args.src) as f:
+				json_dict = json.load(f)
+			with SnapshotManifest.from_json_dict(dst_filename, json_dict, overwrite = True):
+				pass
+		else:
+			with SnapshotManifest.open(self._args.src) as manifest:
+				json_dict = manifest.to_json_dict()
+			with open(dst_filename, "w") as f:
+				json.dump(json_dict, fp = f)
+		if self._args.verbose >= 1:
+			print("%s -> %s" % (self._args.src, dst_filename))
@@ -0,0 +1,35 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+from .BaseAction import BaseAction
+from .ChunkStore import ChunkStore
+from .HashFunctions import HashFunctions
+
+class ActionMigrateStore(BaseAction):
+	def run(self):
+		for hash_function in HashFunctions.available():
+			chunk_dir = "%s/%s" % (self._args.target, HashFunctions.chunk_dir(hash_function))
+			if not os.path.isdir(chunk_dir):
+				continue
+			migrated = ChunkStore.migrate_to_pack(self._args.target, hash_function = hash_function, max_pack_size = self._args.pack_size)
+			if self._args.verbose >= 1:
+				print("%s: %d loose chunks moved into packs." % (chunk_dir, migrated))
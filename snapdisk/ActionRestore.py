@@ -0,0 +1,44 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import time
+from .BaseAction import BaseAction
+from .SnapshotRestorer import SnapshotRestorer
+from .FilesizeFormatter import FilesizeFormatter
+from .TimeFormatter import TimeFormatter
+
+class ActionRestore(BaseAction):
+	def _progress(self, restorer):
+		pos = restorer.position
+		disk_size = restorer.disk_size
+		tdiff = time.time() - self._t0
+		if tdiff < 1:
+			speed_str = "N/A"
+		else:
+			speed_str = self._size_fmt(round(pos / tdiff)) + "/s"
+		print("%6.2f%%: %s of %s; %s written, %s zero, %s unchanged. Runtime %s, speed %s." % (pos / disk_size * 100 if (disk_size > 0) else 100, self._size_fmt(pos), self._size_fmt(disk_size), self._size_fmt(restorer.chunks_written_size), self._size_fmt(restorer.chunks_zero_size), self._size_fmt(restorer.chunks_unchanged_size), self._time_fmt(tdiff), speed_str))
+
+	def run(self):
+		self._t0 = time.time()
+		self._time_fmt = TimeFormatter()
+		self._size_fmt = FilesizeFormatter(base1000 = self._args.print_si_units)
+		with SnapshotRestorer(self._args.src, self._args.dst, threads = self._args.threads, pipeline_memory = self._args.pipeline_memory, compare = self._args.compare, write_zeros = self._args.write_zeros, overwrite = self._args.force) as restorer:
+			restorer.restore(progress_callback = self._progress, progress_callback_period = self._args.progress_period)
@@ -19,14 +19,56 @@
 #
 #	Johannes Bauer <JohannesBauer@gmx.de>
 
+import os
+import contextlib
 from .BaseAction import BaseAction
-from .DiskImage import DiskImage
+from .DiskImage import DiskImage, DiskReadMode
 from .DiskImageServer import DiskImageServer
-from .Endpoints import StdinStdoutEndpoint
+from .MultiClientServer import MultiClientServer
+from .ChunkReadAhead import ChunkReadAhead
+from .RateLimiter import RateLimiter
 
 class ActionServe(BaseAction):
+	def _parse_images(self):
+		images = [ ]
+		for src in self._args.src:
+			(name, separator, filename) = src.partition("=")
+			if (separator == "") or ("/" in name):
+				# No name given, the path may still contain "=" somewhere
+				(name, filename) = (os.path.basename(src), src)
+			if name in [ image_name for (image_name, image_filename) in images ]:
+				raise ValueError("Image name '%s' given more than once." % (name))
+			images.append((name, filename))
+		return images
+
+	def _create_rate_limiter(self, key, rate, latency_target = None):
+		if (rate is None) and (latency_target is None) and (self._args.throttle_file is None):
+			return None
+		return RateLimiter(rate = rate, latency_target = latency_target, control_filename = self._args.throttle_file, control_key = key)
+
 	def run(self):
-		endpoint = self._args.endpoint.create_listener()
-		with DiskImage(self._args.src, chunk_size = 1) as self._image:
-			self._server = DiskImageServer(self._image, endpoint = endpoint, max_chunk_size = self._args.max_chunk_size)
-			self._server.run()
+		read_latency_target = None if (self._args.read_latency_target is None) else (self._args.read_latency_target / 1000)
+		# All images share the read limit, all clients the network limit
+		read_rate_limiter = self._create_rate_limiter("read", self._args.max_read_rate, read_latency_target)
+		network_rate_limiter = self._create_rate_limiter("network", self._args.max_network_rate)
+		read_mode = DiskReadMode(self._args.read_mode)
+		# Sending with sendfile would read the data a second time, which is
+		# only cheap as long as it remains in the page cache. It would also
+		# send the stale contents of free blocks.
+		sendfile = (not self._args.no_sendfile) and (read_mode in [ DiskReadMode.Cached, DiskReadMode.Mmap ]) and (not self._args.skip_free_blocks)
+		with contextlib.ExitStack() as stack:
+			images = { }
+			for (name, filename) in self._parse_images():
+				image = stack.enter_context(DiskImage(filename, chunk_size = 1, rate_limiter = read_rate_limiter, read_mode = read_mode, skip_free_blocks = self._args.skip_free_blocks))
+				images[name] = stack.enter_context(ChunkReadAhead(image, read_ahead = self._args.read_ahead, threads = self._args.read_ahead_threads, memory = self._args.cache_memory))
+
+			if self._args.max_clients is None:
+				endpoint = self._args.endpoint.create_listener(buffer_size = self._args.socket_buffer_size)
+				if network_rate_limiter is not None:
+					endpoint.set_rate_limiter(network_rate_limiter)
+				self._server = DiskImageServer(images, endpoint = endpoint, max_chunk_size = self._args.max_chunk_size, sendfile = sendfile, compression_threads = self._args.read_ahead_threads)
+				self._server.run()
+			else:
+				listener = stack.enter_context(self._args.endpoint.create_multi_listener(buffer_size = self._args.socket_buffer_size))
+				self._server = MultiClientServer(images, listener, max_clients = self._args.max_clients, max_chunk_size = self._args.max_chunk_size, sendfile = sendfile, compression_threads = self._args.read_ahead_threads, rate_limiter = network_rate_limiter, client_timeout = self._args.client_timeout, verbose = self._args.verbose)
+				self._server.run()
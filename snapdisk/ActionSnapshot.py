@@ -23,10 +23,14 @@ import time
 import datetime
 import urllib.parse
 from .BaseAction import BaseAction
-from .DiskImage import DiskImage, RemoteDiskImage
+from .DiskImage import DiskImage, RemoteDiskImage, DiskReadMode
+from .Codecs import Codecs
+from .ChunkStore import ChunkStoreLayout
+from .ContentDefinedChunker import ContentDefinedChunker
 from .SnapshotWriter import SnapshotMode, SnapshotWriter
 from .FilesizeFormatter import FilesizeFormatter
 from .TimeFormatter import TimeFormatter
+from .RateLimiter import RateLimiter
 
 class ActionSnapshot(BaseAction):
 	def _progress(self, writer):
@@ -39,26 +43,58 @@ class ActionSnapshot(BaseAction):
 		else:
 			progress = writer.total_bytes_appended / tdiff
 			speed_str = self._size_fmt(round(progress)) + "/s"
-		print("%6.2f%%: %s of %s; %s deduplicated, %s stored. Runtime %s, speed %s." % (pos / disk_size * 100, self._size_fmt(pos), self._size_fmt(disk_size), self._size_fmt(writer.chunks_deduplicated_size), self._size_fmt(writer.chunks_stored_size), self._time_fmt(tdiff), speed_str))
+		print("%6.2f%%: %s of %s; %s zero, %s deduplicated, %s stored. Runtime %s, speed %s." % (pos / disk_size * 100, self._size_fmt(pos), self._size_fmt(disk_size), self._size_fmt(writer.chunks_zero_size), self._size_fmt(writer.chunks_deduplicated_size), self._size_fmt(writer.chunks_stored_size), self._time_fmt(tdiff), speed_str))
 		writer.commit()
 
+	def _create_rate_limiter(self, key, rate, latency_target = None):
+		if (rate is None) and (latency_target is None) and (self._args.throttle_file is None):
+			return None
+		return RateLimiter(rate = rate, latency_target = latency_target, control_filename = self._args.throttle_file, control_key = key)
+
 	def run(self):
 		self._t0 = time.time()
 		self._time_fmt = TimeFormatter()
 		self._size_fmt = FilesizeFormatter(base1000 = self._args.print_si_units)
 
+		if self._args.chunking == "cdc":
+			chunker = ContentDefinedChunker(avg_size = self._args.chunk_size, min_size = self._args.cdc_min_size, max_size = self._args.cdc_max_size)
+		else:
+			chunker = None
+
+		if self._args.compress is None:
+			compression = None
+		else:
+			compression = Codecs.create(self._args.compress, level = self._args.compress_level, threads = self._args.compress_threads, threshold = self._args.compress_threshold if (self._args.compress_threshold > 0) else None)
+
+		if self._args.wire_compression == "none":
+			wire_compression = None
+		elif self._args.wire_compression == "auto":
+			# Chunks that arrive compressed by the store's codec are stored as
+			# they are
+			wire_compression = compression
+		elif (compression is not None) and (compression.name == self._args.wire_compression):
+			wire_compression = compression
+		else:
+			wire_compression = Codecs.create(self._args.wire_compression, threads = self._args.compress_threads)
+
 		parsed_src = urllib.parse.urlparse(self._args.src)
 		if parsed_src.scheme == "":
 			# Local file is source
-			self._image = DiskImage(self._args.src, chunk_size = self._args.chunk_size)
+			read_latency_target = None if (self._args.read_latency_target is None) else (self._args.read_latency_target / 1000)
+			rate_limiter = self._create_rate_limiter("read", self._args.max_read_rate, read_latency_target)
+			self._image = DiskImage(self._args.src, chunk_size = self._args.chunk_size, hash_threads = self._args.hash_threads, pipeline_memory = self._args.pipeline_memory, chunker = chunker, hash_function = self._args.hash_function, rate_limiter = rate_limiter, read_mode = DiskReadMode(self._args.read_mode), skip_free_blocks = self._args.skip_free_blocks)
 		else:
-			# Some kind of endpoint was given.
-			self._image = RemoteDiskImage(parsed_src, chunk_size = self._args.chunk_size, remote_snapdisk_binary = self._args.remote_snapdisk)
+			if chunker is not None:
+				raise NotImplementedError("Content-defined chunking is only supported for local images.")
+			# Some kind of endpoint was given. Reads are throttled on the server.
+			rate_limiter = self._create_rate_limiter("network", self._args.max_network_rate)
+			self._image = RemoteDiskImage(parsed_src, chunk_size = self._args.chunk_size, remote_snapdisk_binary = self._args.remote_snapdisk, hash_function = self._args.hash_function, window = self._args.remote_window, batch_size = self._args.remote_batch_size, pipeline_memory = self._args.pipeline_memory, socket_buffer_size = self._args.socket_buffer_size, wire_compression = wire_compression, rate_limiter = rate_limiter)
 
 		if self._args.name is None:
 			snapshot_name = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
 		else:
 			snapshot_name = self._args.name
+		store_layout = None if (self._args.store_layout is None) else ChunkStoreLayout(self._args.store_layout)
 		mode = SnapshotMode(self._args.mode)
-		with self._image, SnapshotWriter(image = self._image, target = self._args.dst, name = snapshot_name, compression = self._args.compress, mode = mode) as self._snapshot_writer:
-			self._snapshot_writer.create(progress_callback = self._progress, progress_callback_period = self._args.commit_period)
+		with self._image, SnapshotWriter(image = self._image, target = self._args.dst, name = snapshot_name, compression = compression, mode = mode, store_layout = store_layout, delta_parent = self._args.delta_parent, delta_block_size = self._args.delta_block_size) as self._snapshot_writer:
+			self._snapshot_writer.create(progress_callback = self._progress, progress_callback_period = self._args.commit_period, workers = self._args.workers)
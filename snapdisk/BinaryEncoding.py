@@ -0,0 +1,181 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import struct
+from .Codecs import Codecs
+from .HashFunctions import HashFunctions
+
+class BinaryEncodingException(Exception): pass
+
+class BinaryEncoding():
+	# Compact struct-based encoding of the frequent commands and their
+	# responses. Digests travel as raw bytes and every message decodes to
+	# the same dict as its JSON counterpart. Messages that do not fit a
+	# binary layout (other commands, errors, unknown values) are sent as
+	# JSON instead.
+	Name = "binary-1"
+	_VERSION = 1
+	_HEAD = struct.Struct("< B B")
+	_RESPONSE = 0x80
+	_OPCODES = {
+		"get_chunk_hash":	1,
+		"get_chunk_hashes":	2,
+		"get_chunk_data":	3,
+	}
+	_COMMANDS = { opcode: cmd for (cmd, opcode) in _OPCODES.items() }
+	_REQUEST_FIELDS = {
+		"get_chunk_hash":	set([ "cmd", "offset", "length", "hash_function", "detect_zero" ]),
+		"get_chunk_hashes":	set([ "cmd", "offset", "length", "count", "hash_function", "detect_zero" ]),
+		"get_chunk_data":	set([ "cmd", "offset", "length", "hash_function", "compression", "compress_level", "compress_threshold", "detect_zero" ]),
+	}
+	_HASH_FUNCTIONS = HashFunctions.names()
+	_DIGEST_SIZES = { name: HashFunctions.digest_size(name) for name in HashFunctions.available() }
+	_COMPRESSIONS = [ None ] + Codecs.names()
+	_FLAG_DETECT_ZERO = (1 << 0)
+	_FLAG_ZERO = (1 << 0)
+	_NO_LEVEL = -128
+
+	_HASH_REQUEST = struct.Struct("< Q Q B B")
+	_HASHES_REQUEST = struct.Struct("< Q Q L B B")
+	_DATA_REQUEST = struct.Struct("< Q Q B B b d")
+	_CHUNK_RECORD = struct.Struct("< Q Q B B")
+	_HASHES_RESPONSE = struct.Struct("< L")
+	_DATA_RESPONSE = struct.Struct("< Q Q B B")
+
+	@classmethod
+	def _encode_chunk_record(cls, msg):
+		hash_function = msg["hash_function"]
+		if msg["zero"]:
+			digest = bytes(cls._DIGEST_SIZES[hash_function])
+		else:
+			digest = bytes.fromhex(msg["hash"])
+		return cls._CHUNK_RECORD.pack(msg["offset"], msg["size"], cls._HASH_FUNCTIONS.index(hash_function), cls._FLAG_ZERO if msg["zero"] else 0) + digest
+
+	@classmethod
+	def _decode_chunk_record(cls, data, offset):
+		(chunk_offset, size, hash_function_id, flags) = cls._CHUNK_RECORD.unpack_from(data, offset)
+		hash_function = cls._HASH_FUNCTIONS[hash_function_id]
+		offset += cls._CHUNK_RECORD.size
+		digest_size = cls._DIGEST_SIZES[hash_function]
+		zero = (flags & cls._FLAG_ZERO) != 0
+		record = {
+			"offset":			chunk_offset,
+			"hash":				None if zero else bytes(data[offset : offset + digest_size]).hex(),
+			"hash_function":	hash_function,
+			"size":				size,
+			"zero":				zero,
+		}
+		return (record, offset + digest_size)
+
+	@classmethod
+	def encode_request(cls, msg):
+		try:
+			opcode = cls._OPCODES[msg["cmd"]]
+			if not (set(msg) <= cls._REQUEST_FIELDS[msg["cmd"]]):
+				# A field that the binary layout cannot carry
+				return None
+			hash_function_id = cls._HASH_FUNCTIONS.index(msg["hash_function"])
+			flags = cls._FLAG_DETECT_ZERO if msg.get("detect_zero", False) else 0
+			if opcode == 1:
+				body = cls._HASH_REQUEST.pack(msg["offset"], msg["length"], hash_function_id, flags)
+			elif opcode == 2:
+				body = cls._HASHES_REQUEST.pack(msg["offset"], msg["length"], msg["count"], hash_function_id, flags)
+			else:
+				level = msg.get("compress_level")
+				threshold = msg.get("compress_threshold")
+				body = cls._DATA_REQUEST.pack(msg["offset"], msg["length"], hash_function_id, cls._COMPRESSIONS.index(msg.get("compression")), cls._NO_LEVEL if (level is None) else level, -1 if (threshold is None) else threshold)
+		except (KeyError, ValueError, struct.error):
+			return None
+		return cls._HEAD.pack(cls._VERSION, opcode) + body
+
+	@classmethod
+	def encode_response(cls, cmd, msg):
+		if (cmd not in cls._OPCODES) or (msg.get("status") != "ok"):
+			return None
+		opcode = cls._OPCODES[cmd]
+		try:
+			if opcode == 1:
+				body = cls._encode_chunk_record(msg)
+			elif opcode == 2:
+				body = cls._HASHES_RESPONSE.pack(len(msg["chunks"])) + b"".join(cls._encode_chunk_record(chunk) for chunk in msg["chunks"])
+			else:
+				body = cls._DATA_RESPONSE.pack(msg["offset"], msg["size"], cls._HASH_FUNCTIONS.index(msg["hash_function"]), cls._COMPRESSIONS.index(msg["compression"])) + bytes.fromhex(msg["hash"])
+		except (KeyError, ValueError, TypeError, struct.error):
+			return None
+		return cls._HEAD.pack(cls._VERSION, cls._RESPONSE | opcode) + body
+
+	@classmethod
+	def _decode_request(cls, cmd, data):
+		msg = { "cmd": cmd }
+		if cmd == "get_chunk_hash":
+			(msg["offset"], msg["length"], hash_function_id, flags) = cls._HASH_REQUEST.unpack_from(data, cls._HEAD.size)
+		elif cmd == "get_chunk_hashes":
+			(msg["offset"], msg["length"], msg["count"], hash_function_id, flags) = cls._HASHES_REQUEST.unpack_from(data, cls._HEAD.size)
+		else:
+			(msg["offset"], msg["length"], hash_function_id, compression_id, level, threshold) = cls._DATA_REQUEST.unpack_from(data, cls._HEAD.size)
+			flags = 0
+			msg["compression"] = cls._COMPRESSIONS[compression_id]
+			msg["compress_level"] = None if (level == cls._NO_LEVEL) else level
+			msg["compress_threshold"] = None if (threshold < 0) else threshold
+		msg["hash_function"] = cls._HASH_FUNCTIONS[hash_function_id]
+		msg["detect_zero"] = (flags & cls._FLAG_DETECT_ZERO) != 0
+		return msg
+
+	@classmethod
+	def _decode_response(cls, cmd, data):
+		if cmd == "get_chunk_hash":
+			(msg, offset) = cls._decode_chunk_record(data, cls._HEAD.size)
+		elif cmd == "get_chunk_hashes":
+			(count, ) = cls._HASHES_RESPONSE.unpack_from(data, cls._HEAD.size)
+			offset = cls._HEAD.size + cls._HASHES_RESPONSE.size
+			chunks = [ ]
+			for i in range(count):
+				(chunk, offset) = cls._decode_chunk_record(data, offset)
+				chunks.append(chunk)
+			msg = { "chunks": chunks }
+		else:
+			(chunk_offset, size, hash_function_id, compression_id) = cls._DATA_RESPONSE.unpack_from(data, cls._HEAD.size)
+			hash_function = cls._HASH_FUNCTIONS[hash_function_id]
+			msg = {
+				"offset":			chunk_offset,
+				"hash":				bytes(data[cls._HEAD.size + cls._DATA_RESPONSE.size : ]).hex(),
+				"hash_function":	hash_function,
+				"size":				size,
+				"compression":		cls._COMPRESSIONS[compression_id],
+			}
+		msg["status"] = "ok"
+		return msg
+
+	@classmethod
+	def decode(cls, data):
+		try:
+			(version, opcode) = cls._HEAD.unpack_from(data)
+			if version != cls._VERSION:
+				raise BinaryEncodingException("Unsupported binary message version %d." % (version))
+			cmd = cls._COMMANDS.get(opcode & ~cls._RESPONSE)
+			if cmd is None:
+				raise BinaryEncodingException("Unknown binary message opcode 0x%x." % (opcode))
+			if opcode & cls._RESPONSE:
+				return cls._decode_response(cmd, data)
+			else:
+				return cls._decode_request(cmd, data)
+		except (struct.error, IndexError, KeyError) as e:
+			raise BinaryEncodingException("Malformed binary message: %s" % (str(e)))
@@ -0,0 +1,54 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import mmap
+import threading
+import collections
+
+class BufferPool():
+	# Page-aligned buffers (anonymous mappings, as required for O_DIRECT)
+	# that are returned after use, so that reading many equally sized chunks
+	# does not map and fault in fresh memory every time.
+	def __init__(self, max_free = 4):
+		self._max_free = max_free
+		self._lock = threading.Lock()
+		self._free = collections.defaultdict(list)
+
+	def acquire(self, size):
+		with self._lock:
+			if len(self._free[size]) > 0:
+				return self._free[size].pop()
+		return mmap.mmap(-1, size)
+
+	def release(self, buffer):
+		with self._lock:
+			if len(self._free[len(buffer)]) < self._max_free:
+				self._free[len(buffer)].append(buffer)
+				return
+		buffer.close()
+
+	def close(self):
+		with self._lock:
+			for buffers in self._free.values():
+				for buffer in buffers:
+					buffer.close()
+			self._free.clear()
@@ -19,73 +19,133 @@
 #
 #	Johannes Bauer <JohannesBauer@gmx.de>
 
-import os
-import hashlib
-import contextlib
-import subprocess
+import functools
+from .HashFunctions import HashFunctions
 
 class GenericChunk():
+	is_zero = False
+	compressed = None
+
+	def __init__(self, hash_function):
+		self._hash_function = hash_function
+
+	@property
+	def hash_function(self):
+		return self._hash_function
+
 	@property
 	def hash_value(self):
 		return self._hash_value
 
-	def _chunk_target_dir(self, target_dir):
-		return "%s/chunks/%s" % (target_dir, self.hash_value[:2])
-
-	def already_stored(self, target_dir):
-		dir_name = self._chunk_target_dir(target_dir)
-		return os.path.isfile("%s/%s" % (dir_name, self.hash_value)) or os.path.isfile("%s/%s.gz" % (dir_name, self.hash_value))
-
-	def store(self, target_dir, compression = None):
-		dir_name = "%s/chunks/%s" % (target_dir, self.hash_value[:2])
-		with contextlib.suppress(FileExistsError):
-			os.makedirs(dir_name)
-		_ = self.data		# Assure that chunk is fetched entirely if remote
-		if compression is None:
-			file_name = "%s/%s" % (dir_name, self.hash_value)
-			with open(file_name, "wb") as f:
-				f.write(self.data)
-			return len(self.data)
-		elif compression == "gz":
-			file_name = "%s/%s.gz" % (dir_name, self.hash_value)
-			with open(file_name, "wb") as f:
-				proc = subprocess.Popen([ "pigz" ], stdout = f, stdin = subprocess.PIPE)
-				proc.communicate(self.data)
-			return os.stat(file_name).st_size
-		else:
-			raise NotImplementedError(compression)
+	def already_stored(self, chunk_store):
+		return self.hash_value in chunk_store
+
+	def store(self, chunk_store, compression = None):
+		return chunk_store.store(self.hash_value, self.data, compression = compression, compressed = self.compressed)
 
 class Chunk(GenericChunk):
-	def __init__(self, data, hash_value = None):
-		GenericChunk.__init__(self)
-		assert(isinstance(data, bytes) or isinstance(data, bytearray))
+	@classmethod
+	def from_data(cls, data, hash_function = HashFunctions.Default):
+		if ZeroChunk.is_zero_data(data):
+			return ZeroChunk(len(data), hash_function = hash_function)
+		else:
+			return cls(data, hash_function = hash_function)
+
+	def __init__(self, data, hash_value = None, hash_function = HashFunctions.Default, compressed = None):
+		GenericChunk.__init__(self, hash_function = hash_function)
+		assert(isinstance(data, (bytes, bytearray, memoryview)))
 		self._data = data
+		# Tuple of codec name and the data compressed by it (or None if the
+		# codec found the data not worth compressing), if known
+		self._compressed = compressed
 		if hash_value is not None:
 			self._hash_value = hash_value
 		else:
-			self._hash_value = hashlib.sha384(self._data).hexdigest()
+			self._hash_value = HashFunctions.hexdigest(hash_function, self._data)
 
 	@property
 	def data(self):
 		return self._data
 
+	@property
+	def compressed(self):
+		return self._compressed
+
 	def __len__(self):
 		return len(self._data)
 
 class RemoteChunk(GenericChunk):
-	def __init__(self, hash_value, size, retrieval_callback):
-		GenericChunk.__init__(self)
+	def __init__(self, hash_value, size, retrieval_callback, hash_function = HashFunctions.Default):
+		GenericChunk.__init__(self, hash_function = hash_function)
 		self._hash_value = hash_value
 		self._size = size
 		self._retrieval_callback = retrieval_callback
 		self._chunk = None
 
-	@property
-	def data(self):
+	def _retrieve(self):
 		if self._chunk is None:
 			self._chunk = self._retrieval_callback()
 			assert(self._chunk.hash_value == self.hash_value)
-		return self._chunk.data
+		return self._chunk
+
+	@property
+	def data(self):
+		return self._retrieve().data
+
+	@property
+	def compressed(self):
+		return self._retrieve().compressed
+
+	def __len__(self):
+		return self._size
+
+class ZeroChunk(GenericChunk):
+	is_zero = True
+	_COMPARE_PIECE_SIZE = 1024 * 1024
+
+	def __init__(self, size, hash_function = HashFunctions.Default):
+		GenericChunk.__init__(self, hash_function = hash_function)
+		self._hash_value = None
+		self._size = size
+
+	@staticmethod
+	@functools.lru_cache(maxsize = 4)
+	def _zero_data(length):
+		return bytes(length)
+
+	@classmethod
+	def zero_data(cls, length):
+		# Shared zero buffers for the few lengths that recur (chunk size, size
+		# of a read)
+		return cls._zero_data(length)
+
+	@classmethod
+	def is_zero_data(cls, data):
+		# Compared in pieces against a single zero buffer, so that no buffer of
+		# the data's length (which differs for every content-defined chunk) is
+		# allocated. startswith() is a memcmp() that neither copies the piece
+		# nor continues past the first difference. Memoryviews lack it and
+		# would be compared element by element, so their pieces are copied.
+		zero_piece = memoryview(cls._zero_data(cls._COMPARE_PIECE_SIZE))
+		for offset in range(0, len(data), cls._COMPARE_PIECE_SIZE):
+			length = min(cls._COMPARE_PIECE_SIZE, len(data) - offset)
+			if isinstance(data, memoryview):
+				(piece, piece_offset) = (bytes(data[offset : offset + length]), 0)
+			else:
+				(piece, piece_offset) = (data, offset)
+			if not piece.startswith(zero_piece[ : length], piece_offset):
+				return False
+		return True
+
+	@property
+	def data(self):
+		return self._zero_data(self._size)
+
+	def already_stored(self, chunk_store):
+		return True
+
+	def store(self, chunk_store, compression = None):
+		raise NotImplementedError("Zero chunks are never stored.")
 
 	def __len__(self):
 		return self._size
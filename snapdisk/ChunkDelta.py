@@ -0,0 +1,118 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import hashlib
+
+class ChunkDeltaException(Exception): pass
+
+class ChunkDelta():
+	# Transfers a chunk that changed since a parent snapshot as the blocks
+	# that differ from the parent's chunk at the same index. The server sends
+	# digests of all blocks of its chunk, the client compares them against
+	# the parent's data, requests the differing blocks only and patches them
+	# into the parent's data. The result is verified by its full digest.
+	_DIGEST_SIZE = 16
+	_MIN_BLOCK_SIZE = 512
+
+	def __init__(self, parent_chunks, chunk_store, block_size):
+		# Parent chunks are given as a dict of chunk index and a tuple of
+		# length and hash value (None for a zero chunk).
+		self._parent_chunks = parent_chunks
+		self._chunk_store = chunk_store
+		self._block_size = block_size
+
+	@property
+	def block_size(self):
+		return self._block_size
+
+	def has_parent(self, chunk_index):
+		if chunk_index not in self._parent_chunks:
+			return False
+		(length, hash_value) = self._parent_chunks[chunk_index]
+		return (hash_value is None) or (hash_value in self._chunk_store)
+
+	def parent_data(self, chunk_index):
+		(length, hash_value) = self._parent_chunks[chunk_index]
+		if hash_value is None:
+			return bytes(length)
+		return self._chunk_store.load(hash_value)
+
+	@classmethod
+	def check_block_size(cls, block_size, length):
+		if not (cls._MIN_BLOCK_SIZE <= block_size <= length):
+			raise ChunkDeltaException("Block size %d invalid, must be between %d and %d bytes." % (block_size, cls._MIN_BLOCK_SIZE, length))
+
+	@classmethod
+	def block_count(cls, length, block_size):
+		return (length + block_size - 1) // block_size
+
+	@classmethod
+	def block_digests(cls, data, block_size):
+		view = memoryview(data)
+		return b"".join(hashlib.blake2b(view[offset : offset + block_size], digest_size = cls._DIGEST_SIZE).digest() for offset in range(0, len(data), block_size))
+
+	@classmethod
+	def changed_ranges(cls, parent_data, digests, block_size):
+		# Runs of consecutive blocks whose digests differ, as a list of first
+		# block and block count. Blocks beyond the parent's end always differ.
+		parent_digests = cls.block_digests(parent_data, block_size)
+		ranges = [ ]
+		for block_no in range(len(digests) // cls._DIGEST_SIZE):
+			offset = block_no * cls._DIGEST_SIZE
+			if digests[offset : offset + cls._DIGEST_SIZE] == parent_digests[offset : offset + cls._DIGEST_SIZE]:
+				continue
+			if (len(ranges) > 0) and (ranges[-1][0] + ranges[-1][1] == block_no):
+				ranges[-1][1] += 1
+			else:
+				ranges.append([ block_no, 1 ])
+		return ranges
+
+	@classmethod
+	def check_ranges(cls, ranges, length, block_size):
+		block_count = cls.block_count(length, block_size)
+		previous_end = 0
+		for (first_block, count) in ranges:
+			if (first_block < previous_end) or (count <= 0) or (first_block + count > block_count):
+				raise ChunkDeltaException("Invalid block range %d-%d for %d blocks requested." % (first_block, first_block + count - 1, block_count))
+			previous_end = first_block + count
+
+	@classmethod
+	def extract_blocks(cls, data, ranges, block_size):
+		view = memoryview(data)
+		return b"".join(view[first_block * block_size : (first_block + count) * block_size] for (first_block, count) in ranges)
+
+	@classmethod
+	def patch(cls, parent_data, length, ranges, blocks, block_size):
+		data = bytearray(length)
+		copy_length = min(length, len(parent_data))
+		data[ : copy_length] = memoryview(parent_data)[ : copy_length]
+		blocks_offset = 0
+		for (first_block, count) in ranges:
+			start = first_block * block_size
+			end = min(start + (count * block_size), length)
+			if blocks_offset + (end - start) > len(blocks):
+				raise ChunkDeltaException("Received %d bytes of blocks, but ranges cover more." % (len(blocks)))
+			data[start : end] = blocks[blocks_offset : blocks_offset + (end - start)]
+			blocks_offset += end - start
+		if blocks_offset != len(blocks):
+			raise ChunkDeltaException("Received %d bytes of blocks, but ranges cover %d bytes." % (len(blocks), blocks_offset))
+		return data
@@ -0,0 +1,78 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import queue
+import threading
+import concurrent.futures
+from .Chunk import Chunk
+from .HashFunctions import HashFunctions
+
+# Reader thread -> pool of hashing threads -> consumer (which stores the
+# chunks). Stages are connected by a bounded queue of futures, so chunks are
+# yielded in the order in which they were read.
+class ChunkPipeline():
+	_END_OF_DATA = object()
+
+	def __init__(self, data_source, hash_threads, queue_depth = None, hash_function = HashFunctions.Default):
+		assert(hash_threads >= 1)
+		self._data_source = data_source
+		self._hash_threads = hash_threads
+		if queue_depth is None:
+			queue_depth = 2 * hash_threads
+		self._queue = queue.Queue(maxsize = max(1, queue_depth))
+		self._hash_function = hash_function
+		self._abort = threading.Event()
+
+	def _put(self, item):
+		while not self._abort.is_set():
+			try:
+				self._queue.put(item, timeout = 0.1)
+				return True
+			except queue.Full:
+				pass
+		return False
+
+	def _reader(self, executor):
+		try:
+			for data in self._data_source:
+				future = executor.submit(Chunk.from_data, data, hash_function = self._hash_function)
+				if not self._put(future):
+					return
+		except Exception as e:
+			self._put(e)
+			return
+		self._put(self._END_OF_DATA)
+
+	def __iter__(self):
+		with concurrent.futures.ThreadPoolExecutor(max_workers = self._hash_threads) as executor:
+			reader = threading.Thread(target = self._reader, args = (executor, ), daemon = True)
+			reader.start()
+			try:
+				while True:
+					item = self._queue.get()
+					if item is self._END_OF_DATA:
+						break
+					elif isinstance(item, Exception):
+						raise item
+					yield item.result()
+			finally:
+				self._abort.set()
+				reader.join()
@@ -0,0 +1,190 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import threading
+import collections
+import concurrent.futures
+
+# Cache of hashed chunks that reader threads fill ahead of the clients'
+# requests. Clients read an image sequentially, so while a chunk is being
+# sent the next ones are already read and hashed in the background. The
+# cache may be shared by several clients of the same image; the read ahead
+# follows each client's position separately.
+#
+# A client requests the data of a chunk only after it received the chunk's
+# hash, and by then the hashes of its whole window of following chunks are
+# requested already. Chunks whose hash was sent are therefore kept until the
+# client requests the data of a later chunk or more chunks than its window
+# were hashed since. The memory limit is a hard cap, though: it includes
+# reads that are still running for chunks that were evicted already, the
+# read ahead stops when it is reached, and beyond it even those chunks are
+# evicted (and read again if needed). Only chunks that are being waited for
+# are never evicted.
+class ChunkReadAhead():
+	_DEFAULT_HASH_WINDOW = 9
+
+	def __init__(self, image, read_ahead = 4, threads = 1, memory = None):
+		self._image = image
+		self._read_ahead = read_ahead
+		self._memory = memory
+		self._executor = concurrent.futures.ThreadPoolExecutor(max_workers = max(1, threads))
+		self._lock = threading.Lock()
+		self._cache = collections.OrderedDict()
+		self._evicted_reads = { }
+		self._clients = { }
+		self._pinned = collections.Counter()
+		self._waiting = collections.Counter()
+
+	@property
+	def image(self):
+		return self._image
+
+	def register_client(self, client, hash_window = None):
+		with self._lock:
+			self._register_client(client, hash_window)
+
+	def _register_client(self, client, hash_window = None):
+		if hash_window is None:
+			hash_window = self._DEFAULT_HASH_WINDOW
+		self._clients[client] = {
+			"hash_window":		max(1, hash_window),
+			"pins":				collections.deque(),
+		}
+		return self._clients[client]
+
+	def _memory_limit(self, length):
+		if self._memory is None:
+			# Room for everything that the clients may still request
+			return sum(client["hash_window"] + self._read_ahead + 1 for client in self._clients.values()) * length
+		else:
+			return self._memory
+
+	def _memory_used(self):
+		for future in [ future for future in self._evicted_reads if future.done() ]:
+			del self._evicted_reads[future]
+		return sum(key[1] for key in self._cache) + sum(self._evicted_reads.values())
+
+	def _submit(self, key):
+		(offset, length, hash_function) = key
+		future = self._executor.submit(self._image.get_chunk_at, offset, length, hash_function = hash_function)
+		self._cache[key] = future
+		return future
+
+	def _pin(self, client, key):
+		if key in client["pins"]:
+			return
+		client["pins"].append(key)
+		self._pinned[key] += 1
+		# A window that does not fit into memory is of no use
+		max_pins = client["hash_window"] if (self._memory is None) else min(client["hash_window"], max(1, self._memory // key[1]))
+		while len(client["pins"]) > max_pins:
+			self._unpin(client["pins"].popleft())
+
+	def _unpin(self, key):
+		self._pinned[key] -= 1
+		if self._pinned[key] == 0:
+			del self._pinned[key]
+
+	def _evict(self, length):
+		limit = self._memory_limit(length)
+		used = self._memory_used()
+		# Chunks that a client may still request are only evicted when there
+		# is no other way to stay within the limit; those that a client waits
+		# for never are
+		for evict_pinned in [ False, True ]:
+			for (key, future) in list(self._cache.items()):
+				if used <= limit:
+					return
+				if ((key in self._pinned) and (not evict_pinned)) or (future in self._waiting):
+					continue
+				del self._cache[key]
+				if future.cancel() or future.done():
+					used -= key[1]
+				else:
+					# Its memory is only freed once the read has finished
+					self._evicted_reads[future] = key[1]
+
+	def get_chunk(self, offset, length, hash_function, client = None, data_request = False):
+		key = (offset, length, hash_function)
+		with self._lock:
+			client_state = self._clients.get(client)
+			if client_state is None:
+				client_state = self._register_client(client)
+			future = self._cache.get(key)
+			if future is None:
+				future = self._submit(key)
+			self._waiting[future] += 1
+
+			if data_request:
+				# The client has moved past all chunks before this one, but may
+				# still request this one again (e.g., blocks after its digests)
+				pins = client_state["pins"]
+				while (len(pins) > 0) and (pins[0][0] < offset):
+					self._unpin(pins.popleft())
+			else:
+				self._pin(client_state, key)
+				limit = self._memory_limit(length)
+				used = self._memory_used()
+				for ahead_offset in range(offset + length, offset + ((self._read_ahead + 1) * length), length):
+					if (ahead_offset >= self._image.disk_size) or (used + length > limit):
+						break
+					ahead_key = (ahead_offset, length, hash_function)
+					if ahead_key not in self._cache:
+						self._submit(ahead_key)
+						used += length
+
+		try:
+			chunk = future.result()
+		finally:
+			with self._lock:
+				self._waiting[future] -= 1
+				if self._waiting[future] == 0:
+					del self._waiting[future]
+				self._evict(length)
+		return chunk
+
+	def release_client(self, client):
+		with self._lock:
+			client_state = self._clients.pop(client, None)
+			if client_state is not None:
+				for key in client_state["pins"]:
+					self._unpin(key)
+			if len(self._clients) == 0:
+				# The image may change until the next client connects, which must
+				# not be served what was read for the previous ones
+				for (key, future) in list(self._cache.items()):
+					if future not in self._waiting:
+						del self._cache[key]
+						if not (future.cancel() or future.done()):
+							self._evicted_reads[future] = key[1]
+
+	def close(self):
+		with self._lock:
+			for future in self._cache.values():
+				future.cancel()
+			self._cache.clear()
+		self._executor.shutdown(wait = True)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
@@ -0,0 +1,404 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import struct
+import fcntl
+import enum
+import threading
+import collections
+import contextlib
+from .HashFunctions import HashFunctions
+from .Codecs import Codecs
+
+class ChunkStoreException(Exception): pass
+
+class ChunkStoreLayout(enum.Enum):
+	Loose = "loose"
+	Pack = "pack"
+
+class ChunkStore():
+	# The index is an append-only file of fixed-size records (raw digest,
+	# codec and location of a stored chunk) that follows a small header. A
+	# record is only appended after its chunk has been written completely
+	# and synced, and the index is synced after every record, so a crash can
+	# at worst lose the record of a chunk that is present (it is then stored
+	# again) but never index a chunk that is missing. A torn record at the
+	# end of the file is discarded. All appends and the repair happen under
+	# an exclusive lock; a writer reads the records that other writers
+	# (e.g., stripe processes) appended in the meantime before it appends
+	# its own, so that a chunk is stored only once. The index can always be
+	# recreated from the chunks themselves.
+	#
+	# Chunks are either stored as one file per chunk ("loose" layout, below
+	# a directory named by the first two hex digits) or appended to large
+	# pack files ("pack" layout). Pack entries carry their digest so that
+	# packs are self-describing. A pack store may still contain loose chunks
+	# when a migration was interrupted; these are indexed as well and an
+	# entry in a pack supersedes the loose one.
+	_INDEX_MAGIC = b"SDCIDX02"
+	_INDEX_HEADER = struct.Struct("< 8s L L")
+	_INDEX_LOCATION = struct.Struct("< B L Q Q")
+	_PACK_MAGIC = b"SDPACK01"
+	_PACK_HEADER = struct.Struct("< 8s L")
+	_PACK_ENTRY_MAGIC = b"SDPE"
+	_PACK_ENTRY_HEADER = struct.Struct("< 4s B Q")
+	_CODEC_SUFFIXES = [ "" ] + Codecs.suffixes()
+	_Entry = collections.namedtuple("Entry", [ "codec_id", "pack_no", "offset", "length" ])
+
+	def __init__(self, target_dir, hash_function = HashFunctions.Default, layout = None, max_pack_size = 1024 * 1024 * 1024):
+		self._target_dir = target_dir
+		self._hash_function = hash_function
+		self._chunk_dir = "%s/%s" % (target_dir, HashFunctions.chunk_dir(hash_function))
+		self._digest_size = HashFunctions.digest_size(hash_function)
+		self._record_size = self._digest_size + self._INDEX_LOCATION.size
+		self._max_pack_size = max_pack_size
+		self._entries = { }
+		self._index_fd = None
+		self._index_position = None
+		self._pack_fds = { }
+		self._pack_fds_lock = threading.Lock()
+		self._pack_end = None
+		with contextlib.suppress(FileExistsError):
+			os.makedirs(self._chunk_dir)
+		self._layout = self._determine_layout(layout)
+		self._open_index()
+
+	def _determine_layout(self, requested_layout):
+		if os.path.isdir(self.pack_dir):
+			layout = ChunkStoreLayout.Pack
+		elif any(True for _ in self._iter_loose_files()):
+			layout = ChunkStoreLayout.Loose
+		else:
+			layout = requested_layout or ChunkStoreLayout.Loose
+		if (requested_layout is not None) and (requested_layout != layout):
+			raise ChunkStoreException("Chunk store %s uses the %s layout, but %s was requested; migrate the store first." % (self._chunk_dir, layout.value, requested_layout.value))
+		if layout == ChunkStoreLayout.Pack:
+			with contextlib.suppress(FileExistsError):
+				os.mkdir(self.pack_dir)
+		return layout
+
+	@property
+	def chunk_dir(self):
+		return self._chunk_dir
+
+	@property
+	def pack_dir(self):
+		return "%s/packs" % (self._chunk_dir)
+
+	@property
+	def layout(self):
+		return self._layout
+
+	@property
+	def hash_function(self):
+		return self._hash_function
+
+	@property
+	def index_filename(self):
+		return "%s/index" % (self._chunk_dir)
+
+	@contextlib.contextmanager
+	def _index_locked(self):
+		fcntl.flock(self._index_fd, fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			fcntl.flock(self._index_fd, fcntl.LOCK_UN)
+
+	def _open_index(self):
+		self._index_fd = os.open(self.index_filename, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+		with self._index_locked():
+			index_size = os.fstat(self._index_fd).st_size
+			if index_size >= self._INDEX_HEADER.size:
+				(magic, version, digest_size) = self._INDEX_HEADER.unpack(os.pread(self._index_fd, self._INDEX_HEADER.size, 0))
+				if digest_size != self._digest_size:
+					raise ChunkStoreException("Chunk index %s belongs to a different hash function." % (self.index_filename))
+				valid = (magic == self._INDEX_MAGIC) and (version == 1)
+			else:
+				valid = False
+
+			if not valid:
+				# Missing or outdated index, recreate it from the chunks
+				os.ftruncate(self._index_fd, 0)
+				os.write(self._index_fd, self._INDEX_HEADER.pack(self._INDEX_MAGIC, 1, self._digest_size))
+				self._index_position = self._INDEX_HEADER.size
+				self._rebuild_index()
+				os.fsync(self._index_fd)
+			else:
+				self._index_position = self._INDEX_HEADER.size
+				torn_length = (index_size - self._INDEX_HEADER.size) % self._record_size
+				if torn_length != 0:
+					os.ftruncate(self._index_fd, index_size - torn_length)
+				self._read_index_tail()
+			if self._layout == ChunkStoreLayout.Pack:
+				self._index_leftover_loose_files()
+
+	def _index_leftover_loose_files(self):
+		# Caller must hold the index lock
+		appended = False
+		for (hash_value, codec_id, filename) in self._iter_loose_files():
+			digest = bytes.fromhex(hash_value)
+			if digest not in self._entries:
+				self._append_index(digest, self._Entry(codec_id = codec_id, pack_no = 0, offset = 0, length = os.stat(filename).st_size))
+				appended = True
+		if appended:
+			os.fsync(self._index_fd)
+
+	def _add_entry(self, digest, entry):
+		if entry.pack_no > 0:
+			self._pack_end = max(self._pack_end or (0, 0), (entry.pack_no, entry.offset + entry.length))
+		if (digest in self._entries) and ((self._entries[digest].pack_no != 0) or (entry.pack_no == 0)):
+			return
+		self._entries[digest] = entry
+
+	def _read_index_tail(self):
+		# Caller must hold the index lock
+		while True:
+			data = os.pread(self._index_fd, 1024 * self._record_size, self._index_position)
+			record_count = len(data) // self._record_size
+			if record_count == 0:
+				break
+			for offset in range(0, record_count * self._record_size, self._record_size):
+				digest = data[offset : offset + self._digest_size]
+				entry = self._Entry(*self._INDEX_LOCATION.unpack_from(data, offset + self._digest_size))
+				self._add_entry(digest, entry)
+			self._index_position += record_count * self._record_size
+
+	def _append_index(self, digest, entry):
+		# Caller must hold the index lock and have read the tail before
+		os.write(self._index_fd, digest + self._INDEX_LOCATION.pack(*entry))
+		self._index_position += self._record_size
+		self._add_entry(digest, entry)
+
+	def _iter_loose_files(self):
+		with os.scandir(self._chunk_dir) as dir_entries:
+			for dir_entry in dir_entries:
+				if (len(dir_entry.name) != 2) or (not dir_entry.is_dir()):
+					continue
+				with os.scandir(dir_entry.path) as chunk_entries:
+					for chunk_entry in chunk_entries:
+						(hash_value, suffix) = (chunk_entry.name[:2 * self._digest_size], chunk_entry.name[2 * self._digest_size:])
+						if (len(hash_value) == 2 * self._digest_size) and (suffix in self._CODEC_SUFFIXES):
+							yield (hash_value, self._CODEC_SUFFIXES.index(suffix), chunk_entry.path)
+
+	def _iter_pack_entries(self, pack_no):
+		pack_fd = self._pack_fd(pack_no)
+		pack_size = os.fstat(pack_fd).st_size
+		offset = self._PACK_HEADER.size
+		entry_header_size = self._PACK_ENTRY_HEADER.size + self._digest_size
+		while offset + entry_header_size <= pack_size:
+			header = os.pread(pack_fd, entry_header_size, offset)
+			(magic, codec_id, length) = self._PACK_ENTRY_HEADER.unpack_from(header)
+			data_offset = offset + entry_header_size
+			if (magic != self._PACK_ENTRY_MAGIC) or (data_offset + length > pack_size):
+				# Torn entry of a crashed writer
+				break
+			yield (header[self._PACK_ENTRY_HEADER.size : ], self._Entry(codec_id = codec_id, pack_no = pack_no, offset = data_offset, length = length))
+			offset = data_offset + length
+
+	def _pack_numbers(self):
+		return sorted(int(filename[5:-5]) for filename in os.listdir(self.pack_dir) if filename.startswith("pack-") and filename.endswith(".pack"))
+
+	def _rebuild_index(self):
+		# Caller must hold the index lock
+		if self._layout == ChunkStoreLayout.Loose:
+			for (hash_value, codec_id, filename) in self._iter_loose_files():
+				self._append_index(bytes.fromhex(hash_value), self._Entry(codec_id = codec_id, pack_no = 0, offset = 0, length = os.stat(filename).st_size))
+		else:
+			for pack_no in self._pack_numbers():
+				for (digest, entry) in self._iter_pack_entries(pack_no):
+					self._append_index(digest, entry)
+
+	def _loose_filename(self, hash_value, codec_id):
+		return "%s/%s/%s%s" % (self._chunk_dir, hash_value[:2], hash_value, self._CODEC_SUFFIXES[codec_id])
+
+	def _pack_filename(self, pack_no):
+		return "%s/pack-%06d.pack" % (self.pack_dir, pack_no)
+
+	def _pack_fd(self, pack_no):
+		# Chunks may be loaded by several threads (e.g., when restoring)
+		with self._pack_fds_lock:
+			if pack_no not in self._pack_fds:
+				pack_fd = os.open(self._pack_filename(pack_no), os.O_RDWR | os.O_CREAT, 0o644)
+				if os.fstat(pack_fd).st_size < self._PACK_HEADER.size:
+					os.pwrite(pack_fd, self._PACK_HEADER.pack(self._PACK_MAGIC, self._digest_size), 0)
+					os.fsync(pack_fd)
+					self._fsync_dir(self.pack_dir)
+				self._pack_fds[pack_no] = pack_fd
+			return self._pack_fds[pack_no]
+
+	@staticmethod
+	def _fsync_dir(dirname):
+		dir_fd = os.open(dirname, os.O_RDONLY | os.O_DIRECTORY)
+		try:
+			os.fsync(dir_fd)
+		finally:
+			os.close(dir_fd)
+
+	@staticmethod
+	def _pwrite_fully(fd, data, offset):
+		view = memoryview(data)
+		while len(view) > 0:
+			written = os.pwrite(fd, view, offset)
+			view = view[written : ]
+			offset += written
+
+	def __contains__(self, hash_value):
+		# Answered from memory. A chunk that another writer stored in the
+		# meantime is only noticed when storing it, under the index lock.
+		return bytes.fromhex(hash_value) in self._entries
+
+	def __len__(self):
+		return len(self._entries)
+
+	def __iter__(self):
+		return (digest.hex() for digest in self._entries)
+
+	def _store_loose(self, hash_value, codec_id, data):
+		# Chunks are written to a temporary file first and then renamed so
+		# that neither a crash nor a concurrent writer storing the same chunk
+		# can ever leave a truncated chunk file behind.
+		digest = bytes.fromhex(hash_value)
+		file_name = self._loose_filename(hash_value, codec_id)
+		try:
+			os.mkdir(os.path.dirname(file_name))
+			self._fsync_dir(self._chunk_dir)
+		except FileExistsError:
+			pass
+		tmp_file_name = "%s.%d.tmp" % (file_name, os.getpid())
+		with open(tmp_file_name, "wb") as f:
+			f.write(data)
+			f.flush()
+			os.fsync(f.fileno())
+		with self._index_locked():
+			self._read_index_tail()
+			if digest in self._entries:
+				os.unlink(tmp_file_name)
+				return False
+			os.replace(tmp_file_name, file_name)
+			self._fsync_dir(os.path.dirname(file_name))
+			self._append_index(digest, self._Entry(codec_id = codec_id, pack_no = 0, offset = 0, length = len(data)))
+			os.fsync(self._index_fd)
+		return True
+
+	def _store_pack(self, hash_value, codec_id, data, sync = True):
+		digest = bytes.fromhex(hash_value)
+		with self._index_locked():
+			self._read_index_tail()
+			if (digest in self._entries) and (self._entries[digest].pack_no != 0):
+				return False
+			# New entries are always written directly after the last indexed
+			# one, which overwrites any torn or unindexed leftovers.
+			(pack_no, offset) = self._pack_end or (1, self._PACK_HEADER.size)
+			if (offset > self._PACK_HEADER.size) and (offset + len(data) > self._max_pack_size):
+				(pack_no, offset) = (pack_no + 1, self._PACK_HEADER.size)
+			pack_fd = self._pack_fd(pack_no)
+			entry_header = self._PACK_ENTRY_HEADER.pack(self._PACK_ENTRY_MAGIC, codec_id, len(data)) + digest
+			self._pwrite_fully(pack_fd, entry_header + data, offset)
+			if sync:
+				os.fsync(pack_fd)
+			self._append_index(digest, self._Entry(codec_id = codec_id, pack_no = pack_no, offset = offset + len(entry_header), length = len(data)))
+			if sync:
+				os.fsync(self._index_fd)
+		return True
+
+	def store(self, hash_value, data, compression = None, compressed = None):
+		# Incompressible chunks are stored raw; the index (and, for loose
+		# chunks, the file suffix) records which codec a chunk was stored with.
+		# Data that already went through the same codec (e.g., on the wire) is
+		# not compressed a second time. Returns None if another writer stored
+		# the chunk in the meantime.
+		if compression is None:
+			compressed = None
+		elif (compressed is not None) and (compressed[0] == compression.name):
+			compressed = compressed[1]
+		else:
+			compressed = compression.compress_if_worthwhile(data)
+		if compressed is None:
+			codec_id = 0
+		else:
+			(codec_id, data) = (self._CODEC_SUFFIXES.index(compression.suffix), compressed)
+		if not self.store_raw(hash_value, codec_id, data):
+			return None
+		return len(data)
+
+	def store_raw(self, hash_value, codec_id, data):
+		if self._layout == ChunkStoreLayout.Loose:
+			return self._store_loose(hash_value, codec_id, data)
+		else:
+			return self._store_pack(hash_value, codec_id, data)
+
+	def load_raw(self, hash_value):
+		entry = self._entries[bytes.fromhex(hash_value)]
+		if entry.pack_no == 0:
+			with open(self._loose_filename(hash_value, entry.codec_id), "rb") as f:
+				data = f.read()
+		else:
+			data = os.pread(self._pack_fd(entry.pack_no), entry.length, entry.offset)
+		return (entry.codec_id, data)
+
+	def load(self, hash_value):
+		(codec_id, data) = self.load_raw(hash_value)
+		if codec_id != 0:
+			data = Codecs.from_suffix(self._CODEC_SUFFIXES[codec_id]).decompress(data)
+		return data
+
+	@classmethod
+	def migrate_to_pack(cls, target_dir, hash_function = HashFunctions.Default, max_pack_size = 1024 * 1024 * 1024):
+		# Idempotent: loose chunks are only deleted after all of them have
+		# been added to packs and the packs have been synced, so an
+		# interrupted migration can simply be restarted; until then, the
+		# store remains usable with the loose chunks that are left. Syncing
+		# happens once at the end instead of for every chunk. Must not run
+		# concurrently with a snapshot writing to the same store.
+		chunk_dir = "%s/%s" % (target_dir, HashFunctions.chunk_dir(hash_function))
+		with contextlib.suppress(FileExistsError):
+			os.makedirs("%s/packs" % (chunk_dir))
+		with cls(target_dir, hash_function = hash_function, layout = ChunkStoreLayout.Pack, max_pack_size = max_pack_size) as chunk_store:
+			loose_files = list(chunk_store._iter_loose_files())
+			for (hash_value, codec_id, filename) in loose_files:
+				with open(filename, "rb") as f:
+					chunk_store._store_pack(hash_value, codec_id, f.read(), sync = False)
+			for pack_fd in chunk_store._pack_fds.values():
+				os.fsync(pack_fd)
+			os.fsync(chunk_store._index_fd)
+			for (hash_value, codec_id, filename) in loose_files:
+				os.unlink(filename)
+			for dir_entry in os.scandir(chunk_dir):
+				if (len(dir_entry.name) == 2) and dir_entry.is_dir():
+					with contextlib.suppress(OSError):
+						os.rmdir(dir_entry.path)
+			return len(loose_files)
+
+	def close(self):
+		for pack_fd in self._pack_fds.values():
+			os.close(pack_fd)
+		self._pack_fds = { }
+		if self._index_fd is not None:
+			os.close(self._index_fd)
+			self._index_fd = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
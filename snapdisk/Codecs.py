@@ -0,0 +1,213 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import io
+import zlib
+import gzip
+import lzma
+import bz2
+import concurrent.futures
+
+try:
+	from compression import zstd
+	zstandard = None
+except ImportError:
+	zstd = None
+	try:
+		import zstandard
+	except ImportError:
+		zstandard = None
+
+class Codec():
+	_NAME = None
+	_SUFFIX = None
+	_DEFAULT_LEVEL = None
+	_LEVEL_RANGE = None
+	_BLOCK_SIZE = 1024 * 1024
+	_SAMPLE_SIZE = 64 * 1024
+	_SAMPLE_COUNT = 4
+
+	def __init__(self, level = None, threads = 1, threshold = None):
+		if (level is not None) and (not (self._LEVEL_RANGE[0] <= level <= self._LEVEL_RANGE[1])):
+			raise ValueError("Compression level of %s must be between %d and %d, but got %d." % (self._NAME, self._LEVEL_RANGE[0], self._LEVEL_RANGE[1], level))
+		self._level = level if (level is not None) else self._DEFAULT_LEVEL
+		self._threads = threads
+		self._threshold = threshold
+		self._executor = None
+
+	@property
+	def name(self):
+		return self._NAME
+
+	@property
+	def suffix(self):
+		return self._SUFFIX
+
+	@property
+	def level(self):
+		return self._level
+
+	@property
+	def threshold(self):
+		return self._threshold
+
+	def __getstate__(self):
+		# The executor cannot be pickled (e.g., when handing the codec to a
+		# stripe process); it is simply recreated on first use.
+		state = dict(self.__dict__)
+		state["_executor"] = None
+		return state
+
+	def _compress_block(self, data):
+		raise NotImplementedError(self.__class__.__name__)
+
+	def compress(self, data):
+		# Block-parallel framing: each block is compressed independently into
+		# its own member/stream/frame and the results are concatenated. All
+		# supported formats define such a concatenation to decompress to the
+		# concatenated plaintext, so the output remains a regular file of the
+		# respective format.
+		if (self._threads <= 1) or (len(data) <= self._BLOCK_SIZE):
+			return self._compress_block(data)
+		if self._executor is None:
+			self._executor = concurrent.futures.ThreadPoolExecutor(max_workers = self._threads)
+		view = memoryview(data)
+		blocks = [ view[offset : offset + self._BLOCK_SIZE] for offset in range(0, len(view), self._BLOCK_SIZE) ]
+		return b"".join(self._executor.map(self._compress_block, blocks))
+
+	def _sample_ratio(self, data):
+		# Estimate the compression ratio by compressing a few evenly spaced
+		# samples with the fastest zlib level, regardless of the codec.
+		sample_stride = (len(data) - self._SAMPLE_SIZE) // (self._SAMPLE_COUNT - 1)
+		view = memoryview(data)
+		compressed_size = 0
+		for sample_no in range(self._SAMPLE_COUNT):
+			offset = sample_no * sample_stride
+			compressed_size += len(zlib.compress(view[offset : offset + self._SAMPLE_SIZE], 1))
+		return compressed_size / (self._SAMPLE_COUNT * self._SAMPLE_SIZE)
+
+	def compress_if_worthwhile(self, data):
+		# Returns None if the data should rather be stored uncompressed, i.e.,
+		# if the sampled or the achieved ratio is above the threshold.
+		if self._threshold is None:
+			return self.compress(data)
+		if (len(data) >= 2 * self._SAMPLE_COUNT * self._SAMPLE_SIZE) and (self._sample_ratio(data) > self._threshold):
+			return None
+		compressed = self.compress(data)
+		if len(compressed) > self._threshold * len(data):
+			return None
+		return compressed
+
+	def decompress(self, data):
+		raise NotImplementedError(self.__class__.__name__)
+
+	def __str__(self):
+		return "%s-%s" % (self.name, self.level)
+
+class GzipCodec(Codec):
+	_NAME = "gz"
+	_SUFFIX = ".gz"
+	_DEFAULT_LEVEL = 6
+	_LEVEL_RANGE = (0, 9)
+
+	def _compress_block(self, data):
+		compressor = zlib.compressobj(self._level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+		return compressor.compress(data) + compressor.flush()
+
+	def decompress(self, data):
+		return gzip.decompress(data)
+
+class XzCodec(Codec):
+	_NAME = "xz"
+	_SUFFIX = ".xz"
+	_DEFAULT_LEVEL = 6
+	_LEVEL_RANGE = (0, 9)
+
+	def _compress_block(self, data):
+		return lzma.compress(data, preset = self._level)
+
+	def decompress(self, data):
+		return lzma.decompress(data)
+
+class Bzip2Codec(Codec):
+	_NAME = "bz2"
+	_SUFFIX = ".bz2"
+	_DEFAULT_LEVEL = 9
+	_LEVEL_RANGE = (1, 9)
+
+	def _compress_block(self, data):
+		return bz2.compress(data, compresslevel = self._level)
+
+	def decompress(self, data):
+		return bz2.decompress(data)
+
+class ZstdCodec(Codec):
+	_NAME = "zst"
+	_SUFFIX = ".zst"
+	_DEFAULT_LEVEL = 3
+	_LEVEL_RANGE = (1, 22)
+
+	def _compress_block(self, data):
+		if zstd is not None:
+			return zstd.compress(data, level = self._level)
+		else:
+			return zstandard.ZstdCompressor(level = self._level).compress(data)
+
+	def decompress(self, data):
+		if zstd is not None:
+			return zstd.decompress(data)
+		else:
+			with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data), read_across_frames = True) as reader:
+				return reader.read()
+
+class Codecs():
+	_CODECS = { codec._NAME: codec for codec in (GzipCodec, XzCodec, Bzip2Codec, ZstdCodec) }
+
+	@classmethod
+	def names(cls):
+		# All known codecs, also those whose module is not installed, in the
+		# order in which they were added; new ones must be appended since the
+		# position identifies them in the binary wire encoding
+		return list(cls._CODECS)
+
+	@classmethod
+	def available(cls):
+		names = [ "gz", "xz", "bz2" ]
+		if (zstd is not None) or (zstandard is not None):
+			names.append("zst")
+		return names
+
+	@classmethod
+	def suffixes(cls):
+		return [ codec._SUFFIX for codec in cls._CODECS.values() ]
+
+	@classmethod
+	def create(cls, name, level = None, threads = 1, threshold = None):
+		if name not in cls.available():
+			raise NotImplementedError("Unsupported compression codec: %s" % (name))
+		return cls._CODECS[name](level = level, threads = threads, threshold = threshold)
+
+	@classmethod
+	def from_suffix(cls, suffix):
+		for codec in cls._CODECS.values():
+			if codec._SUFFIX == suffix:
+				return codec()
+		raise NotImplementedError("No codec for suffix: %s" % (suffix))
@@ -19,30 +19,48 @@
 #
 #	Johannes Bauer <JohannesBauer@gmx.de>
 
+import os
 import json
 import struct
 import collections
+from .HashFunctions import HashFunctions
+from .BinaryEncoding import BinaryEncoding, BinaryEncodingException
 
 class MarshallingException(Exception): pass
 
 class CommandMarshalling():
 	_MAGIC = 4189080007
+	_BINARY_MAGIC = 4189080008
 	_HEADER = struct.Struct("< L L Q")
 	_HEADER_FIELDS = collections.namedtuple("Header", [ "magic", "msg_len", "payload_len" ])
-	_MESSAGE = collections.namedtuple("Message", [ "msg", "payload" ])
+	_MESSAGE = collections.namedtuple("Message", [ "msg", "payload", "payload_hash", "binary" ], defaults = [ None, False ])
+	_FRAME_SIZE = 1024 * 1024
 	assert(_HEADER.size == 16)
 
-	def __init__(self, recv_callback = None, send_callback = None):
+	# A payload that is sent straight from a file descriptor
+	FileRegion = collections.namedtuple("FileRegion", [ "fd", "offset", "length" ])
+
+	def __init__(self, recv_callback = None, send_callback = None, recv_into_callback = None, send_buffers_callback = None, send_file_callback = None):
 		self._send_callback = send_callback
 		self._recv_callback = recv_callback
+		self._recv_into_callback = recv_into_callback
+		self._send_buffers_callback = send_buffers_callback
+		self._send_file_callback = send_file_callback
+		self._binary_encoding = False
 
 	@classmethod
 	def create_on_endpoint(cls, endpoint):
-		return cls(send_callback = lambda data: endpoint.send(data), recv_callback = lambda length: endpoint.recv(length))
+		return cls(send_callback = lambda data: endpoint.send(data), recv_callback = lambda length: endpoint.recv(length), recv_into_callback = lambda view: endpoint.recv_into(view), send_buffers_callback = lambda buffers: endpoint.send_buffers(buffers), send_file_callback = lambda fd, offset, length: endpoint.send_file(fd, offset, length))
+
+	def set_binary_encoding(self, enabled):
+		# Only for requests; responses are encoded like their request
+		self._binary_encoding = enabled
 
 	def send_recv(self, msg = None, payload = None):
 		self.send(msg = msg, payload = payload)
-		recved = self.recv()
+		return self.check_response(self.recv())
+
+	def check_response(self, recved):
 		if not isinstance(recved.msg, dict):
 			raise MarshallingException("Invalid data type received: %s" % (type(recved.msg)))
 		if not "status" in recved.msg:
@@ -51,31 +69,87 @@ class CommandMarshalling():
 			raise MarshallingException("Received response message contains error status code: %s (%s)" % (recved.msg["status"], recved.msg.get("text")))
 		return recved
 
-	def send(self, msg = None, payload = None):
-		for chunk in self.marshal(msg, payload):
-			self._send_callback(chunk)
+	def send(self, msg = None, payload = None, reply_to = None):
+		if isinstance(payload, self.FileRegion):
+			self._send_callback(self._marshal_head(msg, payload.length, reply_to))
+			if self._send_file_callback is not None:
+				self._send_file_callback(payload.fd, payload.offset, payload.length)
+			else:
+				for offset in range(payload.offset, payload.offset + payload.length, self._FRAME_SIZE):
+					self._send_callback(os.pread(payload.fd, min(self._FRAME_SIZE, payload.offset + payload.length - offset), offset))
+		elif self._send_buffers_callback is not None:
+			# Header, message and payload in a single scatter-gather call
+			if payload is None:
+				payload = bytes()
+			self._send_buffers_callback([ self._marshal_head(msg, len(payload), reply_to), payload ])
+		else:
+			for chunk in self.marshal(msg, payload, reply_to):
+				self._send_callback(chunk)
 
-	def recv(self):
+	def _recv_payload(self, length, hash_function = None):
+		# The payload is received frame by frame into a single preallocated
+		# buffer; every frame is hashed right after it arrived, while the
+		# next one is still on the wire.
+		payload = bytearray(length)
+		view = memoryview(payload)
+		hashfnc = None if (hash_function is None) else HashFunctions.new(hash_function)
+		for offset in range(0, length, self._FRAME_SIZE):
+			frame = view[offset : offset + self._FRAME_SIZE]
+			if self._recv_into_callback is not None:
+				self._recv_into_callback(frame)
+			else:
+				frame[:] = self._recv_callback(len(frame))
+			if hashfnc is not None:
+				hashfnc.update(frame)
+		view.release()
+		if hashfnc is None:
+			return (payload, None)
+		else:
+			return (payload, hashfnc.hexdigest())
+
+	def recv(self, payload_hash_function = None):
 		header_bin = self._recv_callback(self._HEADER.size)
 		try:
 			header = self._HEADER_FIELDS(*self._HEADER.unpack(header_bin))
 		except struct.error as e:
 			raise MarshallingException("Marshalling unpacking error: %s" % (str(e)))
-		if header.magic != self._MAGIC:
-			raise MarshallingException("Invalid magic number received (expected %08x but got %08x)." % (self._MAGIC, header.magic))
+		if header.magic not in (self._MAGIC, self._BINARY_MAGIC):
+			raise MarshallingException("Invalid magic number received (expected %08x or %08x but got %08x)." % (self._MAGIC, self._BINARY_MAGIC, header.magic))
 		msg_bin = self._recv_callback(header.msg_len)
-		payload_bin = self._recv_callback(header.payload_len)
-		msg = json.loads(msg_bin.decode("ascii"))
-		return self._MESSAGE(msg = msg, payload = payload_bin)
+		(payload_bin, payload_hash) = self._recv_payload(header.payload_len, payload_hash_function)
+		binary = header.magic == self._BINARY_MAGIC
+		if binary:
+			try:
+				msg = BinaryEncoding.decode(msg_bin)
+			except BinaryEncodingException as e:
+				raise MarshallingException("Binary message decoding error: %s" % (str(e)))
+		else:
+			msg = json.loads(msg_bin.decode("ascii"))
+		return self._MESSAGE(msg = msg, payload = payload_bin, payload_hash = payload_hash, binary = binary)
+
+	def _marshal_head(self, msg, payload_length, reply_to = None):
+		# Messages without a binary layout fall back to JSON
+		msg_binary = None
+		if reply_to is not None:
+			if reply_to.binary:
+				msg_binary = BinaryEncoding.encode_response(reply_to.msg["cmd"], msg)
+		elif self._binary_encoding and isinstance(msg, dict):
+			msg_binary = BinaryEncoding.encode_request(msg)
+		if msg_binary is not None:
+			magic = self._BINARY_MAGIC
+		else:
+			magic = self._MAGIC
+			msg_binary = json.dumps(msg, separators = (",", ":")).encode("ascii")
+		header = self._HEADER.pack(magic, len(msg_binary), payload_length)
+		return header + msg_binary
 
-	def marshal(self, msg = None, payload = None):
-		msg_binary = json.dumps(msg, separators = (",", ":")).encode("ascii")
+	def marshal(self, msg = None, payload = None, reply_to = None):
 		if payload is None:
 			payload = bytes()
-		header = self._HEADER.pack(self._MAGIC, len(msg_binary), len(payload))
-		yield header
-		yield msg_binary
-		yield payload
+		yield self._marshal_head(msg, len(payload), reply_to)
+		payload = memoryview(payload)
+		for offset in range(0, len(payload), self._FRAME_SIZE):
+			yield payload[offset : offset + self._FRAME_SIZE]
 
 if __name__ == "__main__":
 	import io
@@ -0,0 +1,187 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import zlib
+import bisect
+import hashlib
+import collections
+import multiprocessing
+import concurrent.futures
+
+class ContentDefinedChunker():
+	# Boundaries are found in two stages. The first stage is a rolling hash
+	# that is computed for every block read at once using big integer
+	# arithmetic (i.e., it runs in C): every byte is mapped through a gear
+	# table and the mapped values are XORed over a sliding window. Positions
+	# at which this 8 bit value is zero are candidates, for which the second
+	# stage computes a CRC32 over the same window and checks the bits given
+	# by the (FastCDC-style normalized) mask. The window has an odd length
+	# and the gear table contains no zero so that long runs of a constant
+	# byte (e.g., zeros) do not make every position a candidate.
+	_WINDOW_SIZE = 17
+	_READ_SIZE = 4 * 1024 * 1024
+	_GEAR_TABLE = bytes(next(value for value in hashlib.sha256(b"snapdisk-cdc-gear" + bytes([ byte ])).digest() if value != 0) for byte in range(256))
+
+	def __init__(self, avg_size, min_size = None, max_size = None):
+		if min_size is None:
+			min_size = avg_size // 4
+		if max_size is None:
+			max_size = avg_size * 4
+		if not (self._WINDOW_SIZE <= min_size <= avg_size <= max_size):
+			raise ValueError("Content-defined chunking requires %d <= min_size <= avg_size <= max_size, but got min %d, avg %d, max %d." % (self._WINDOW_SIZE, min_size, avg_size, max_size))
+		self._min_size = min_size
+		self._avg_size = avg_size
+		self._max_size = max_size
+		mask_bits = max(0, avg_size.bit_length() - 1 - 8)
+		self._mask_before_avg = (1 << (mask_bits + 1)) - 1
+		self._mask_after_avg = (1 << max(0, mask_bits - 1)) - 1
+
+	@classmethod
+	def from_dict(cls, chunking):
+		return cls(min_size = chunking["min_size"], avg_size = chunking["avg_size"], max_size = chunking["max_size"])
+
+	@property
+	def min_size(self):
+		return self._min_size
+
+	@property
+	def avg_size(self):
+		return self._avg_size
+
+	@property
+	def max_size(self):
+		return self._max_size
+
+	@property
+	def read_size(self):
+		# Independent of the chunk sizes: the candidates of every block read
+		# are computed as big integers that are several times its size
+		return self._READ_SIZE
+
+	def to_dict(self):
+		return {
+			"method":		"cdc",
+			"min_size":		self._min_size,
+			"avg_size":		self._avg_size,
+			"max_size":		self._max_size,
+		}
+
+	def _candidates(self, data):
+		# XOR over a 16 byte window by repeated doubling, then the 17th byte
+		gear = int.from_bytes(data.translate(self._GEAR_TABLE), "little")
+		value = gear
+		for shift in (8, 16, 32, 64):
+			value ^= value << shift
+		value ^= gear << 128
+		return value.to_bytes(len(data) + self._WINDOW_SIZE, "little")[:len(data)]
+
+	def _cut_positions(self, data, context_length):
+		# All positions in the block (which follows context_length bytes of
+		# the data before it) at which a chunk may end when the CRC32 is
+		# checked with the mask after the average size, and the subset of them
+		# with the mask before it. Positions whose window would reach before
+		# the data (only at the beginning of the image) are skipped.
+		candidates = self._candidates(data)
+		(before_avg, after_avg) = ([ ], [ ])
+		pos = candidates.find(0, self._WINDOW_SIZE - 1)
+		while pos != -1:
+			crc = zlib.crc32(data[pos - self._WINDOW_SIZE + 1 : pos + 1])
+			if (crc & self._mask_after_avg) == 0:
+				after_avg.append(pos - context_length)
+				if (crc & self._mask_before_avg) == 0:
+					before_avg.append(pos - context_length)
+			pos = candidates.find(0, pos + 1)
+		return (before_avg, after_avg)
+
+	def _iter_cut_positions(self, blocks, workers):
+		# Yields every block with the positions at which it may be cut. They
+		# only depend on the block and the window before it, so several blocks
+		# are searched at once by a pool of processes (computing them holds
+		# the GIL); the fork start method keeps them from running __main__.
+		context = b""
+		if workers <= 1:
+			for block in blocks:
+				data = context + block
+				yield (block, ) + self._cut_positions(data, len(context))
+				context = data[-(self._WINDOW_SIZE - 1) : ]
+			return
+		pending = collections.deque()
+		with concurrent.futures.ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context("fork")) as executor:
+			for block in blocks:
+				data = context + block
+				pending.append((block, executor.submit(self._cut_positions, data, len(context))))
+				context = data[-(self._WINDOW_SIZE - 1) : ]
+				if len(pending) > 2 * workers:
+					(block, future) = pending.popleft()
+					yield (block, ) + future.result()
+			while len(pending) > 0:
+				(block, future) = pending.popleft()
+				yield (block, ) + future.result()
+
+	def _find_cut(self, cuts_before_avg, cuts_after_avg, start, end, end_of_data):
+		# Positions are relative to the beginning of the image, data is
+		# available up to end.
+		max_end = start + self._max_size
+		limit = min(max_end, end)
+		normal = min(start + self._avg_size, limit)
+		index = bisect.bisect_left(cuts_before_avg, start + self._min_size - 1)
+		if (index < len(cuts_before_avg)) and (cuts_before_avg[index] < normal):
+			return cuts_before_avg[index] + 1
+		index = bisect.bisect_left(cuts_after_avg, normal)
+		if (index < len(cuts_after_avg)) and (cuts_after_avg[index] < limit):
+			return cuts_after_avg[index] + 1
+		if max_end <= end:
+			return max_end
+		elif end_of_data:
+			return end
+		else:
+			return None
+
+	def _split_buffer(self, data, data_offset, cuts_before_avg, cuts_after_avg, start, end_of_data):
+		end = data_offset + len(data)
+		while start < end:
+			cut = self._find_cut(cuts_before_avg, cuts_after_avg, start, end, end_of_data)
+			if cut is None:
+				break
+			yield bytes(data[start - data_offset : cut - data_offset])
+			start = cut
+		return start
+
+	def split(self, blocks, workers = 1):
+		# Only the data of the chunk that is not cut yet is kept, beginning at
+		# data_offset of the image, and only the positions at which it may be
+		# cut. Those of newly read data are computed with the window before it
+		# taken from the previously read data, so cut positions depend on the
+		# data alone, not on how it was read.
+		data = bytearray()
+		(cuts_before_avg, cuts_after_avg) = ([ ], [ ])
+		(data_offset, start) = (0, 0)
+		for (block, before_avg, after_avg) in self._iter_cut_positions(blocks, workers):
+			offset = data_offset + len(data)
+			cuts_before_avg += [ pos + offset for pos in before_avg ]
+			cuts_after_avg += [ pos + offset for pos in after_avg ]
+			data += block
+			start = yield from self._split_buffer(data, data_offset, cuts_before_avg, cuts_after_avg, start, end_of_data = False)
+			del data[ : start - data_offset]
+			del cuts_before_avg[ : bisect.bisect_left(cuts_before_avg, start)]
+			del cuts_after_avg[ : bisect.bisect_left(cuts_after_avg, start)]
+			data_offset = start
+		yield from self._split_buffer(data, data_offset, cuts_before_avg, cuts_after_avg, start, end_of_data = True)
@@ -20,15 +20,34 @@
 #	Johannes Bauer <JohannesBauer@gmx.de>
 
 import os
-from .Chunk import Chunk, RemoteChunk
-from .Endpoints import EndpointDefinition, SubprocessEndpoint
+import errno
+import time
+import enum
+import mmap
+import stat
+import functools
+import collections
+import urllib.parse
+from .Chunk import Chunk, RemoteChunk, ZeroChunk
+from .ChunkDelta import ChunkDelta
+from .ChunkPipeline import ChunkPipeline
+from .Endpoints import EndpointDefinition, SubprocessEndpoint, EndpointTerminatedException
 from .CommandMarshalling import CommandMarshalling
+from .RequestWindow import RequestWindow
+from .BinaryEncoding import BinaryEncoding
+from .HashFunctions import HashFunctions
+from .BufferPool import BufferPool
+from .ExtFilesystem import ExtFilesystem
+
+class DiskImageException(Exception): pass
 
 class GenericDiskImage():
-	def __init__(self, device_name, chunk_size, disk_size):
+	def __init__(self, device_name, chunk_size, disk_size, chunker = None, hash_function = HashFunctions.Default):
 		self._device_name = device_name
 		self._chunk_size = chunk_size
 		self._disk_size = disk_size
+		self._chunker = chunker
+		self._hash_function = hash_function
 		self._chunk_count = (self._disk_size + self._chunk_size - 1) // self._chunk_size
 
 	@property
@@ -47,18 +66,58 @@ class GenericDiskImage():
 	def chunk_count(self):
 		return self._chunk_count
 
-	def iter_chunk_indices(self, start_offset = None):
+	@property
+	def chunker(self):
+		return self._chunker
+
+	@property
+	def hash_function(self):
+		return self._hash_function
+
+	def iter_chunk_indices(self, start_offset = None, end_offset = None):
 		if start_offset is None:
 			start_offset = 0
 		else:
 			assert((start_offset % self._chunk_size) == 0)
+		if end_offset is None:
+			end_chunk = self.chunk_count
+		else:
+			end_chunk = min((end_offset + self._chunk_size - 1) // self._chunk_size, self.chunk_count)
+
+		return range(start_offset // self._chunk_size, end_chunk)
 
-		return range(start_offset // self._chunk_size, self.chunk_count)
+class DiskReadMode(enum.Enum):
+	Cached = "cached"
+	DontNeed = "dontneed"
+	Direct = "direct"
+	Mmap = "mmap"
 
 class DiskImage(GenericDiskImage):
-	def __init__(self, device_name, chunk_size):
-		GenericDiskImage.__init__(self, device_name = device_name, chunk_size = chunk_size, disk_size = self._get_disksize(device_name))
+	_THROTTLED_READ_SIZE = 1024 * 1024
+	_DIRECT_ALIGNMENT = 4096
+
+	def __init__(self, device_name, chunk_size, hash_threads = 1, pipeline_memory = None, chunker = None, hash_function = HashFunctions.Default, rate_limiter = None, read_mode = DiskReadMode.Cached, skip_free_blocks = False):
+		assert(isinstance(read_mode, DiskReadMode))
+		if (read_mode == DiskReadMode.Mmap) and (rate_limiter is not None) and (rate_limiter.latency_target is not None):
+			# Mapped pages are only read in when they are hashed, there is no
+			# read whose latency could be measured
+			raise NotImplementedError("A read latency target cannot be used with memory mapped reading.")
+		GenericDiskImage.__init__(self, device_name = device_name, chunk_size = chunk_size, disk_size = self._get_disksize(device_name), chunker = chunker, hash_function = hash_function)
 		self._f = None
+		self._direct_fd = None
+		self._buffer_pool = None
+		self._mapping = None
+		self._skip_holes = False
+		self._skip_free_blocks = skip_free_blocks
+		self._filesystem = None
+		self._hash_threads = hash_threads
+		self._pipeline_memory = pipeline_memory
+		self._rate_limiter = rate_limiter
+		self._read_mode = read_mode
+
+	@property
+	def read_mode(self):
+		return self._read_mode
 
 	@staticmethod
 	def _get_disksize(device_name):
@@ -68,33 +127,219 @@ class DiskImage(GenericDiskImage):
 
 	def __enter__(self):
 		self._f = open(self._device_name, "rb")
+		# Holes of sparse files are found with SEEK_DATA/SEEK_HOLE; file
+		# systems that do not track them report the whole file as data
+		self._skip_holes = stat.S_ISREG(os.fstat(self._f.fileno()).st_mode)
+		if self._read_mode != DiskReadMode.Cached:
+			os.posix_fadvise(self._f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+		if self._read_mode == DiskReadMode.Direct:
+			try:
+				self._direct_fd = os.open(self._device_name, os.O_RDONLY | os.O_DIRECT)
+			except OSError as e:
+				self._f.close()
+				raise NotImplementedError("Cannot open %s for direct I/O: %s" % (self._device_name, str(e)))
+			self._buffer_pool = BufferPool(max_free = max(2, self._hash_threads))
+		elif (self._read_mode == DiskReadMode.Mmap) and (self._disk_size > 0):
+			if not stat.S_ISREG(os.fstat(self._f.fileno()).st_mode):
+				self._f.close()
+				raise NotImplementedError("Memory mapped reading is only supported for regular files, not %s." % (self._device_name))
+			self._mapping = mmap.mmap(self._f.fileno(), self._disk_size, access = mmap.ACCESS_READ)
+			self._mapping.madvise(mmap.MADV_SEQUENTIAL)
+		if self._skip_free_blocks:
+			try:
+				self._filesystem = ExtFilesystem(self.read_at, self._disk_size)
+			except Exception:
+				self.__exit__()
+				raise
 		return self
 
 	def __exit__(self, *args):
 		self._f.close()
 		self._f = None
+		self._filesystem = None
+		if self._direct_fd is not None:
+			os.close(self._direct_fd)
+			self._direct_fd = None
+			self._buffer_pool.close()
+			self._buffer_pool = None
+		if self._mapping is not None:
+			try:
+				self._mapping.close()
+			except BufferError:
+				# Chunks that are still referenced elsewhere keep the mapping
+				# alive; it is unmapped once they are gone
+				pass
+			self._mapping = None
+
+	def fileno(self):
+		return self._f.fileno()
 
-	def get_chunk_at(self, offset, chunk_size = None):
-		if chunk_size is None:
-			chunk_size = self._chunk_size
-		end_offset = offset + chunk_size
+	def _data_ranges(self, offset, length):
+		# Allocated ranges of the file within the given range; the remainder
+		# are holes that read as zeros.
+		ranges = [ ]
+		(pos, end_offset) = (offset, offset + length)
+		while pos < end_offset:
+			try:
+				data_offset = os.lseek(self._f.fileno(), pos, os.SEEK_DATA)
+			except OSError as e:
+				if e.errno == errno.ENXIO:
+					# Only a hole follows up to the end of the file
+					break
+				raise
+			if data_offset >= end_offset:
+				break
+			hole_offset = min(os.lseek(self._f.fileno(), data_offset, os.SEEK_HOLE), end_offset)
+			ranges.append((data_offset, hole_offset))
+			pos = hole_offset
+		return ranges
+
+	def read_at(self, offset, length = None):
+		if length is None:
+			length = self._chunk_size
+		end_offset = offset + length
 		if end_offset > self._disk_size:
 			end_offset = self._disk_size
 		expect_read_length = end_offset - offset
-		self._f.seek(offset)
-		data = self._f.read(chunk_size)
+		if (self._filesystem is not None) and self._filesystem.is_free(offset, expect_read_length):
+			# Whatever free blocks contain is of no use to anyone
+			return ZeroChunk.zero_data(expect_read_length)
+		if self._skip_holes and (expect_read_length > 0):
+			ranges = self._data_ranges(offset, expect_read_length)
+			if len(ranges) == 0:
+				# Entirely a hole, nothing to read at all
+				return ZeroChunk.zero_data(expect_read_length)
+			elif ranges != [ (offset, end_offset) ]:
+				data = bytearray(expect_read_length)
+				for (range_start, range_end) in ranges:
+					data[range_start - offset : range_end - offset] = self._read_range(range_start, range_end - range_start)
+				return data
+		return self._read_range(offset, expect_read_length)
+
+	def _read_range(self, offset, expect_read_length):
+		# pread does not move the file position, so reads may be concurrent
+		if self._mapping is not None:
+			data = self._read_mapped(offset, expect_read_length)
+		elif (self._direct_fd is not None) and ((offset % self._DIRECT_ALIGNMENT) == 0):
+			data = self._read_direct(offset, expect_read_length)
+		else:
+			if self._rate_limiter is None:
+				data = os.pread(self._f.fileno(), expect_read_length, offset)
+			else:
+				data = self._read_throttled(offset, expect_read_length)
+			if self._read_mode != DiskReadMode.Cached:
+				# Do not displace the page cache's contents with data that is
+				# only read once
+				os.posix_fadvise(self._f.fileno(), offset, expect_read_length, os.POSIX_FADV_DONTNEED)
 		assert(len(data) == expect_read_length)
-		return Chunk(data = data)
+		return data
+
+	def _read_into(self, fd, view, offset):
+		# Throttled reads happen in small pieces so that the disk is not
+		# saturated in bursts, and the rate limiter adapts to how long each of
+		# them took. Returns the number of bytes read, which is less than
+		# requested only at the end of the image.
+		piece_size = len(view) if (self._rate_limiter is None) else self._THROTTLED_READ_SIZE
+		pos = 0
+		while pos < len(view):
+			piece = view[pos : pos + piece_size]
+			if self._rate_limiter is not None:
+				self._rate_limiter.consume(len(piece))
+			t0 = time.monotonic()
+			read_length = os.preadv(fd, [ piece ], offset + pos)
+			if self._rate_limiter is not None:
+				self._rate_limiter.report_latency(read_length, time.monotonic() - t0)
+			if read_length == 0:
+				break
+			pos += read_length
+		return pos
+
+	def _read_throttled(self, offset, length):
+		data = bytearray(length)
+		with memoryview(data) as view:
+			read_length = self._read_into(self._f.fileno(), view, offset)
+		del data[read_length : ]
+		return data
+
+	def _read_mapped(self, offset, length):
+		# A read-only view of the mapping without any copy; the pages are read
+		# in when the chunk is hashed (possibly by several threads at once)
+		# or stored. Have the kernel read them ahead in large requests.
+		if self._rate_limiter is not None:
+			self._rate_limiter.consume(length)
+		page_offset = offset - (offset % mmap.PAGESIZE)
+		if length > 0:
+			self._mapping.madvise(mmap.MADV_WILLNEED, page_offset, offset + length - page_offset)
+		return memoryview(self._mapping)[offset : offset + length]
+
+	def _read_direct(self, offset, length):
+		# O_DIRECT bypasses the page cache entirely, but needs aligned buffers
+		# and lengths. The data is copied out of the pooled buffer once since
+		# chunks live on for much longer (pipeline, compression, caches).
+		aligned_length = (length + self._DIRECT_ALIGNMENT - 1) // self._DIRECT_ALIGNMENT * self._DIRECT_ALIGNMENT
+		buffer = self._buffer_pool.acquire(aligned_length)
+		try:
+			with memoryview(buffer) as view:
+				read_length = self._read_into(self._direct_fd, view, offset)
+				return bytes(view[ : min(length, read_length)])
+		finally:
+			self._buffer_pool.release(buffer)
+
+	def get_chunk_at(self, offset, chunk_size = None, hash_function = None, detect_zero = True):
+		if hash_function is None:
+			hash_function = self._hash_function
+		data = self.read_at(offset, chunk_size)
+		if detect_zero:
+			return Chunk.from_data(data, hash_function = hash_function)
+		else:
+			return Chunk(data, hash_function = hash_function)
 
-	def iter_chunks(self, start_offset = None):
-		self._f.seek(start_offset)
-		for chunk_no in self.iter_chunk_indices(start_offset):
-			yield self.get_chunk_at(chunk_no * self._chunk_size)
+	def stripe_image_factory(self, stripe_count):
+		if self._pipeline_memory is None:
+			pipeline_memory = None
+		else:
+			pipeline_memory = max(self._chunk_size, self._pipeline_memory // stripe_count)
+		rate_limiter = None if (self._rate_limiter is None) else self._rate_limiter.split(stripe_count)
+		return functools.partial(DiskImage, self._device_name, chunk_size = self._chunk_size, hash_threads = max(1, self._hash_threads // stripe_count), pipeline_memory = pipeline_memory, hash_function = self._hash_function, rate_limiter = rate_limiter, read_mode = self._read_mode, skip_free_blocks = self._skip_free_blocks)
+
+	def _iter_blocks(self, start_offset, block_size):
+		for offset in range(start_offset, self._disk_size, block_size):
+			yield self.read_at(offset, block_size)
+
+	def iter_chunk_data(self, start_offset = None, end_offset = None):
+		if self._chunker is not None:
+			assert(end_offset is None)
+			yield from self._chunker.split(self._iter_blocks(start_offset or 0, self._chunker.read_size), workers = self._hash_threads)
+			return
+
+		for chunk_no in self.iter_chunk_indices(start_offset, end_offset):
+			yield self.read_at(chunk_no * self._chunk_size)
+
+	def _pipeline_queue_depth(self):
+		queue_depth = 2 * self._hash_threads
+		if self._pipeline_memory is not None:
+			queue_depth = min(queue_depth, self._pipeline_memory // self._chunk_size)
+		return max(1, queue_depth)
+
+	def iter_chunks(self, start_offset = None, end_offset = None, known_hashes = None, delta = None):
+		# All chunks are read locally anyway, neither known hashes nor a delta
+		# against a parent snapshot help here
+		if self._hash_threads <= 1:
+			for data in self.iter_chunk_data(start_offset, end_offset):
+				yield Chunk.from_data(data, hash_function = self._hash_function)
+		else:
+			yield from ChunkPipeline(self.iter_chunk_data(start_offset, end_offset), hash_threads = self._hash_threads, queue_depth = self._pipeline_queue_depth(), hash_function = self._hash_function)
 
 class RemoteDiskImage(GenericDiskImage):
-	def __init__(self, parsed_uri, chunk_size, remote_snapdisk_binary):
+	def __init__(self, parsed_uri, chunk_size, remote_snapdisk_binary, hash_function = HashFunctions.Default, window = 8, batch_size = 64 * 1024 * 1024, pipeline_memory = None, socket_buffer_size = None, wire_compression = None, rate_limiter = None):
 		self._parsed_uri = parsed_uri
 		self._remote_snapdisk_binary = remote_snapdisk_binary
+		self._window = max(1, window)
+		self._batch_size = batch_size
+		self._pipeline_memory = pipeline_memory
+		self._socket_buffer_size = socket_buffer_size
+		self._requested_wire_compression = wire_compression
+		self._rate_limiter = rate_limiter
 		if parsed_uri.scheme == "ssh":
 			username_hostname_port = parsed_uri.netloc
 			if ":" in username_hostname_port:
@@ -109,24 +354,254 @@ class RemoteDiskImage(GenericDiskImage):
 			self._endpoint = SubprocessEndpoint(command)
 		else:
 			endpoint_definition = EndpointDefinition.from_parsed_uri(self._parsed_uri)
-			self._endpoint = endpoint_definition.create_connection()
+			self._endpoint = endpoint_definition.create_connection(buffer_size = socket_buffer_size)
+		if rate_limiter is not None:
+			self._endpoint.set_rate_limiter(rate_limiter)
 		self._marshal = CommandMarshalling.create_on_endpoint(self._endpoint)
 
-		meta_data = self._marshal.send_recv({ "cmd": "get_image_metadata" })
-		GenericDiskImage.__init__(self, device_name = meta_data.msg["device_name"], chunk_size = chunk_size, disk_size = meta_data.msg["disk_size"])
+		image_name = urllib.parse.parse_qs(parsed_uri.query).get("image", [ None ])[0]
+		# The server keeps the chunks whose data may be requested after their
+		# hashes: those of the current batch and of the window that follows
+		hash_window = (self._window + 1) * max(1, batch_size // chunk_size)
+		meta_data = self._marshal.send_recv({ "cmd": "get_image_metadata", "image": image_name, "hash_window": hash_window })
+		# Servers that do not advertise their hash functions only know SHA-384
+		server_hash_functions = meta_data.msg.get("hash_functions", [ HashFunctions.Default ])
+		if hash_function not in server_hash_functions:
+			raise NotImplementedError("Server does not support hash function %s, only: %s" % (hash_function, ", ".join(server_hash_functions)))
+		self._batch_hashes = "get_chunk_hashes" in meta_data.msg.get("commands", [ ])
+		self._block_delta = "get_chunk_blocks" in meta_data.msg.get("commands", [ ])
+		self._server_max_clients = meta_data.msg.get("max_clients", 1)
+		self._marshal.set_binary_encoding(BinaryEncoding.Name in meta_data.msg.get("encodings", [ ]))
+		if (wire_compression is not None) and (wire_compression.name in meta_data.msg.get("compressions", [ ])):
+			self._wire_compression = wire_compression
+		else:
+			self._wire_compression = None
+		GenericDiskImage.__init__(self, device_name = meta_data.msg["device_name"], chunk_size = chunk_size, disk_size = meta_data.msg["disk_size"], hash_function = hash_function)
 
 	def __enter__(self):
 		return self
 
-	def __exit__(self, *args):
-		self._marshal.send_recv({ "cmd": "quit" })
-
-	def iter_chunks(self, start_offset = None):
-		for chunk_no in range(start_offset // self._chunk_size, self.chunk_count):
-			offset = chunk_no * self._chunk_size
-			chunk_hash_msg = self._marshal.send_recv({ "cmd": "get_chunk_hash", "offset": offset, "length": self.chunk_size })
-			def _retrieve():
-				chunk_data_msg = self._marshal.send_recv({ "cmd": "get_chunk_data", "offset": offset, "length": self.chunk_size })
-				assert((len(chunk_data_msg.payload) == self._chunk_size) or (chunk_no == self.chunk_count - 1))
-				return Chunk(data = chunk_data_msg.payload)
-			yield RemoteChunk(chunk_hash_msg.msg["hash"], chunk_hash_msg.msg["size"], retrieval_callback = _retrieve)
+	def __exit__(self, exc_type, exc_value, traceback):
+		# After an error, the connection may be broken; the server copes with
+		# a client that simply disconnects. A server may also have closed a
+		# connection that idled, e.g., while stripes were transferred over
+		# connections of their own.
+		try:
+			if exc_type is None:
+				self._marshal.send_recv({ "cmd": "quit" })
+		except (EndpointTerminatedException, OSError):
+			pass
+		finally:
+			self._endpoint.close()
+
+	def stripe_image_factory(self, stripe_count):
+		# Every stripe opens a connection of its own. Via ssh, each of them
+		# starts its own server process; any other server must accept those
+		# in addition to this connection, which stays open meanwhile.
+		required_clients = stripe_count + 1
+		if (self._parsed_uri.scheme != "ssh") and (self._server_max_clients < required_clients):
+			raise NotImplementedError("Server accepts only %d client(s) at a time, but %d connections are required for striping; start the server with --max-clients %d or more." % (self._server_max_clients, required_clients, required_clients))
+		if self._pipeline_memory is None:
+			pipeline_memory = None
+		else:
+			pipeline_memory = max(self._chunk_size, self._pipeline_memory // stripe_count)
+		rate_limiter = None if (self._rate_limiter is None) else self._rate_limiter.split(stripe_count)
+		return functools.partial(RemoteDiskImage, self._parsed_uri, chunk_size = self._chunk_size, remote_snapdisk_binary = self._remote_snapdisk_binary, hash_function = self._hash_function, window = self._window, batch_size = self._batch_size, pipeline_memory = pipeline_memory, socket_buffer_size = self._socket_buffer_size, wire_compression = self._requested_wire_compression, rate_limiter = rate_limiter)
+
+	def _iter_hash_requests(self, chunk_indices):
+		if self._batch_hashes:
+			batch_count = max(1, self._batch_size // self._chunk_size)
+		else:
+			batch_count = 1
+		for i in range(0, len(chunk_indices), batch_count):
+			batch = chunk_indices[i : i + batch_count]
+			msg = { "offset": batch[0] * self._chunk_size, "length": self.chunk_size, "hash_function": self.hash_function, "detect_zero": True }
+			if self._batch_hashes:
+				msg["cmd"] = "get_chunk_hashes"
+				msg["count"] = len(batch)
+			else:
+				msg["cmd"] = "get_chunk_hash"
+			yield msg
+
+	def _submit_data_request(self, window, offset, hashed_data = False):
+		msg = { "cmd": "get_chunk_data", "offset": offset, "length": self.chunk_size, "hash_function": self.hash_function }
+		if hashed_data:
+			msg["hashed_data"] = True
+		if self._wire_compression is None:
+			# Hash the data while it is being received
+			return window.submit(msg, payload_hash_function = self.hash_function)
+		msg["compression"] = self._wire_compression.name
+		msg["compress_level"] = self._wire_compression.level
+		msg["compress_threshold"] = self._wire_compression.threshold
+		return window.submit(msg)
+
+	def _submit_block_digests_request(self, window, offset, block_size):
+		return window.submit({ "cmd": "get_chunk_block_digests", "offset": offset, "length": self.chunk_size, "hash_function": self.hash_function, "block_size": block_size })
+
+	def _submit_blocks_request(self, window, chunk_info, delta, digests_response):
+		# Requests the blocks that differ from the parent chunk. Returns None
+		# if the digests do not belong to the chunk whose hash was reported.
+		if digests_response.msg["hash"] != chunk_info["hash"]:
+			return None
+		chunk_index = chunk_info["offset"] // self._chunk_size
+		parent_data = delta.parent_data(chunk_index)
+		ranges = ChunkDelta.changed_ranges(parent_data, digests_response.payload, delta.block_size)
+		msg = { "cmd": "get_chunk_blocks", "offset": chunk_info["offset"], "length": self.chunk_size, "hash_function": self.hash_function, "block_size": delta.block_size, "ranges": ranges }
+		if self._wire_compression is not None:
+			msg["compression"] = self._wire_compression.name
+			msg["compress_level"] = self._wire_compression.level
+			msg["compress_threshold"] = self._wire_compression.threshold
+		return (window.submit(msg), parent_data, ranges)
+
+	def _chunk_from_blocks_response(self, response, chunk_info, delta, parent_data, ranges):
+		# Returns None whenever the delta cannot reproduce the chunk, which
+		# then needs to be transferred as a whole
+		if response.msg["hash"] != chunk_info["hash"]:
+			return None
+		if response.msg.get("compression") is not None:
+			blocks = self._wire_compression.decompress(response.payload)
+		else:
+			blocks = response.payload
+		data = ChunkDelta.patch(parent_data, chunk_info["size"], ranges, blocks, delta.block_size)
+		chunk = Chunk(data = data, hash_function = self.hash_function)
+		if chunk.hash_value != chunk_info["hash"]:
+			return None
+		return chunk
+
+	def _chunk_from_data_response(self, response, size):
+		if response.msg.get("compression") is not None:
+			data = self._wire_compression.decompress(response.payload)
+			compressed = (response.msg["compression"], response.payload)
+		else:
+			data = response.payload
+			# The server found the chunk not worth compressing
+			compressed = None if (self._wire_compression is None) else (self._wire_compression.name, None)
+		assert(len(data) == size)
+		return Chunk(data = data, hash_value = response.payload_hash, hash_function = self.hash_function, compressed = compressed)
+
+	def _data_window(self):
+		data_window = self._window
+		if self._pipeline_memory is not None:
+			data_window = min(data_window, self._pipeline_memory // self._chunk_size)
+		return max(1, data_window)
+
+	def iter_chunks(self, start_offset = None, end_offset = None, known_hashes = None, delta = None):
+		# Keep a window of hash requests in flight so that neither the link
+		# nor the server idle during a round trip. When the hashes that are
+		# already present are known, the data of all other chunks is requested
+		# ahead of time as well. Chunks that have a parent to compute a delta
+		# against have their block digests requested instead.
+		if not self._block_delta:
+			delta = None
+		window = RequestWindow(self._marshal)
+		hash_requests = self._iter_hash_requests(self.iter_chunk_indices(start_offset, end_offset))
+		hash_tickets = collections.deque()
+		ready_chunks = collections.deque()
+		prefetch_candidates = collections.deque()
+		prefetched_hashes = set()
+		pending_digests = collections.deque()
+		data_window = self._data_window()
+		data_in_flight = 0
+
+		def use_delta(chunk_info):
+			return (delta is not None) and delta.has_parent(chunk_info["offset"] // self._chunk_size)
+
+		def submit_fetch(chunk_info):
+			if use_delta(chunk_info):
+				chunk_info["ticket"] = self._submit_block_digests_request(window, chunk_info["offset"], delta.block_size)
+				chunk_info["stage"] = "digests"
+				pending_digests.append(chunk_info)
+			else:
+				chunk_info["ticket"] = self._submit_data_request(window, chunk_info["offset"])
+				chunk_info["stage"] = "data"
+
+		def request_blocks(chunk_info):
+			# Follows up on the block digests of a chunk with the blocks that
+			# differ, or with the whole chunk if the delta cannot work
+			blocks_request = self._submit_blocks_request(window, chunk_info, delta, window.result(chunk_info["ticket"]))
+			if blocks_request is None:
+				chunk_info["ticket"] = self._submit_data_request(window, chunk_info["offset"])
+				chunk_info["stage"] = "data"
+			else:
+				(chunk_info["ticket"], chunk_info["parent_data"], chunk_info["ranges"]) = blocks_request
+				chunk_info["stage"] = "blocks"
+
+		def request_received_blocks():
+			# Block digests that have arrived are followed up right away, in
+			# order, so that the blocks are in flight long before they are
+			# needed instead of costing a round trip each
+			while len(pending_digests) > 0:
+				chunk_info = pending_digests[0]
+				if chunk_info["stage"] == "digests":
+					if not window.has_result(chunk_info["ticket"]):
+						break
+					request_blocks(chunk_info)
+				pending_digests.popleft()
+
+		def fetch_data(chunk_info):
+			nonlocal data_in_flight
+			if chunk_info.get("ticket") is None:
+				submit_fetch(chunk_info)
+			else:
+				data_in_flight -= 1
+			if chunk_info["stage"] == "digests":
+				request_blocks(chunk_info)
+			ticket = chunk_info.pop("ticket")
+			if chunk_info["stage"] == "blocks":
+				chunk = self._chunk_from_blocks_response(window.result(ticket), chunk_info, delta, chunk_info.pop("parent_data"), chunk_info["ranges"])
+				if chunk is not None:
+					return chunk
+				ticket = self._submit_data_request(window, chunk_info["offset"])
+			chunk = self._chunk_from_data_response(window.result(ticket), chunk_info["size"])
+			if chunk.hash_value != chunk_info["hash"]:
+				# Sent straight from an image that changed since it was hashed
+				ticket = self._submit_data_request(window, chunk_info["offset"], hashed_data = True)
+				chunk = self._chunk_from_data_response(window.result(ticket), chunk_info["size"])
+				if chunk.hash_value != chunk_info["hash"]:
+					raise DiskImageException("Data of the chunk at offset %d does not match its hash %s." % (chunk_info["offset"], chunk_info["hash"]))
+			return chunk
+
+		try:
+			while True:
+				while len(hash_tickets) < self._window:
+					msg = next(hash_requests, None)
+					if msg is None:
+						break
+					hash_tickets.append(window.submit(msg))
+
+				if (len(ready_chunks) == 0) and (len(hash_tickets) > 0):
+					response = window.result(hash_tickets.popleft())
+					chunk_infos = response.msg["chunks"] if ("chunks" in response.msg) else [ response.msg ]
+					ready_chunks += chunk_infos
+					prefetch_candidates += chunk_infos
+				if len(ready_chunks) == 0:
+					break
+
+				while (known_hashes is not None) and (len(prefetch_candidates) > 0) and (data_in_flight < data_window):
+					chunk_info = prefetch_candidates.popleft()
+					if chunk_info["zero"] or (chunk_info["hash"] in prefetched_hashes) or (chunk_info["hash"] in known_hashes):
+						continue
+					submit_fetch(chunk_info)
+					prefetched_hashes.add(chunk_info["hash"])
+					data_in_flight += 1
+				request_received_blocks()
+
+				chunk_info = ready_chunks.popleft()
+				if chunk_info["zero"]:
+					yield ZeroChunk(chunk_info["size"], hash_function = self.hash_function)
+					continue
+				yield RemoteChunk(chunk_info["hash"], chunk_info["size"], retrieval_callback = functools.partial(fetch_data, chunk_info), hash_function = self.hash_function)
+				prefetched_hashes.discard(chunk_info["hash"])
+				if chunk_info.get("ticket") is not None:
+					# Chunk turned out not to be needed after all
+					window.discard(chunk_info.pop("ticket"))
+					chunk_info["stage"] = None
+					chunk_info.pop("parent_data", None)
+					data_in_flight -= 1
+		except GeneratorExit:
+			# Abandoned early: the connection is still good and is used for
+			# further requests. After any other exception it is not, and
+			# draining it would only hide the original error.
+			window.drain()
+			raise
+		window.drain()
@@ -20,32 +20,82 @@
 #	Johannes Bauer <JohannesBauer@gmx.de>
 
 from .CommandMarshalling import CommandMarshalling, MarshallingException
+from .Endpoints import EndpointTerminatedException
+from .HashFunctions import HashFunctions
+from .Chunk import Chunk
+from .Codecs import Codecs
+from .BinaryEncoding import BinaryEncoding
+from .ChunkDelta import ChunkDelta, ChunkDeltaException
 
 class CommandException(Exception): pass
 class CommandQuit(Exception): pass
 
 class DiskImageServer():
-	def __init__(self, image, endpoint, max_chunk_size):
-		self._image = image
+	_MAX_BATCH_COUNT = 4096
+	_MAX_HASH_WINDOW = 16 * _MAX_BATCH_COUNT
+	_COMMANDS = [ "get_image_metadata", "get_chunk_hash", "get_chunk_hashes", "get_chunk_data", "get_chunk_block_digests", "get_chunk_blocks", "quit" ]
+
+	def __init__(self, images, endpoint, max_chunk_size, sendfile = True, compression_threads = 1, max_clients = 1):
+		# Images are given as a dict of name and ChunkReadAhead, which may be
+		# shared with other connections; the first one is the default.
+		self._images = images
+		self._read_ahead = next(iter(self._images.values()))
+		self._image = self._read_ahead.image
 		self._endpoint = endpoint
 		self._marshal = CommandMarshalling.create_on_endpoint(self._endpoint)
 		self._chunk = None
 		self._chunk_length = None
 		self._chunk_offset = None
+		self._chunk_hash_function = None
 		self._max_chunk_size = max_chunk_size
+		self._hash_functions = HashFunctions.available()
+		self._sendfile = sendfile and self._endpoint.zero_copy
+		self._compression_threads = compression_threads
+		self._max_clients = max_clients
+		self._codecs = { }
 
-	def _read_chunk(self, offset, length):
+	def _read_chunk(self, offset, length, hash_function, detect_zero = False, data_request = False):
 		if length > self._max_chunk_size:
 			raise CommandException("Server chunk size limited at %d bytes, but %d bytes requested." % (self._max_chunk_size, length))
-		if (self._chunk_offset != offset) or (self._chunk_length != length):
-			self._chunk_offset = offset
-			self._chunk_length = length
-			self._chunk = self._image.get_chunk_at(self._chunk_offset, self._chunk_length)
+		if hash_function not in self._hash_functions:
+			raise CommandException("Unsupported hash function '%s' requested." % (hash_function))
+		self._chunk_offset = offset
+		self._chunk_length = length
+		self._chunk_hash_function = hash_function
+		self._chunk = self._read_ahead.get_chunk(offset, length, hash_function, client = self, data_request = data_request)
+		if self._chunk.is_zero and not detect_zero:
+			# Client does not know about zero chunks, hash them regularly
+			self._chunk = Chunk(self._chunk.data, hash_function = self._chunk_hash_function)
 
 	def _cmd_get_image_metadata(self, request):
+		if request.msg.get("image") is not None:
+			if request.msg["image"] not in self._images:
+				raise CommandException("No image named '%s' served, only: %s" % (request.msg["image"], ", ".join(self._images)))
+			self._read_ahead.release_client(self)
+			self._read_ahead = self._images[request.msg["image"]]
+			self._image = self._read_ahead.image
+		if request.msg.get("hash_window") is not None:
+			# Chunks that the client may request the data of after their hashes
+			self._read_ahead.register_client(self, hash_window = min(request.msg["hash_window"], self._MAX_HASH_WINDOW))
 		return {
+			"images":			list(self._images),
 			"device_name":		self._image.device_name,
 			"disk_size":		self._image.disk_size,
+			"hash_functions":	self._hash_functions,
+			"commands":			self._COMMANDS,
+			"compressions":		Codecs.available(),
+			"encodings":		[ "json", BinaryEncoding.Name ],
+			"max_clients":		self._max_clients,
+		}
+
+	def _chunk_hash_response(self, offset, length, hash_function, detect_zero):
+		self._read_chunk(offset, length, hash_function, detect_zero = detect_zero)
+		return {
+			"offset":			self._chunk_offset,
+			"hash":				self._chunk.hash_value,
+			"hash_function":	self._chunk_hash_function,
+			"size":				len(self._chunk),
+			"zero":				self._chunk.is_zero,
 		}
 
 	def _cmd_get_chunk_hash(self, request):
@@ -53,23 +103,103 @@ class DiskImageServer():
 			raise CommandException("Excpected marshalled data to contain 'offset' key.")
 		if not "length" in request.msg:
 			raise CommandException("Excpected marshalled data to contain 'length' key.")
-		self._read_chunk(request.msg["offset"], request.msg["length"])
+		return self._chunk_hash_response(request.msg["offset"], request.msg["length"], request.msg.get("hash_function", HashFunctions.Default), detect_zero = request.msg.get("detect_zero", False))
+
+	def _cmd_get_chunk_hashes(self, request):
+		# Hashes of 'count' consecutive chunks in a single round trip
+		for key in [ "offset", "length", "count" ]:
+			if not key in request.msg:
+				raise CommandException("Excpected marshalled data to contain '%s' key." % (key))
+		if not (0 < request.msg["count"] <= self._MAX_BATCH_COUNT):
+			raise CommandException("Batch of %d chunk hashes requested, but must be between 1 and %d." % (request.msg["count"], self._MAX_BATCH_COUNT))
+		(offset, length) = (request.msg["offset"], request.msg["length"])
+		if length <= 0:
+			raise CommandException("Invalid chunk length %d requested." % (length))
+		chunks = [ ]
+		for chunk_offset in range(offset, min(offset + (request.msg["count"] * length), self._image.disk_size), length):
+			chunks.append(self._chunk_hash_response(chunk_offset, length, request.msg.get("hash_function", HashFunctions.Default), detect_zero = request.msg.get("detect_zero", False)))
 		return {
-			"offset":		self._chunk_offset,
-			"hash":			self._chunk.hash_value,
-			"size":			len(self._chunk),
+			"chunks":			chunks,
 		}
 
+	def _get_codec(self, name, level, threshold):
+		key = (name, level, threshold)
+		if key not in self._codecs:
+			if name not in Codecs.available():
+				raise CommandException("Unsupported compression '%s' requested." % (name))
+			self._codecs[key] = Codecs.create(name, level = level, threads = self._compression_threads, threshold = threshold)
+		return self._codecs[key]
+
 	def _cmd_get_chunk_data(self, request):
 		if not "offset" in request.msg:
 			raise CommandException("Excpected marshalled data to contain 'offset' key.")
 		if not "length" in request.msg:
 			raise CommandException("Excpected marshalled data to contain 'length' key.")
-		self._read_chunk(request.msg["offset"], request.msg["length"])
-		return ({
-			"offset":		self._chunk_offset,
-			"hash":			self._chunk.hash_value,
-		}, self._chunk.data)
+		self._read_chunk(request.msg["offset"], request.msg["length"], request.msg.get("hash_function", HashFunctions.Default), data_request = True)
+		response = {
+			"offset":			self._chunk_offset,
+			"hash":				self._chunk.hash_value,
+			"hash_function":	self._chunk_hash_function,
+			"size":				len(self._chunk),
+			"compression":		None,
+		}
+		if request.msg.get("compression") is not None:
+			# With the client's level and threshold, the result is exactly what
+			# the client would have stored, so it can keep the compressed data
+			# as it is. Chunks that are not worth compressing are sent raw.
+			codec = self._get_codec(request.msg["compression"], request.msg.get("compress_level"), request.msg.get("compress_threshold"))
+			compressed = codec.compress_if_worthwhile(self._chunk.data)
+			if compressed is not None:
+				response["compression"] = codec.name
+				return (response, compressed)
+		if self._sendfile and (not request.msg.get("hashed_data", False)):
+			# The kernel sends the data straight from the image. Should it have
+			# changed since it was hashed, the client notices the mismatch and
+			# requests exactly the data that was hashed instead.
+			payload = CommandMarshalling.FileRegion(fd = self._image.fileno(), offset = self._chunk_offset, length = len(self._chunk))
+		else:
+			payload = self._chunk.data
+		return (response, payload)
+
+	def _read_chunk_blocks(self, request):
+		for key in [ "offset", "length", "block_size" ]:
+			if not key in request.msg:
+				raise CommandException("Excpected marshalled data to contain '%s' key." % (key))
+		self._read_chunk(request.msg["offset"], request.msg["length"], request.msg.get("hash_function", HashFunctions.Default), data_request = True)
+		try:
+			ChunkDelta.check_block_size(request.msg["block_size"], request.msg["length"])
+		except ChunkDeltaException as e:
+			raise CommandException(str(e))
+		return {
+			"offset":			self._chunk_offset,
+			"hash":				self._chunk.hash_value,
+			"hash_function":	self._chunk_hash_function,
+			"size":				len(self._chunk),
+			"block_size":		request.msg["block_size"],
+		}
+
+	def _cmd_get_chunk_block_digests(self, request):
+		response = self._read_chunk_blocks(request)
+		return (response, ChunkDelta.block_digests(self._chunk.data, response["block_size"]))
+
+	def _cmd_get_chunk_blocks(self, request):
+		# Only the requested block ranges of a chunk, for a client that has
+		# the remaining blocks already
+		response = self._read_chunk_blocks(request)
+		ranges = request.msg.get("ranges", [ ])
+		try:
+			ChunkDelta.check_ranges(ranges, response["size"], response["block_size"])
+		except ChunkDeltaException as e:
+			raise CommandException(str(e))
+		payload = ChunkDelta.extract_blocks(self._chunk.data, ranges, response["block_size"])
+		response["compression"] = None
+		if request.msg.get("compression") is not None:
+			codec = self._get_codec(request.msg["compression"], request.msg.get("compress_level"), request.msg.get("compress_threshold"))
+			compressed = codec.compress_if_worthwhile(payload)
+			if compressed is not None:
+				response["compression"] = codec.name
+				payload = compressed
+		return (response, payload)
 
 	def _cmd_quit(self, request):
 		raise CommandQuit("Connection closed successully.")
@@ -87,9 +217,20 @@ class DiskImageServer():
 		return cmd_handler(request)
 
 	def run(self):
+		try:
+			self._serve()
+		finally:
+			self._read_ahead.release_client(self)
+
+	def _serve(self):
 		while True:
 			try:
 				request = self._marshal.recv()
+			except EndpointTerminatedException:
+				# The client disconnected without saying goodbye, e.g., after an
+				# error on its side
+				break
+			try:
 				response = self._process_command(request)
 			except (CommandException, MarshallingException) as e:
 				self._marshal.send({ "status": "error", "text": str(e) })
@@ -105,4 +246,4 @@ class DiskImageServer():
 			if response_msg is None:
 				response_msg = { }
 			response_msg["status"] = "ok"
-			self._marshal.send(response_msg, response_payload)
+			self._marshal.send(response_msg, response_payload, reply_to = request)
@@ -23,6 +23,7 @@ import sys
 import socket
 import os
 import ssl
+import select
 import contextlib
 import subprocess
 import urllib.parse
@@ -32,19 +33,56 @@ from .Certificates import Certificates
 class EndpointTerminatedException(Exception): pass
 
 class ReliableEndpoint():
+	_FILE_BLOCK_SIZE = 1024 * 1024
+	_THROTTLED_SEND_SIZE = 256 * 1024
+	_rate_limiter = None
+
+	@property
+	def zero_copy(self):
+		return False
+
+	def set_rate_limiter(self, rate_limiter):
+		# Limits the sum of sent and received bytes
+		self._rate_limiter = rate_limiter
+
+	def send_buffers(self, buffers):
+		for buffer in buffers:
+			self.send(buffer)
+
+	def send_file(self, fd, offset, length):
+		end_offset = offset + length
+		while offset < end_offset:
+			data = os.pread(fd, min(self._FILE_BLOCK_SIZE, end_offset - offset), offset)
+			if len(data) == 0:
+				raise EndpointTerminatedException("File ended %d bytes before the end of the region to send." % (end_offset - offset))
+			self.send(data)
+			offset += len(data)
+
+	def close(self):
+		pass
+
 	def send(self, data):
-		bytes_sent = 0
-		while bytes_sent < len(data):
-			bytes_sent += self._send(data[bytes_sent : ])
+		view = memoryview(data)
+		while len(view) > 0:
+			if self._rate_limiter is None:
+				view = view[self._send(view) : ]
+			else:
+				self._rate_limiter.consume(min(len(view), self._THROTTLED_SEND_SIZE))
+				view = view[self._send(view[ : self._THROTTLED_SEND_SIZE]) : ]
+
+	def recv_into(self, view):
+		# Fills the given writable memoryview completely without copying
+		while len(view) > 0:
+			received = self._recv_into(view)
+			if not received:
+				raise EndpointTerminatedException("Received zero bytes; connection severed.")
+			if self._rate_limiter is not None:
+				self._rate_limiter.consume(received)
+			view = view[received : ]
 
 	def recv(self, length):
-		received = bytearray()
-		while len(received) < length:
-			missing = length - len(received)
-			chunk = self._recv(missing)
-			if len(chunk) == 0:
-				raise EndpointTerminatedException("Received zero bytes; connection severed.")
-			received += chunk
+		received = bytearray(length)
+		self.recv_into(memoryview(received))
 		return received
 
 class StdinStdoutEndpoint(ReliableEndpoint):
@@ -56,41 +94,113 @@ class StdinStdoutEndpoint(ReliableEndpoint):
 		sys.stdout.buffer.flush()
 		return written
 
-	def _recv(self, length):
-		return sys.stdin.buffer.read(length)
+	def _recv_into(self, view):
+		return sys.stdin.buffer.readinto(view)
 
 class SocketEndpoint(ReliableEndpoint):
-	def __init__(self, sock):
+	def __init__(self, sock, tls_context = None):
 		self._sock = sock
+		self._tls_context = tls_context
 
 	@property
 	def sock(self):
 		return self._sock
 
+	@property
+	def zero_copy(self):
+		# TLS sockets have to encrypt in user space, only plain sockets can
+		# hand buffers or file contents to the kernel directly. Throttled
+		# sockets send in portions that the rate limiter allows.
+		return (self._rate_limiter is None) and (not isinstance(self._sock, ssl.SSLSocket))
+
+	def send_buffers(self, buffers):
+		if not self.zero_copy:
+			return ReliableEndpoint.send_buffers(self, buffers)
+		views = [ memoryview(buffer) for buffer in buffers if len(buffer) > 0 ]
+		while len(views) > 0:
+			sent = self._sock.sendmsg(views)
+			while (len(views) > 0) and (sent >= len(views[0])):
+				sent -= len(views.pop(0))
+			if sent > 0:
+				views[0] = views[0][sent : ]
+
+	def handshake(self):
+		# Connections accepted on a TLS listener are plain until this
+		# performs the server side TLS handshake, which is subject to the
+		# timeout that is set
+		if self._tls_context is not None:
+			self._sock = self._tls_context.wrap_socket(self._sock, server_side = True)
+			self._tls_context = None
+
+	def set_timeout(self, timeout):
+		# Sending or receiving fails when it makes no progress for this many
+		# seconds
+		self._sock.settimeout(timeout)
+
+	def send_file(self, fd, offset, length):
+		if not self.zero_copy:
+			return ReliableEndpoint.send_file(self, fd, offset, length)
+		timeout = self._sock.gettimeout()
+		while length > 0:
+			if timeout is not None:
+				# A socket with a timeout does not block, so wait for room
+				(readable, writable, exceptional) = select.select([ ], [ self._sock ], [ ], timeout)
+				if len(writable) == 0:
+					raise TimeoutError("timed out")
+			try:
+				sent = os.sendfile(self._sock.fileno(), fd, offset, length)
+			except BlockingIOError:
+				continue
+			if sent == 0:
+				raise EndpointTerminatedException("File ended %d bytes before the end of the region to send." % (length))
+			offset += sent
+			length -= sent
+
+	@staticmethod
+	def _set_buffer_size(sock, buffer_size):
+		# Setting the buffer sizes disables the kernel's auto-tuning, so only
+		# do it when explicitly requested
+		if buffer_size is not None:
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+		return sock
+
 	def _send(self, data):
 		return self._sock.send(data)
 
-	def _recv(self, length):
-		return self._sock.recv(length)
+	def _recv_into(self, view):
+		return self._sock.recv_into(view)
+
+	def shutdown(self):
+		# Makes pending and further operations on the connection fail, also
+		# those of other threads
+		with contextlib.suppress(OSError):
+			self._sock.shutdown(socket.SHUT_RDWR)
+
+	def close(self):
+		self._sock.close()
 
 	@classmethod
-	def _prepare_ip_socket(cls, bind_address, bind_port):
-		sock = socket.socket()
+	def _prepare_ip_socket(cls, bind_address, bind_port, buffer_size = None, backlog = 1):
+		sock = cls._set_buffer_size(socket.socket(), buffer_size)
 		sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 		sock.bind((bind_address, bind_port))
-		sock.listen(1)
+		sock.listen(backlog)
 		return sock
 
 	@classmethod
-	def create_ip_listener(cls, bind_address, bind_port):
-		sock = cls._prepare_ip_socket(bind_address, bind_port)
-		(conn, peer) = sock.accept()
-		return cls(conn)
+	def listen_ip(cls, bind_address, bind_port, buffer_size = None, backlog = 1):
+		return SocketListener(cls._prepare_ip_socket(bind_address, bind_port, buffer_size, backlog))
 
 	@classmethod
-	def create_ip_connection(cls, connect_address, connect_port):
+	def create_ip_listener(cls, bind_address, bind_port, buffer_size = None):
+		with cls.listen_ip(bind_address, bind_port, buffer_size) as listener:
+			return listener.accept()
+
+	@classmethod
+	def create_ip_connection(cls, connect_address, connect_port, buffer_size = None):
 		conn = socket.create_connection((connect_address, connect_port))
-		return cls(conn)
+		return cls(cls._set_buffer_size(conn, buffer_size))
 
 	@classmethod
 	def _create_tls_context(cls, keyfile, server = True):
@@ -114,41 +224,77 @@ class SocketEndpoint(ReliableEndpoint):
 		return tls_context
 
 	@classmethod
-	def create_tls_listener(cls, bind_address, bind_port, keyfile):
-		sock = cls._prepare_ip_socket(bind_address, bind_port)
+	def listen_tls(cls, bind_address, bind_port, keyfile, buffer_size = None, backlog = 1):
+		sock = cls._prepare_ip_socket(bind_address, bind_port, buffer_size, backlog)
 		tls_context = cls._create_tls_context(keyfile, server = True)
-		tls_sock = tls_context.wrap_socket(sock, server_side = True)
-		while True:
-			try:
-				(conn, peer) = tls_sock.accept()
-			except (ssl.SSLError, OSError) as e:
-				print("Connection of client rejected: %s - %s" % (e.__class__.__name__, str(e)))
-				continue
-			return cls(conn)
+		return SocketListener(sock, tls_context = tls_context)
 
 	@classmethod
-	def create_tls_connection(cls, connect_address, connect_port, keyfile):
-		conn = socket.create_connection((connect_address, connect_port))
+	def create_tls_listener(cls, bind_address, bind_port, keyfile, buffer_size = None):
+		with cls.listen_tls(bind_address, bind_port, keyfile, buffer_size) as listener:
+			return listener.accept()
+
+	@classmethod
+	def create_tls_connection(cls, connect_address, connect_port, keyfile, buffer_size = None):
+		conn = cls._set_buffer_size(socket.create_connection((connect_address, connect_port)), buffer_size)
 		tls_context = cls._create_tls_context(keyfile, server = False)
 		tls_sock = tls_context.wrap_socket(conn, server_side = False)
 		return cls(tls_sock)
 
 	@classmethod
-	def create_unix_listener(cls, bind_filename):
+	def listen_unix(cls, bind_filename, buffer_size = None, backlog = 1):
 		with contextlib.suppress(FileNotFoundError):
 			os.unlink(bind_filename)
-		sock = socket.socket(family = socket.AF_UNIX)
+		sock = cls._set_buffer_size(socket.socket(family = socket.AF_UNIX), buffer_size)
 		sock.bind(bind_filename)
-		sock.listen(1)
-		(conn, peer) = sock.accept()
-		return cls(conn)
+		sock.listen(backlog)
+		return SocketListener(sock)
+
+	@classmethod
+	def create_unix_listener(cls, bind_filename, buffer_size = None):
+		with cls.listen_unix(bind_filename, buffer_size) as listener:
+			return listener.accept()
 
 	@classmethod
-	def create_unix_connection(cls, connect_filename):
-		sock = socket.socket(family = socket.AF_UNIX)
+	def create_unix_connection(cls, connect_filename, buffer_size = None):
+		sock = cls._set_buffer_size(socket.socket(family = socket.AF_UNIX), buffer_size)
 		sock.connect(connect_filename)
 		return cls(sock)
 
+class SocketListener():
+	def __init__(self, sock, tls_context = None):
+		self._sock = sock
+		self._tls_context = tls_context
+
+	@property
+	def sock(self):
+		return self._sock
+
+	def accept(self, handshake = True):
+		# Without handshake, the caller has to perform the TLS handshake of
+		# the returned endpoint so that a stalled client cannot block accepting
+		# further ones
+		while True:
+			(conn, peer) = self._sock.accept()
+			endpoint = SocketEndpoint(conn, tls_context = self._tls_context)
+			if handshake:
+				try:
+					endpoint.handshake()
+				except (ssl.SSLError, OSError) as e:
+					print("Connection of client rejected: %s - %s" % (e.__class__.__name__, str(e)))
+					endpoint.close()
+					continue
+			return endpoint
+
+	def close(self):
+		self._sock.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
 class SubprocessEndpoint(ReliableEndpoint):
 	def __init__(self, cmd):
 		self._cmd = cmd
@@ -159,8 +305,8 @@ class SubprocessEndpoint(ReliableEndpoint):
 		self._proc.stdin.flush()
 		return written
 
-	def _recv(self, length):
-		return self._proc.stdout.read(length)
+	def _recv_into(self, view):
+		return self._proc.stdout.readinto(view)
 
 
 class EndpointDefinition():
@@ -175,27 +321,37 @@ class EndpointDefinition():
 	def __getitem__(self, key):
 		return self._variables[key]
 
-	def create_listener(self):
+	def create_listener(self, buffer_size = None):
 		if self.scheme == "stdout":
 			return StdinStdoutEndpoint()
 		elif self.scheme == "ip":
-			return SocketEndpoint.create_ip_listener(self["address"], self["port"])
+			return SocketEndpoint.create_ip_listener(self["address"], self["port"], buffer_size = buffer_size)
 		elif self.scheme == "tls":
-			return SocketEndpoint.create_tls_listener(self["address"], self["port"], self["keyfile"])
+			return SocketEndpoint.create_tls_listener(self["address"], self["port"], self["keyfile"], buffer_size = buffer_size)
 		elif self.scheme == "unix":
-			return SocketEndpoint.create_unix_listener(self["filename"])
+			return SocketEndpoint.create_unix_listener(self["filename"], buffer_size = buffer_size)
 		else:
 			raise NotImplementedError(self.scheme)
 
-	def create_connection(self):
+	def create_multi_listener(self, buffer_size = None, backlog = 16):
+		if self.scheme == "ip":
+			return SocketEndpoint.listen_ip(self["address"], self["port"], buffer_size = buffer_size, backlog = backlog)
+		elif self.scheme == "tls":
+			return SocketEndpoint.listen_tls(self["address"], self["port"], self["keyfile"], buffer_size = buffer_size, backlog = backlog)
+		elif self.scheme == "unix":
+			return SocketEndpoint.listen_unix(self["filename"], buffer_size = buffer_size, backlog = backlog)
+		else:
+			raise NotImplementedError("Endpoint %s cannot serve multiple clients." % (self.scheme))
+
+	def create_connection(self, buffer_size = None):
 		if self.scheme == "stdout":
 			return StdinStdoutEndpoint()
 		elif self.scheme == "ip":
-			return SocketEndpoint.create_ip_connection(self["address"], self["port"])
+			return SocketEndpoint.create_ip_connection(self["address"], self["port"], buffer_size = buffer_size)
 		elif self.scheme == "tls":
-			return SocketEndpoint.create_tls_connection(self["address"], self["port"], self["keyfile"])
+			return SocketEndpoint.create_tls_connection(self["address"], self["port"], self["keyfile"], buffer_size = buffer_size)
 		elif self.scheme == "unix":
-			return SocketEndpoint.create_unix_connection(self["filename"])
+			return SocketEndpoint.create_unix_connection(self["filename"], buffer_size = buffer_size)
 		else:
 			raise NotImplementedError(self.scheme)
 
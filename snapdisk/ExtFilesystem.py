@@ -0,0 +1,166 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import struct
+
+class ExtFilesystemException(Exception): pass
+
+class ExtFilesystem():
+	# Read-only view of the block allocation of an ext2/3/4 file system,
+	# built from the superblock, the group descriptors and the block
+	# bitmaps. Block groups whose bitmap was never initialized contain only
+	# the file system's metadata, which is computed instead. Whenever a
+	# feature changes the layout in a way that is not understood, the file
+	# system is rejected rather than guessed at.
+	_SUPERBLOCK_OFFSET = 1024
+	_SUPERBLOCK_SIZE = 1024
+	_MAGIC = 0xef53
+	_COMPAT_SPARSE_SUPER2 = 0x200
+	_INCOMPAT_META_BG = 0x10
+	_INCOMPAT_64BIT = 0x80
+	_RO_COMPAT_SPARSE_SUPER = 0x1
+	_RO_COMPAT_BIGALLOC = 0x200
+	_BG_BLOCK_UNINIT = 0x2
+
+	def __init__(self, read_at, device_size):
+		self._read_at = read_at
+		self._parse_superblock(bytes(read_at(self._SUPERBLOCK_OFFSET, self._SUPERBLOCK_SIZE)))
+		if self._blocks_count * self._block_size > device_size:
+			raise ExtFilesystemException("File system of %d blocks of %d bytes exceeds the device size of %d bytes." % (self._blocks_count, self._block_size, device_size))
+		self._group_count = (self._blocks_count - self._first_data_block + self._blocks_per_group - 1) // self._blocks_per_group
+		self._descriptors = self._read_descriptors()
+		# One bit per block, starting at the first data block
+		self._used = bytearray((self._blocks_count - self._first_data_block + 7) // 8)
+		self._read_bitmaps()
+
+	@property
+	def block_size(self):
+		return self._block_size
+
+	@property
+	def blocks_count(self):
+		return self._blocks_count
+
+	def _parse_superblock(self, data):
+		(magic, ) = struct.unpack_from("< H", data, 0x38)
+		if magic != self._MAGIC:
+			raise ExtFilesystemException("No ext2/3/4 file system found, superblock magic is 0x%x." % (magic))
+		(self._inodes_count, blocks_count_lo, self._first_data_block, log_block_size, self._blocks_per_group, self._inodes_per_group) = struct.unpack_from("< L L 12x L L 4x L 4x L", data, 0)
+		(rev_level, ) = struct.unpack_from("< L", data, 0x4c)
+		(inode_size, compat, incompat, ro_compat) = struct.unpack_from("< H 2x L L L", data, 0x58)
+		(self._reserved_gdt_blocks, ) = struct.unpack_from("< H", data, 0xce)
+		(desc_size, ) = struct.unpack_from("< H", data, 0xfe)
+		(blocks_count_hi, ) = struct.unpack_from("< L", data, 0x150)
+		self._backup_bgs = struct.unpack_from("< L L", data, 0x24c)
+
+		if incompat & self._INCOMPAT_META_BG:
+			raise ExtFilesystemException("File systems with the meta_bg feature are not supported.")
+		if ro_compat & self._RO_COMPAT_BIGALLOC:
+			raise ExtFilesystemException("File systems with the bigalloc feature are not supported.")
+		self._block_size = 1024 << log_block_size
+		self._inode_size = 128 if (rev_level == 0) else inode_size
+		self._is_64bit = (incompat & self._INCOMPAT_64BIT) != 0
+		self._desc_size = desc_size if self._is_64bit else 32
+		self._blocks_count = blocks_count_lo | ((blocks_count_hi << 32) if self._is_64bit else 0)
+		self._sparse_super = (ro_compat & self._RO_COMPAT_SPARSE_SUPER) != 0
+		self._sparse_super2 = (compat & self._COMPAT_SPARSE_SUPER2) != 0
+		if (self._blocks_per_group == 0) or ((self._blocks_per_group % 8) != 0) or (self._blocks_per_group > 8 * self._block_size) or (self._desc_size < 32):
+			raise ExtFilesystemException("Implausible ext2/3/4 superblock.")
+
+	def _read_descriptors(self):
+		table_offset = (self._first_data_block + 1) * self._block_size
+		table = self._read_at(table_offset, self._group_count * self._desc_size)
+		descriptors = [ ]
+		for group in range(self._group_count):
+			offset = group * self._desc_size
+			(block_bitmap, inode_bitmap, inode_table, flags) = struct.unpack_from("< L L L 6x H", table, offset)
+			if self._is_64bit and (self._desc_size >= 64):
+				(block_bitmap_hi, inode_bitmap_hi, inode_table_hi) = struct.unpack_from("< L L L", table, offset + 0x20)
+				block_bitmap |= block_bitmap_hi << 32
+				inode_bitmap |= inode_bitmap_hi << 32
+				inode_table |= inode_table_hi << 32
+			descriptors.append((block_bitmap, inode_bitmap, inode_table, flags))
+		return descriptors
+
+	def _group_has_super(self, group):
+		if group == 0:
+			return True
+		if self._sparse_super2:
+			return group in self._backup_bgs
+		if not self._sparse_super:
+			return True
+		if group == 1:
+			return True
+		for base in [ 3, 5, 7 ]:
+			power = base
+			while power < group:
+				power *= base
+			if power == group:
+				return True
+		return False
+
+	def _mark_used(self, first_block, count):
+		first_bit = max(0, first_block - self._first_data_block)
+		end_bit = min(len(self._used) * 8, first_block - self._first_data_block + count)
+		while (first_bit < end_bit) and ((first_bit % 8) != 0):
+			self._used[first_bit // 8] |= 1 << (first_bit % 8)
+			first_bit += 1
+		while (end_bit > first_bit) and ((end_bit % 8) != 0):
+			end_bit -= 1
+			self._used[end_bit // 8] |= 1 << (end_bit % 8)
+		if first_bit < end_bit:
+			self._used[first_bit // 8 : end_bit // 8] = b"\xff" * ((end_bit - first_bit) // 8)
+
+	def _read_bitmaps(self):
+		group_bytes = self._blocks_per_group // 8
+		gdt_blocks = (self._group_count * self._desc_size + self._block_size - 1) // self._block_size
+		inode_table_blocks = (self._inodes_per_group * self._inode_size + self._block_size - 1) // self._block_size
+		for (group, (block_bitmap, inode_bitmap, inode_table, flags)) in enumerate(self._descriptors):
+			if not (flags & self._BG_BLOCK_UNINIT):
+				bitmap = self._read_at(block_bitmap * self._block_size, group_bytes)
+				offset = group * group_bytes
+				length = min(group_bytes, len(self._used) - offset)
+				self._used[offset : offset + length] = bitmap[ : length]
+			# Metadata is always in use, even where no bitmap records it
+			if self._group_has_super(group):
+				self._mark_used(self._first_data_block + (group * self._blocks_per_group), 1 + gdt_blocks + self._reserved_gdt_blocks)
+			self._mark_used(block_bitmap, 1)
+			self._mark_used(inode_bitmap, 1)
+			self._mark_used(inode_table, inode_table_blocks)
+
+	def is_free(self, offset, length):
+		# True only if the given byte range consists of free blocks entirely
+		first_block = offset // self._block_size
+		end_block = (offset + length + self._block_size - 1) // self._block_size
+		if (first_block < self._first_data_block) or (end_block > self._blocks_count):
+			return False
+		first_bit = first_block - self._first_data_block
+		end_bit = end_block - self._first_data_block
+		while (first_bit < end_bit) and ((first_bit % 8) != 0):
+			if self._used[first_bit // 8] & (1 << (first_bit % 8)):
+				return False
+			first_bit += 1
+		while (end_bit > first_bit) and ((end_bit % 8) != 0):
+			end_bit -= 1
+			if self._used[end_bit // 8] & (1 << (end_bit % 8)):
+				return False
+		return self._used.count(0, first_bit // 8, end_bit // 8) == (end_bit - first_bit) // 8
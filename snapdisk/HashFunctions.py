@@ -0,0 +1,77 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import hashlib
+
+class HashFunctions():
+	Default = "sha384"
+	_CONSTRUCTORS = {
+		"sha384":		lambda: hashlib.sha384(),
+		"sha256":		lambda: hashlib.sha256(),
+		"sha512-256":	lambda: hashlib.new("sha512_256"),
+		"blake2b":		lambda: hashlib.blake2b(),
+		"blake2b-256":	lambda: hashlib.blake2b(digest_size = 32),
+	}
+
+	@classmethod
+	def names(cls):
+		# All known hash functions, in the order in which they were added;
+		# new ones must be appended since the position identifies them in
+		# the binary wire encoding
+		return list(cls._CONSTRUCTORS)
+
+	@classmethod
+	def available(cls):
+		available = [ ]
+		for (name, constructor) in cls._CONSTRUCTORS.items():
+			try:
+				constructor()
+				available.append(name)
+			except ValueError:
+				# Not supported by the OpenSSL library hashlib is linked against
+				pass
+		return available
+
+	@classmethod
+	def new(cls, name):
+		if name not in cls._CONSTRUCTORS:
+			raise NotImplementedError("Unsupported hash function: %s" % (name))
+		return cls._CONSTRUCTORS[name]()
+
+	@classmethod
+	def digest_size(cls, name):
+		return cls.new(name).digest_size
+
+	@classmethod
+	def hexdigest(cls, name, data):
+		hashfnc = cls.new(name)
+		hashfnc.update(data)
+		return hashfnc.hexdigest()
+
+	@classmethod
+	def chunk_dir(cls, name):
+		# SHA-384 chunks remain in the location they always had, every other
+		# hash function gets its own directory so that digests of different
+		# functions (some of which have equal length) can never collide.
+		if name == cls.Default:
+			return "chunks"
+		else:
+			return "chunks-%s" % (name)
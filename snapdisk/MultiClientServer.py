@@ -0,0 +1,86 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import threading
+import concurrent.futures
+from .DiskImageServer import DiskImageServer
+
+class MultiClientServer():
+	# Keeps accepting clients and serves each of them on a thread of its
+	# own. All connections share the images and their read ahead caches, as
+	# well as the network rate limit.
+	def __init__(self, images, listener, max_clients, max_chunk_size, sendfile = True, compression_threads = 1, rate_limiter = None, client_timeout = None, verbose = 0):
+		self._images = images
+		self._listener = listener
+		self._max_clients = max_clients
+		self._max_chunk_size = max_chunk_size
+		self._sendfile = sendfile
+		self._compression_threads = compression_threads
+		self._rate_limiter = rate_limiter
+		self._client_timeout = client_timeout
+		self._verbose = verbose
+		self._client_count = 0
+		self._free_slots = threading.BoundedSemaphore(max_clients)
+		self._lock = threading.Lock()
+		self._endpoints = set()
+
+	def _serve_client(self, client_no, endpoint):
+		if self._verbose >= 1:
+			print("Client %d connected." % (client_no))
+		try:
+			if self._rate_limiter is not None:
+				endpoint.set_rate_limiter(self._rate_limiter)
+			if self._client_timeout is not None:
+				endpoint.set_timeout(self._client_timeout)
+			endpoint.handshake()
+			server = DiskImageServer(self._images, endpoint, max_chunk_size = self._max_chunk_size, sendfile = self._sendfile, compression_threads = self._compression_threads, max_clients = self._max_clients)
+			server.run()
+		except TimeoutError:
+			print("Client %d: connection idle for %d seconds, disconnected." % (client_no, self._client_timeout))
+		except Exception as e:
+			print("Client %d: connection terminated: %s - %s" % (client_no, e.__class__.__name__, str(e)))
+		else:
+			if self._verbose >= 1:
+				print("Client %d disconnected." % (client_no))
+		finally:
+			with self._lock:
+				self._endpoints.discard(endpoint)
+			endpoint.close()
+			self._free_slots.release()
+
+	def run(self):
+		with concurrent.futures.ThreadPoolExecutor(max_workers = self._max_clients) as executor:
+			try:
+				while True:
+					# While all clients are being served, further ones are not
+					# accepted but wait in the listen backlog
+					self._free_slots.acquire()
+					endpoint = self._listener.accept(handshake = False)
+					self._client_count += 1
+					with self._lock:
+						self._endpoints.add(endpoint)
+					executor.submit(self._serve_client, self._client_count, endpoint)
+			finally:
+				# When interrupted, the clients that are still connected are
+				# disconnected instead of waiting for them to finish
+				with self._lock:
+					for endpoint in self._endpoints:
+						endpoint.shutdown()
@@ -0,0 +1,129 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import os
+import time
+import threading
+from .FriendlyArgumentParser import baseint_unit
+
+class RateLimiter():
+	# Token bucket that limits a throughput in bytes per second: callers
+	# consume before they transfer and sleep once the bucket is exhausted.
+	# With a latency target, the rate adapts to the latency that callers
+	# report: it is halved whenever a transfer took longer than the target
+	# and slowly raised otherwise, but never above the configured limit. The
+	# limit can be changed while running through a control file with lines
+	# such as "read 50 Mi" or "network unlimited"; it is checked for changes
+	# once per second.
+	_BURST_TIME = 0.1
+	_MIN_BURST = 64 * 1024
+	_INCREASE = 1.05
+	_CONTROL_CHECK_INTERVAL = 1
+
+	def __init__(self, rate = None, latency_target = None, min_rate = 1024 * 1024, control_filename = None, control_key = None, share = 1):
+		self._lock = threading.Lock()
+		self._initial_rate = rate
+		self._max_rate = rate
+		self._rate = rate
+		self._latency_target = latency_target
+		self._min_rate = min_rate
+		self._control_filename = control_filename
+		self._control_key = control_key
+		self._control_mtime = None
+		self._next_control_check = 0
+		self._share = share
+		self._tokens = 0
+		self._last_refill = time.monotonic()
+
+	@property
+	def rate(self):
+		return self._rate
+
+	@property
+	def latency_target(self):
+		return self._latency_target
+
+	def split(self, share):
+		# Limiter for one of 'share' processes that together must not exceed
+		# this limiter's rate
+		rate = None if (self._initial_rate is None) else max(1, self._initial_rate // share)
+		return RateLimiter(rate = rate, latency_target = self._latency_target, min_rate = max(1, self._min_rate // share), control_filename = self._control_filename, control_key = self._control_key, share = self._share * share)
+
+	def _read_control_file(self):
+		with open(self._control_filename) as f:
+			for line in f:
+				line = line.split("#", maxsplit = 1)[0].split()
+				if (len(line) < 2) or (line[0] != self._control_key):
+					continue
+				value = " ".join(line[1:])
+				if value == "unlimited":
+					return None
+				return max(1, baseint_unit(value) // self._share)
+		# Without a line of its own, the limit given initially applies
+		return self._initial_rate
+
+	def _check_control_file(self, now):
+		if now < self._next_control_check:
+			return
+		self._next_control_check = now + self._CONTROL_CHECK_INTERVAL
+		try:
+			mtime = os.stat(self._control_filename).st_mtime_ns
+		except FileNotFoundError:
+			# The file only needs to exist while it is used
+			return
+		try:
+			if mtime == self._control_mtime:
+				return
+			self._control_mtime = mtime
+			rate = self._read_control_file()
+		except (OSError, ValueError) as e:
+			print("Cannot apply rate limits from %s: %s - %s" % (self._control_filename, e.__class__.__name__, str(e)))
+			return
+		self._max_rate = rate
+		self._rate = rate
+
+	def consume(self, amount):
+		with self._lock:
+			now = time.monotonic()
+			if self._control_filename is not None:
+				self._check_control_file(now)
+			if self._rate is None:
+				return
+			burst = max(self._MIN_BURST, self._rate * self._BURST_TIME)
+			self._tokens = min(burst, self._tokens + ((now - self._last_refill) * self._rate)) - amount
+			self._last_refill = now
+			delay = 0 if (self._tokens >= 0) else (-self._tokens / self._rate)
+		if delay > 0:
+			time.sleep(delay)
+
+	def report_latency(self, amount, latency):
+		if self._latency_target is None:
+			return
+		with self._lock:
+			if latency > self._latency_target:
+				observed_rate = amount / latency
+				rate = observed_rate if (self._rate is None) else min(self._rate, observed_rate)
+				self._rate = max(self._min_rate, rate / 2)
+			elif self._rate is not None:
+				self._rate *= self._INCREASE
+				if (self._max_rate is not None) and (self._rate > self._max_rate):
+					self._rate = self._max_rate
@@ -0,0 +1,76 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+class RequestWindow():
+	# Pipelines requests over a single connection: requests are sent right
+	# away and their responses, which the server sends strictly in request
+	# order, are picked up later. Responses that arrive before the one that
+	# is waited for are kept until they are claimed.
+	def __init__(self, marshal):
+		self._marshal = marshal
+		self._next_ticket = 0
+		self._next_response = 0
+		self._received = { }
+		self._discarded = set()
+		self._payload_hash_functions = { }
+
+	@property
+	def outstanding(self):
+		return self._next_ticket - self._next_response
+
+	def submit(self, msg, payload = None, payload_hash_function = None):
+		ticket = self._next_ticket
+		self._next_ticket += 1
+		if payload_hash_function is not None:
+			self._payload_hash_functions[ticket] = payload_hash_function
+		self._marshal.send(msg, payload)
+		return ticket
+
+	def _receive_next(self):
+		ticket = self._next_response
+		self._next_response += 1
+		response = self._marshal.recv(payload_hash_function = self._payload_hash_functions.pop(ticket, None))
+		if ticket in self._discarded:
+			self._discarded.remove(ticket)
+		else:
+			self._received[ticket] = response
+
+	def has_result(self, ticket):
+		# Whether the response was received already, so that claiming it does
+		# not block
+		return ticket in self._received
+
+	def result(self, ticket):
+		assert(ticket < self._next_ticket)
+		while ticket >= self._next_response:
+			self._receive_next()
+		return self._marshal.check_response(self._received.pop(ticket))
+
+	def discard(self, ticket):
+		if ticket < self._next_response:
+			self._received.pop(ticket, None)
+		else:
+			self._discarded.add(ticket)
+
+	def drain(self):
+		while self.outstanding > 0:
+			self._receive_next()
+		self._received = { }
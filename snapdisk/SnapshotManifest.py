@@ -0,0 +1,257 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import mmap
+import json
+import struct
+import datetime
+import calendar
+import collections
+from .HashFunctions import HashFunctions
+
+class SnapshotManifestException(Exception): pass
+
+class SnapshotManifest():
+	# Binary snapshot manifest. A fixed-size header (magic, version, digest
+	# size and the static meta data as JSON) is followed by an append-only
+	# journal of fixed-size records: chunk records (chunk index, length,
+	# flags and raw digest), stripe records (chunk index range of a stripe)
+	# and checkpoint records. Only records up to the last checkpoint are
+	# valid; everything after it was never committed and is cut off when the
+	# manifest is opened for writing.
+	ManifestChunk = collections.namedtuple("ManifestChunk", [ "index", "length", "hash_value" ])
+	Stripe = collections.namedtuple("Stripe", [ "begin", "end" ])
+	_MAGIC = b"SDSNAP01"
+	_HEADER = struct.Struct("< 8s L L L")
+	_HEADER_SIZE = 4096
+	_RECORD_HEAD = struct.Struct("< B B 6x Q Q")
+	_RECORD_CHUNK = 1
+	_RECORD_STRIPE = 2
+	_RECORD_CHECKPOINT = 3
+	_FLAG_ZERO = (1 << 0)
+	_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+	def __init__(self, filename, fd, meta, writable):
+		self._filename = filename
+		self._fd = fd
+		self._meta = meta
+		self._writable = writable
+		self._digest_size = HashFunctions.digest_size(meta["hash_function"])
+		self._record = struct.Struct("%s %ds" % (self._RECORD_HEAD.format, self._digest_size))
+		self._zero_digest = bytes(self._digest_size)
+		self._record_count = 0
+		self._end_ts = None
+		self._pending = [ ]
+		self._find_last_checkpoint()
+		if writable:
+			os.ftruncate(self._fd, self._records_end)
+
+	@property
+	def filename(self):
+		return self._filename
+
+	@property
+	def meta(self):
+		return self._meta
+
+	@property
+	def end_ts(self):
+		return self._end_ts
+
+	@property
+	def record_count(self):
+		return self._record_count
+
+	@property
+	def _records_end(self):
+		return self._HEADER_SIZE + (self._record_count * self._record.size)
+
+	@classmethod
+	def create(cls, filename, meta, overwrite = False):
+		meta_bin = json.dumps(meta, sort_keys = True).encode("utf-8")
+		if cls._HEADER.size + len(meta_bin) > cls._HEADER_SIZE:
+			raise SnapshotManifestException("Meta data of snapshot %s too large for header (%d bytes)." % (filename, len(meta_bin)))
+		flags = os.O_RDWR | os.O_CREAT | (os.O_TRUNC if overwrite else os.O_EXCL)
+		fd = os.open(filename, flags, 0o644)
+		header = cls._HEADER.pack(cls._MAGIC, 1, HashFunctions.digest_size(meta["hash_function"]), len(meta_bin)) + meta_bin
+		cls._pwrite_fully(fd, header + bytes(cls._HEADER_SIZE - len(header)), 0)
+		os.fsync(fd)
+		return cls(filename, fd, meta, writable = True)
+
+	@classmethod
+	def open(cls, filename, writable = False):
+		fd = os.open(filename, os.O_RDWR if writable else os.O_RDONLY)
+		header = os.pread(fd, cls._HEADER_SIZE, 0)
+		try:
+			(magic, version, digest_size, meta_length) = cls._HEADER.unpack_from(header)
+		except struct.error:
+			os.close(fd)
+			raise SnapshotManifestException("Snapshot manifest %s is truncated." % (filename))
+		if (magic != cls._MAGIC) or (version != 1):
+			os.close(fd)
+			raise SnapshotManifestException("Snapshot manifest %s has an invalid magic number or unsupported version." % (filename))
+		meta = json.loads(header[cls._HEADER.size : cls._HEADER.size + meta_length].decode("utf-8"))
+		return cls(filename, fd, meta, writable = writable)
+
+	@staticmethod
+	def _pwrite_fully(fd, data, offset):
+		view = memoryview(data)
+		while len(view) > 0:
+			written = os.pwrite(fd, view, offset)
+			view = view[written : ]
+			offset += written
+
+	def _find_last_checkpoint(self):
+		file_size = os.fstat(self._fd).st_size
+		record_count = max(0, (file_size - self._HEADER_SIZE) // self._record.size)
+		while record_count > 0:
+			record_data = os.pread(self._fd, self._record.size, self._HEADER_SIZE + ((record_count - 1) * self._record.size))
+			(record_type, flags, end_ts, preceding_records, digest) = self._record.unpack(record_data)
+			if (record_type == self._RECORD_CHECKPOINT) and (preceding_records == record_count - 1):
+				self._end_ts = datetime.datetime.fromtimestamp(end_ts, datetime.timezone.utc)
+				break
+			record_count -= 1
+		self._record_count = record_count
+
+	def _iter_records(self):
+		if self._record_count == 0:
+			return
+		with mmap.mmap(self._fd, self._records_end, access = mmap.ACCESS_READ) as mapping:
+			view = memoryview(mapping)
+			try:
+				yield from self._record.iter_unpack(view[self._HEADER_SIZE : self._records_end])
+			finally:
+				view.release()
+
+	def iter_chunks(self):
+		for (record_type, flags, index, length, digest) in self._iter_records():
+			if record_type == self._RECORD_CHUNK:
+				hash_value = None if (flags & self._FLAG_ZERO) else digest.hex()
+				yield self.ManifestChunk(index = index, length = length, hash_value = hash_value)
+
+	def iter_ordered_chunks(self):
+		# Chunks of different stripes are interleaved in the journal
+		if len(self.stripes) == 0:
+			yield from self.iter_chunks()
+		else:
+			yield from sorted(self.iter_chunks(), key = lambda chunk: chunk.index)
+
+	@property
+	def stripes(self):
+		return [ self.Stripe(begin = begin, end = end) for (record_type, flags, begin, end, digest) in self._iter_records() if record_type == self._RECORD_STRIPE ]
+
+	def append_chunk(self, index, length, hash_value):
+		if hash_value is None:
+			record = self._record.pack(self._RECORD_CHUNK, self._FLAG_ZERO, index, length, self._zero_digest)
+		else:
+			record = self._record.pack(self._RECORD_CHUNK, 0, index, length, bytes.fromhex(hash_value))
+		self._pending.append(record)
+
+	def append_stripe(self, begin, end):
+		self._pending.append(self._record.pack(self._RECORD_STRIPE, 0, begin, end, self._zero_digest))
+
+	def checkpoint(self, end_ts):
+		# The records are synced before the checkpoint that commits them is
+		# written so that a checkpoint can never precede its records on disk.
+		assert(self._writable)
+		if len(self._pending) > 0:
+			self._pwrite_fully(self._fd, b"".join(self._pending), self._records_end)
+			self._record_count += len(self._pending)
+			self._pending = [ ]
+			os.fsync(self._fd)
+		checkpoint = self._record.pack(self._RECORD_CHECKPOINT, 0, calendar.timegm(end_ts.utctimetuple()), self._record_count, self._zero_digest)
+		self._pwrite_fully(self._fd, checkpoint, self._records_end)
+		self._record_count += 1
+		os.fsync(self._fd)
+		self._end_ts = end_ts
+
+	def close(self):
+		if self._fd is not None:
+			os.close(self._fd)
+			self._fd = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def to_json_dict(self):
+		meta = dict(self._meta)
+		chunks = list(self.iter_ordered_chunks())
+		if meta["chunking"]["method"] == "fixed":
+			meta["chunk_count"] = (meta["disk_size"] + meta["chunk_size"] - 1) // meta["chunk_size"]
+		else:
+			meta["chunk_count"] = len(chunks)
+		meta["end_ts"] = (self._end_ts or datetime.datetime.now(datetime.timezone.utc)).strftime(self._TIMESTAMP_FORMAT)
+		meta["version"] = 1
+		result = {
+			"meta":		meta,
+			"chunks":	[ ],
+		}
+		stripes = [ stripe._asdict() for stripe in self.stripes ]
+		for stripe in stripes:
+			stripe["chunks"] = [ ]
+		for chunk in chunks:
+			stripe = next((stripe for stripe in stripes if stripe["begin"] <= chunk.index < stripe["end"]), None)
+			(stripe["chunks"] if (stripe is not None) else result["chunks"]).append(chunk.hash_value)
+		if any(stripe["begin"] + len(stripe["chunks"]) != stripe["end"] for stripe in stripes):
+			result["stripes"] = stripes
+		else:
+			# Complete stripes are simply part of the ordered chunk list
+			result["chunks"] += [ hash_value for stripe in stripes for hash_value in stripe["chunks"] ]
+		if meta["chunking"]["method"] != "fixed":
+			result["chunk_sizes"] = [ chunk.length for chunk in chunks ]
+		return result
+
+	@classmethod
+	def static_meta(cls, json_meta):
+		return {
+			"target":			json_meta["target"],
+			"name":				json_meta["name"],
+			"disk_size":		json_meta["disk_size"],
+			"chunk_size":		json_meta["chunk_size"],
+			"chunking":			json_meta.get("chunking", { "method": "fixed" }),
+			"hash_function":	json_meta.get("hash_function", HashFunctions.Default),
+			"device_name":		json_meta["device_name"],
+			"start_ts":			json_meta["start_ts"],
+		}
+
+	@classmethod
+	def from_json_dict(cls, filename, json_dict, overwrite = False):
+		meta = cls.static_meta(json_dict["meta"])
+		manifest = cls.create(filename, meta, overwrite = overwrite)
+		(chunk_size, disk_size) = (meta["chunk_size"], meta["disk_size"])
+		chunk_sizes = json_dict.get("chunk_sizes")
+		def chunk_length(index):
+			if chunk_sizes is not None:
+				return chunk_sizes[index]
+			return min(chunk_size, disk_size - (index * chunk_size))
+
+		for (index, hash_value) in enumerate(json_dict["chunks"]):
+			manifest.append_chunk(index, chunk_length(index), hash_value)
+		for stripe in json_dict.get("stripes", [ ]):
+			manifest.append_stripe(stripe["begin"], stripe["end"])
+			for (index, hash_value) in enumerate(stripe["chunks"], stripe["begin"]):
+				manifest.append_chunk(index, chunk_length(index), hash_value)
+		manifest.checkpoint(datetime.datetime.strptime(json_dict["meta"]["end_ts"], cls._TIMESTAMP_FORMAT))
+		return manifest
@@ -0,0 +1,251 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import enum
+import stat
+import fcntl
+import struct
+import ctypes
+import ctypes.util
+import collections
+import concurrent.futures
+from .SnapshotManifest import SnapshotManifest
+from .ChunkStore import ChunkStore
+from .Chunk import ZeroChunk
+from .HashFunctions import HashFunctions
+
+try:
+	_fallocate = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True).fallocate
+	_fallocate.argtypes = [ ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64 ]
+except (OSError, AttributeError):
+	_fallocate = None
+
+class SnapshotRestorerException(Exception): pass
+
+class RestoreOutcome(enum.Enum):
+	Written = "written"
+	Zero = "zero"
+	Unchanged = "unchanged"
+
+class SnapshotRestorer():
+	# Chunks are loaded, decompressed, verified and written by a pool of
+	# threads (all of which releases the GIL) and written with pwrite() at
+	# their offset, so the order in which they complete does not matter.
+	# When comparing, the target is read and hashed first and a chunk it
+	# already contains is neither loaded nor written. Zero chunks are not
+	# written as data: a new file is sparse anyway, otherwise the range is
+	# deallocated (hole punching for files, BLKZEROOUT for block devices)
+	# and zeros are only written when that is not supported.
+	_BLKZEROOUT = 0x127f
+	_FALLOC_FL_KEEP_SIZE = 0x01
+	_FALLOC_FL_PUNCH_HOLE = 0x02
+	_ZERO_WRITE_SIZE = 1024 * 1024
+
+	def __init__(self, snapshot_filename, device_name, threads = 1, pipeline_memory = None, compare = False, write_zeros = False, overwrite = False):
+		assert(threads >= 1)
+		if snapshot_filename.endswith(".json"):
+			raise SnapshotRestorerException("Cannot restore snapshot in legacy JSON format, convert it first using \"convert-snapshot\": %s" % (snapshot_filename))
+		self._snapshot_filename = snapshot_filename
+		self._device_name = device_name
+		self._threads = threads
+		self._pipeline_memory = pipeline_memory
+		self._compare = compare
+		self._write_zeros = write_zeros
+		self._overwrite = overwrite
+		self._manifest = None
+		self._chunk_store = None
+		self._fd = None
+		self._is_regular_file = None
+		self._target_is_zero = False
+		self._can_deallocate = not write_zeros
+		self._position = 0
+		self._chunks_written_size = 0
+		self._chunks_zero_size = 0
+		self._chunks_unchanged_size = 0
+
+	@property
+	def disk_size(self):
+		return self._manifest.meta["disk_size"]
+
+	@property
+	def position(self):
+		return self._position
+
+	@property
+	def chunks_written_size(self):
+		return self._chunks_written_size
+
+	@property
+	def chunks_zero_size(self):
+		return self._chunks_zero_size
+
+	@property
+	def chunks_unchanged_size(self):
+		return self._chunks_unchanged_size
+
+	def _load_chunk_list(self):
+		# Validate the complete snapshot before the first byte is written
+		if self._manifest.end_ts is None:
+			raise SnapshotRestorerException("Snapshot %s was never committed, nothing to restore." % (self._snapshot_filename))
+		chunk_list = [ ]
+		offset = 0
+		for chunk in self._manifest.iter_ordered_chunks():
+			if chunk.index != len(chunk_list):
+				raise SnapshotRestorerException("Snapshot %s is incomplete, chunk %d is missing; finish it first using the \"resume\" mode." % (self._snapshot_filename, len(chunk_list)))
+			chunk_list.append((offset, chunk))
+			offset += chunk.length
+		if offset != self.disk_size:
+			raise SnapshotRestorerException("Snapshot %s is incomplete, it covers %d of %d bytes; finish it first using the \"resume\" mode." % (self._snapshot_filename, offset, self.disk_size))
+		return chunk_list
+
+	def _open_target(self):
+		try:
+			statres = os.stat(self._device_name)
+		except FileNotFoundError:
+			statres = None
+		if (statres is not None) and (not self._overwrite):
+			raise SnapshotRestorerException("Refusing to overwrite already existing target: %s" % (self._device_name))
+		if (statres is None) or stat.S_ISREG(statres.st_mode):
+			self._is_regular_file = True
+			self._fd = os.open(self._device_name, os.O_RDWR | os.O_CREAT, 0o644)
+			self._target_is_zero = (os.fstat(self._fd).st_size == 0)
+			os.ftruncate(self._fd, self.disk_size)
+		elif stat.S_ISBLK(statres.st_mode):
+			# O_EXCL fails for block devices that are mounted
+			self._is_regular_file = False
+			self._fd = os.open(self._device_name, os.O_RDWR | os.O_EXCL)
+			device_size = os.lseek(self._fd, 0, os.SEEK_END)
+			if device_size < self.disk_size:
+				raise SnapshotRestorerException("Target %s has %d bytes, but the snapshot needs %d bytes." % (self._device_name, device_size, self.disk_size))
+		else:
+			raise SnapshotRestorerException("Target %s is neither a regular file nor a block device." % (self._device_name))
+
+	@staticmethod
+	def _pwrite_fully(fd, data, offset):
+		view = memoryview(data)
+		while len(view) > 0:
+			written = os.pwrite(fd, view, offset)
+			view = view[written : ]
+			offset += written
+
+	def _deallocate(self, offset, length):
+		if self._is_regular_file:
+			if _fallocate is None:
+				return False
+			if _fallocate(self._fd, self._FALLOC_FL_PUNCH_HOLE | self._FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+				return False
+		else:
+			try:
+				# The ioctl takes two uint64_t in the machine's byte order
+				fcntl.ioctl(self._fd, self._BLKZEROOUT, struct.pack("Q Q", offset, length))
+			except OSError:
+				return False
+		return True
+
+	def _restore_zero(self, offset, length):
+		if self._target_is_zero:
+			return
+		if self._can_deallocate:
+			if self._deallocate(offset, length):
+				return
+			# Not supported by the file system or device, do not try again
+			self._can_deallocate = False
+		for piece_offset in range(offset, offset + length, self._ZERO_WRITE_SIZE):
+			self._pwrite_fully(self._fd, ZeroChunk.zero_data(min(self._ZERO_WRITE_SIZE, offset + length - piece_offset)), piece_offset)
+
+	def _restore_chunk(self, offset, chunk):
+		if self._compare and (not self._target_is_zero):
+			current_data = os.pread(self._fd, chunk.length, offset)
+			if chunk.hash_value is None:
+				if ZeroChunk.is_zero_data(current_data):
+					return RestoreOutcome.Unchanged
+			elif HashFunctions.hexdigest(self._chunk_store.hash_function, current_data) == chunk.hash_value:
+				return RestoreOutcome.Unchanged
+		if chunk.hash_value is None:
+			self._restore_zero(offset, chunk.length)
+			return RestoreOutcome.Zero
+		try:
+			data = self._chunk_store.load(chunk.hash_value)
+		except (KeyError, FileNotFoundError):
+			raise SnapshotRestorerException("Chunk %s of snapshot %s is missing from the chunk store." % (chunk.hash_value, self._snapshot_filename))
+		if (len(data) != chunk.length) or (HashFunctions.hexdigest(self._chunk_store.hash_function, data) != chunk.hash_value):
+			raise SnapshotRestorerException("Chunk %s of snapshot %s is corrupt in the chunk store." % (chunk.hash_value, self._snapshot_filename))
+		self._pwrite_fully(self._fd, data, offset)
+		return RestoreOutcome.Written
+
+	def _account_chunk(self, chunk_length, outcome):
+		self._position += chunk_length
+		if outcome == RestoreOutcome.Written:
+			self._chunks_written_size += chunk_length
+		elif outcome == RestoreOutcome.Zero:
+			self._chunks_zero_size += chunk_length
+		else:
+			self._chunks_unchanged_size += chunk_length
+
+	def _max_in_flight(self):
+		max_in_flight = 2 * self._threads
+		if self._pipeline_memory is not None:
+			# Content-defined chunks may be up to their maximum size
+			max_chunk_size = self._manifest.meta["chunking"].get("max_size", self._manifest.meta["chunk_size"])
+			max_in_flight = min(max_in_flight, self._pipeline_memory // max_chunk_size)
+		return max(1, max_in_flight)
+
+	def restore(self, progress_callback = None, progress_callback_period = None):
+		chunk_list = self._load_chunk_list()
+		self._open_target()
+		last_progress_update = 0
+		def collect_oldest():
+			nonlocal last_progress_update
+			(chunk, future) = in_flight.popleft()
+			self._account_chunk(chunk.length, future.result())
+			if (progress_callback is not None) and (progress_callback_period is not None) and (self._position - last_progress_update >= progress_callback_period):
+				last_progress_update = self._position
+				progress_callback(self)
+
+		max_in_flight = self._max_in_flight()
+		in_flight = collections.deque()
+		with concurrent.futures.ThreadPoolExecutor(max_workers = self._threads) as executor:
+			try:
+				for (offset, chunk) in chunk_list:
+					if len(in_flight) >= max_in_flight:
+						collect_oldest()
+					in_flight.append((chunk, executor.submit(self._restore_chunk, offset, chunk)))
+				while len(in_flight) > 0:
+					collect_oldest()
+			finally:
+				for (chunk, future) in in_flight:
+					future.cancel()
+		os.fsync(self._fd)
+		if progress_callback is not None:
+			progress_callback(self)
+
+	def __enter__(self):
+		self._manifest = SnapshotManifest.open(self._snapshot_filename)
+		self._chunk_store = ChunkStore(os.path.dirname(self._snapshot_filename) or ".", hash_function = self._manifest.meta["hash_function"])
+		return self
+
+	def __exit__(self, *args):
+		if self._fd is not None:
+			os.close(self._fd)
+			self._fd = None
+		self._chunk_store.close()
+		self._manifest.close()
@@ -22,8 +22,13 @@
 import os
 import contextlib
 import datetime
-import json
 import enum
+import queue
+import multiprocessing
+import traceback
+from .ChunkStore import ChunkStore
+from .ChunkDelta import ChunkDelta
+from .SnapshotManifest import SnapshotManifest
 
 class SnapshotWriterException(Exception): pass
 
@@ -32,8 +37,23 @@ class SnapshotMode(enum.Enum):
 	Resume = "resume"
 	Overwrite = "overwrite"
 
+def _snapshot_stripe(image_factory, target, compression, parent_chunks, delta_block_size, stripe_no, start_offset, end_offset, result_queue):
+	try:
+		with image_factory() as image, ChunkStore(target, hash_function = image.hash_function) as chunk_store:
+			delta = None if (parent_chunks is None) else ChunkDelta(parent_chunks, chunk_store, delta_block_size)
+			for chunk in image.iter_chunks(start_offset = start_offset, end_offset = end_offset, known_hashes = chunk_store, delta = delta):
+				if chunk.is_zero or chunk.already_stored(chunk_store):
+					stored_size = None
+				else:
+					stored_size = chunk.store(chunk_store, compression = compression)
+				result_queue.put(("chunk", stripe_no, chunk.hash_value, len(chunk), stored_size))
+	except Exception:
+		result_queue.put(("error", stripe_no, traceback.format_exc()))
+		return
+	result_queue.put(("done", stripe_no))
+
 class SnapshotWriter():
-	def __init__(self, image, target, name, compression = None, mode = SnapshotMode.Create):
+	def __init__(self, image, target, name, compression = None, mode = SnapshotMode.Create, store_layout = None, delta_parent = None, delta_block_size = 4096):
 		assert(isinstance(mode, SnapshotMode))
 		self._image = image
 		self._target = target
@@ -41,35 +61,118 @@ class SnapshotWriter():
 		self._compression = compression
 		with contextlib.suppress(FileExistsError):
 			os.makedirs(self._target)
-		self._chunks = [ ]
+		self._chunk_count = 0
+		self._chunked_size = 0
+		self._stripes = None
 		self._start_ts = datetime.datetime.utcnow()
 		self._end_ts = self._start_ts
 		self._total_bytes_appended = 0
 		self._chunks_deduplicated = 0
 		self._chunks_deduplicated_size = 0
+		self._chunks_zero = 0
+		self._chunks_zero_size = 0
 		self._chunks_stored = 0
 		self._chunks_stored_size = 0
 		if (mode == SnapshotMode.Create) and os.path.isfile(self.snapshot_filename):
 			raise SnapshotWriterException("Refusing to overwrite already existing snapshot file: %s" % (self.snapshot_filename))
-		elif (mode == SnapshotMode.Resume):
-			self._load_snapshot()
+		# Everything that can fail comes before a new snapshot file is created,
+		# which would otherwise be left behind empty and block the next attempt
+		self._chunk_store = ChunkStore(self._target, hash_function = self._image.hash_function, layout = store_layout)
+		try:
+			self._delta_block_size = delta_block_size
+			if delta_parent is None:
+				self._parent_chunks = None
+			else:
+				self._parent_chunks = self._load_parent_chunks(delta_parent)
+			if mode == SnapshotMode.Resume:
+				self._load_snapshot()
+			else:
+				self._manifest = SnapshotManifest.create(self.snapshot_filename, self._static_meta, overwrite = (mode == SnapshotMode.Overwrite))
+		except Exception:
+			self._chunk_store.close()
+			raise
+
+	@property
+	def _static_meta(self):
+		return {
+			"target":			self._target,
+			"name":				self._name,
+			"disk_size":		self._image.disk_size,
+			"chunk_size":		self._image.chunk_size,
+			"chunking":			self._chunking,
+			"hash_function":	self._image.hash_function,
+			"device_name":		self._image.device_name,
+			"start_ts":			self._start_ts.strftime("%Y-%m-%dT%H:%M:%SZ"),
+		}
 
 	def _load_snapshot(self):
 		if not os.path.isfile(self.snapshot_filename):
+			legacy_filename = self._target + "/" + self._name + ".json"
+			if os.path.isfile(legacy_filename):
+				raise SnapshotWriterException("Cannot resume snapshot in legacy JSON format, convert it first using \"convert-snapshot\": %s" % (legacy_filename))
 			raise SnapshotWriterException("Cannot resume non-existent snapshot file: %s" % (self.snapshot_filename))
-		with open(self.snapshot_filename) as f:
-			snapshot_meta = json.load(f)
-		if snapshot_meta["meta"]["disk_size"] != self._image.disk_size:
-			raise SnapshotWriterException("Disk size in snapshot %s is %d bytes, but trying to resume disk with size %d bytes." % (self.snapshot_filename, snapshot_meta["meta"]["disk_size"], self._image.disk_size))
-		if snapshot_meta["meta"]["chunk_size"] != self._image.chunk_size:
-			raise SnapshotWriterException("Chunk size in snapshot %s is %d bytes, but trying to resume with chunk size %d bytes." % (self.snapshot_filename, snapshot_meta["meta"]["chunk_size"], self._image.chunk_size))
-		self._start_ts = datetime.datetime.strptime(snapshot_meta["meta"]["start_ts"], "%Y-%m-%dT%H:%M:%SZ")
+		self._manifest = SnapshotManifest.open(self.snapshot_filename, writable = True)
+		meta = self._manifest.meta
+		if meta["disk_size"] != self._image.disk_size:
+			raise SnapshotWriterException("Disk size in snapshot %s is %d bytes, but trying to resume disk with size %d bytes." % (self.snapshot_filename, meta["disk_size"], self._image.disk_size))
+		if meta["chunk_size"] != self._image.chunk_size:
+			raise SnapshotWriterException("Chunk size in snapshot %s is %d bytes, but trying to resume with chunk size %d bytes." % (self.snapshot_filename, meta["chunk_size"], self._image.chunk_size))
+		if meta["hash_function"] != self._image.hash_function:
+			raise SnapshotWriterException("Hash function in snapshot %s is %s, but trying to resume with %s." % (self.snapshot_filename, meta["hash_function"], self._image.hash_function))
+		if meta["chunking"] != self._chunking:
+			raise SnapshotWriterException("Chunking method in snapshot %s is %s, but trying to resume with %s." % (self.snapshot_filename, str(meta["chunking"]), str(self._chunking)))
+		self._start_ts = datetime.datetime.strptime(meta["start_ts"], "%Y-%m-%dT%H:%M:%SZ")
 		self._end_ts = datetime.datetime.utcnow()
-		self._chunks = snapshot_meta["chunks"]
+
+		stripes = [ { "begin": stripe.begin, "end": stripe.end, "done": 0 } for stripe in self._manifest.stripes ]
+		for chunk in self._manifest.iter_chunks():
+			stripe = next((stripe for stripe in stripes if stripe["begin"] <= chunk.index < stripe["end"]), None)
+			if stripe is None:
+				self._chunk_count += 1
+			else:
+				stripe["done"] += 1
+			self._chunked_size += chunk.length
+		if len(stripes) > 0:
+			self._stripes = stripes
+			if all(stripe["begin"] + stripe["done"] == stripe["end"] for stripe in stripes):
+				self._merge_stripes()
+
+	def _load_parent_chunks(self, parent_name):
+		parent_filename = self._target + "/" + parent_name + ".snap"
+		if not os.path.isfile(parent_filename):
+			raise SnapshotWriterException("Parent snapshot file does not exist: %s" % (parent_filename))
+		if self._image.chunker is not None:
+			raise SnapshotWriterException("Delta transfer against a parent snapshot is only possible with fixed-size chunking.")
+		with SnapshotManifest.open(parent_filename) as parent:
+			meta = parent.meta
+			if meta["chunk_size"] != self._image.chunk_size:
+				raise SnapshotWriterException("Chunk size of parent snapshot %s is %d bytes, but snapshotting with chunk size %d bytes." % (parent_filename, meta["chunk_size"], self._image.chunk_size))
+			if meta["hash_function"] != self._image.hash_function:
+				raise SnapshotWriterException("Hash function of parent snapshot %s is %s, but snapshotting with %s." % (parent_filename, meta["hash_function"], self._image.hash_function))
+			if meta["chunking"]["method"] != "fixed":
+				raise SnapshotWriterException("Parent snapshot %s does not use fixed-size chunking." % (parent_filename))
+			return { chunk.index: (chunk.length, chunk.hash_value) for chunk in parent.iter_chunks() }
+
+	def _delta(self):
+		if self._parent_chunks is None:
+			return None
+		return ChunkDelta(self._parent_chunks, self._chunk_store, self._delta_block_size)
+
+	@property
+	def _chunking(self):
+		if self._image.chunker is None:
+			return { "method": "fixed" }
+		else:
+			return self._image.chunker.to_dict()
 
 	@property
 	def position(self):
-		pos = len(self._chunks) * self._image.chunk_size
+		if self._image.chunker is not None:
+			return self._chunked_size
+		chunks_done = self._chunk_count
+		if self._stripes is not None:
+			chunks_done += sum(stripe["done"] for stripe in self._stripes)
+		pos = chunks_done * self._image.chunk_size
 		if pos > self._image.disk_size:
 			pos = self._image.disk_size
 		return pos
@@ -86,6 +189,14 @@ class SnapshotWriter():
 	def chunks_deduplicated_size(self):
 		return self._chunks_deduplicated_size
 
+	@property
+	def chunks_zero(self):
+		return self._chunks_zero
+
+	@property
+	def chunks_zero_size(self):
+		return self._chunks_zero_size
+
 	@property
 	def chunks_stored(self):
 		return self._chunks_stored
@@ -96,50 +207,127 @@ class SnapshotWriter():
 
 	@property
 	def snapshot_filename(self):
-		snapshot_filename = self._target + "/" + self._name + ".json"
+		snapshot_filename = self._target + "/" + self._name + ".snap"
 		return snapshot_filename
 
-	def _append_chunk(self, chunk):
-		self._total_bytes_appended += len(chunk)
+	def _account_chunk(self, chunk_length, stored_size, hash_value):
+		self._total_bytes_appended += chunk_length
 		self._end_ts = datetime.datetime.utcnow()
-		if chunk.already_stored(self._target):
+		if hash_value is None:
+			self._chunks_zero += 1
+			self._chunks_zero_size += chunk_length
+		elif stored_size is None:
 			self._chunks_deduplicated += 1
-			self._chunks_deduplicated_size += len(chunk)
+			self._chunks_deduplicated_size += chunk_length
 		else:
 			self._chunks_stored += 1
-			self._chunks_stored_size += chunk.store(self._target, compression = self._compression)
-		self._chunks.append(chunk.hash_value)
+			self._chunks_stored_size += stored_size
+
+	def _append_chunk(self, chunk):
+		# Zero chunks are recorded with a null hash value and never stored
+		if chunk.is_zero or chunk.already_stored(self._chunk_store):
+			stored_size = None
+		else:
+			stored_size = chunk.store(self._chunk_store, compression = self._compression)
+		self._account_chunk(len(chunk), stored_size, chunk.hash_value)
+		self._manifest.append_chunk(self._chunk_count, len(chunk), chunk.hash_value)
+		self._chunk_count += 1
+		self._chunked_size += len(chunk)
 
 	def commit(self):
-		history = {
-			"meta": {
-				"target":			self._target,
-				"name":				self._name,
-				"disk_size":		self._image.disk_size,
-				"chunk_count":		self._image.chunk_count,
-				"chunk_size":		self._image.chunk_size,
-				"device_name":		self._image.device_name,
-				"start_ts":			self._start_ts.strftime("%Y-%m-%dT%H:%M:%SZ"),
-				"end_ts":			self._end_ts.strftime("%Y-%m-%dT%H:%M:%SZ"),
-				"version":			1,
-			},
-			"chunks": self._chunks,
-		}
-		with open(self.snapshot_filename, "w") as f:
-			json.dump(history, fp = f)
+		self._manifest.checkpoint(self._end_ts)
 
 	def _iter_chunks(self):
-		yield from self._image.iter_chunks(start_offset = self.position)
+		yield from self._image.iter_chunks(start_offset = self.position, known_hashes = self._chunk_store, delta = self._delta())
 
-	def create(self, progress_callback = None, progress_callback_period = None):
-		last_progress_update = self.total_bytes_appended
-		for chunk in self._iter_chunks():
-			self._append_chunk(chunk)
+	def _split_stripes(self, stripe_count):
+		first_chunk = self._chunk_count
+		remaining_chunks = self._image.chunk_count - first_chunk
+		stripe_count = max(1, min(stripe_count, remaining_chunks))
+		self._stripes = [ ]
+		for stripe_no in range(stripe_count):
+			stripe = {
+				"begin":	first_chunk + (remaining_chunks * stripe_no // stripe_count),
+				"end":		first_chunk + (remaining_chunks * (stripe_no + 1) // stripe_count),
+				"done":		0,
+			}
+			self._stripes.append(stripe)
+			self._manifest.append_stripe(stripe["begin"], stripe["end"])
+
+	def _merge_stripes(self):
+		for stripe in self._stripes:
+			assert(stripe["begin"] + stripe["done"] == stripe["end"])
+		self._chunk_count = self._stripes[-1]["end"]
+		self._stripes = None
 
+	def _create_striped(self, workers, progress_tick):
+		if self._stripes is None:
+			self._split_stripes(workers)
+
+		# Fork explicitly: with spawn, the children would re-import the main
+		# module and thereby re-execute the command line.
+		mp_context = multiprocessing.get_context("fork")
+		result_queue = mp_context.Queue()
+		image_factory = self._image.stripe_image_factory(len(self._stripes))
+		processes = [ ]
+		for (stripe_no, stripe) in enumerate(self._stripes):
+			start_offset = (stripe["begin"] + stripe["done"]) * self._image.chunk_size
+			end_offset = stripe["end"] * self._image.chunk_size
+			process = mp_context.Process(target = _snapshot_stripe, args = (image_factory, self._target, self._compression, self._parent_chunks, self._delta_block_size, stripe_no, start_offset, end_offset, result_queue))
+			process.start()
+			processes.append(process)
+
+		try:
+			finished = set()
+			dead_at_last_poll = set()
+			while len(finished) < len(processes):
+				try:
+					result = result_queue.get(timeout = 1)
+				except queue.Empty:
+					# A worker flushes its results into the queue before it
+					# exits. One that is still unreported an interval after it
+					# was found dead has been killed (e.g., by the OOM killer).
+					dead = set(stripe_no for (stripe_no, process) in enumerate(processes) if (stripe_no not in finished) and (process.exitcode is not None))
+					for stripe_no in sorted(dead & dead_at_last_poll):
+						raise SnapshotWriterException("Snapshotting of stripe %d failed: worker process died with exit code %d." % (stripe_no, processes[stripe_no].exitcode))
+					dead_at_last_poll = dead
+					continue
+				if result[0] == "chunk":
+					(stripe_no, hash_value, chunk_length, stored_size) = result[1:]
+					self._account_chunk(chunk_length, stored_size, hash_value)
+					stripe = self._stripes[stripe_no]
+					self._manifest.append_chunk(stripe["begin"] + stripe["done"], chunk_length, hash_value)
+					stripe["done"] += 1
+					progress_tick()
+				elif result[0] == "done":
+					finished.add(result[1])
+				else:
+					(stripe_no, error_text) = result[1:]
+					raise SnapshotWriterException("Snapshotting of stripe %d failed: %s" % (stripe_no, error_text))
+		finally:
+			for process in processes:
+				if process.is_alive():
+					process.terminate()
+				process.join()
+		self._merge_stripes()
+
+	def create(self, progress_callback = None, progress_callback_period = None, workers = 1):
+		last_progress_update = self.total_bytes_appended
+		def progress_tick():
+			nonlocal last_progress_update
 			progress_since_last_callback = self.total_bytes_appended - last_progress_update
 			if (progress_callback is not None) and (progress_callback_period is not None) and (progress_since_last_callback >= progress_callback_period):
 				last_progress_update = self.total_bytes_appended
 				progress_callback(self)
+
+		if ((workers > 1) or (self._stripes is not None)) and (self._image.chunker is not None):
+			raise SnapshotWriterException("Striped snapshots are only possible with fixed-size chunking.")
+		if (workers > 1) or (self._stripes is not None):
+			self._create_striped(workers, progress_tick)
+		else:
+			for chunk in self._iter_chunks():
+				self._append_chunk(chunk)
+				progress_tick()
 		if progress_callback is not None:
 			progress_callback(self)
 
@@ -148,3 +336,5 @@ class SnapshotWriter():
 
 	def __exit__(self, *args):
 		self.commit()
+		self._manifest.close()
+		self._chunk_store.close()
@@ -19,13 +19,19 @@
 #
 #	Johannes Bauer <JohannesBauer@gmx.de>
 
+import os
 import sys
 from .MultiCommand import MultiCommand
 from .FriendlyArgumentParser import baseint_unit
 from .Endpoints import EndpointDefinition
+from .HashFunctions import HashFunctions
+from .Codecs import Codecs
 from .ActionSnapshot import ActionSnapshot
 from .ActionServe import ActionServe
 from .ActionGenKey import ActionGenKey
+from .ActionMigrateStore import ActionMigrateStore
+from .ActionConvertSnapshot import ActionConvertSnapshot
+from .ActionRestore import ActionRestore
 
 mc = MultiCommand()
 
@@ -33,8 +39,31 @@ def genparser(parser):
 	parser.add_argument("-p", "--commit-period", metavar = "size", type = baseint_unit, default = "10 Gi", help = "Commit the snapshot file in this interval of time to preserve the progress. Can use an SI or binary suffix, defaults to %(default)s.")
 	parser.add_argument("-n", "--name", metavar = "snapshot_name", help = "Snapshot name. If omitted, by default the snapshot is named by the current timestamp.")
 	parser.add_argument("-m", "--mode", choices = [ "create", "resume", "overwrite"], default = "create", help = "Snapshotting mode. Can be any of %(choices)s, defaults to %(default)s.")
-	parser.add_argument("-c", "--compress", choices = [ "gz" ], default = None, help = "Specify compression method to use for chunks. Can be one of %(default)s, defaults to uncompressed.")
+	parser.add_argument("-c", "--compress", choices = Codecs.available(), default = None, help = "Specify compression method to use for chunks. Can be one of %(choices)s, defaults to uncompressed.")
+	parser.add_argument("--compress-level", metavar = "level", type = int, help = "Compression level to use: 0 to 9 for gz and xz, 1 to 9 for bz2 and 1 to 22 for zst. Defaults to the default level of the respective compression method.")
+	parser.add_argument("--compress-threshold", metavar = "ratio", type = float, default = 0.95, help = "Chunks are stored uncompressed when samples of them (or, ultimately, the chunk itself) compress to more than this fraction of their size, so that no CPU time is wasted on encrypted or already compressed data. Specify 0 to always compress. Defaults to %(default).2f.")
+	parser.add_argument("--compress-threads", metavar = "count", type = int, default = os.cpu_count() or 1, help = "Compress every chunk in blocks using this many threads. Defaults to %(default)d.")
+	parser.add_argument("-H", "--hash-function", choices = HashFunctions.available(), default = HashFunctions.Default, help = "Hash function that identifies chunks. Chunks of different hash functions are kept apart in the chunk store, so changing the hash function means that chunks stored under another one are not deduplicated against. Can be one of %(choices)s, defaults to %(default)s.")
+	parser.add_argument("--store-layout", choices = [ "loose", "pack" ], help = "Layout of a newly created chunk store. 'loose' stores every chunk in a file of its own, 'pack' appends chunks to large pack files. Existing stores always keep their layout (see the migrate-store command). Can be one of %(choices)s, defaults to loose.")
 	parser.add_argument("-s", "--chunk-size", metavar = "size", type = baseint_unit, default = "256 Mi", help = "Specify chunk size to use. Can use an SI or binary suffix. Defaults to %(default)s.")
+	parser.add_argument("--chunking", choices = [ "fixed", "cdc" ], default = "fixed", help = "Chunking method to use. 'fixed' cuts the image into chunks of exactly the chunk size, 'cdc' uses content-defined chunking with the chunk size as the average size of a chunk so that data that has shifted its position can still be deduplicated. Can be one of %(choices)s, defaults to %(default)s.")
+	parser.add_argument("--cdc-min-size", metavar = "size", type = baseint_unit, help = "Minimum size of a chunk when using content-defined chunking. Can use an SI or binary suffix. Defaults to a quarter of the chunk size.")
+	parser.add_argument("--cdc-max-size", metavar = "size", type = baseint_unit, help = "Maximum size of a chunk when using content-defined chunking. Can use an SI or binary suffix. Defaults to four times the chunk size.")
+	parser.add_argument("-t", "--hash-threads", metavar = "count", type = int, default = os.cpu_count() or 1, help = "When snapshotting a local image, read, hash and store chunks in a pipeline that uses this many hashing threads; with content-defined chunking, as many processes search for chunk boundaries. A value of 1 disables the pipeline. Defaults to %(default)d.")
+	parser.add_argument("-w", "--workers", metavar = "count", type = int, default = 1, help = "Split the image into this many stripes that are read, hashed and stored by separate processes. For a remote image, every stripe uses a connection of its own, so that the server also hashes in parallel; unless connecting via ssh, the server then has to be started with --max-clients of at least one more than the number of workers. The stripe layout is preserved in the snapshot file so that a resumed snapshot continues every stripe where it left off. Defaults to %(default)d.")
+	parser.add_argument("--pipeline-memory", metavar = "size", type = baseint_unit, default = "1 Gi", help = "Limit the amount of chunk data that may be in flight in the snapshot pipeline at any time. Can use an SI or binary suffix. Defaults to %(default)s.")
+	parser.add_argument("--remote-window", metavar = "count", type = int, default = 8, help = "When snapshotting a remote image, keep up to this many requests in flight so that the connection does not idle during round trips. Defaults to %(default)d.")
+	parser.add_argument("--remote-batch-size", metavar = "size", type = baseint_unit, default = "64 Mi", help = "When snapshotting a remote image, request the hashes of this much consecutive data in a single request. Can use an SI or binary suffix. Defaults to %(default)s.")
+	parser.add_argument("--wire-compression", choices = [ "auto", "none" ] + Codecs.available(), default = "auto", help = "When snapshotting a remote image, have the server compress chunk data before sending it. 'auto' uses the chunk compression method (see --compress) if the server supports it, so that chunks are stored exactly as they were received without compressing them again. Can be one of %(choices)s, defaults to %(default)s.")
+	parser.add_argument("--delta-parent", metavar = "snapshot_name", help = "Name of an earlier snapshot in the destination directory. When snapshotting a remote image, a chunk that is not stored yet is transferred as the blocks that differ from the chunk at the same position in this snapshot, which greatly reduces traffic for scattered small changes. Requires fixed-size chunking with the same chunk size and hash function as the earlier snapshot.")
+	parser.add_argument("--delta-block-size", metavar = "size", type = baseint_unit, default = "4 ki", help = "Size of the blocks that chunks are compared in for a transfer against a parent snapshot (see --delta-parent). Can use an SI or binary suffix. Defaults to %(default)s.")
+	parser.add_argument("--socket-buffer-size", metavar = "size", type = baseint_unit, help = "When snapshotting a remote image via ip://, unix:// or tls://, set the socket's send and receive buffers to this size. Can use an SI or binary suffix. By default, the operating system tunes the buffer sizes automatically.")
+	parser.add_argument("--read-mode", choices = [ "cached", "dontneed", "direct", "mmap" ], default = "cached", help = "How a local image is read. 'cached' reads through the page cache, 'dontneed' does so as well but advises the kernel to drop the data right away so that the page cache keeps what other programs use, 'direct' bypasses the page cache entirely using O_DIRECT. 'mmap' maps a regular image file into memory so that chunks are hashed and stored without copying them; the file must not shrink meanwhile. Can be one of %(choices)s, defaults to %(default)s.")
+	parser.add_argument("--skip-free-blocks", action = "store_true", help = "The local image holds an ext2, ext3 or ext4 file system; chunks that consist of free blocks only are recorded as zero chunks without reading them. Restoring the snapshot then yields zeros in place of the stale data that was there.")
+	parser.add_argument("--max-read-rate", metavar = "rate", type = baseint_unit, help = "Limit the rate at which a local image is read, in bytes per second, so that snapshotting a disk in use affects its other users predictably. Can use an SI or binary suffix. Unlimited by default; for a remote image, limit the reads on the server instead.")
+	parser.add_argument("--read-latency-target", metavar = "ms", type = float, help = "Adapt the read rate to the load of the disk: whenever reading a piece of 1 MiB takes longer than this many milliseconds, the rate is halved, afterwards it slowly recovers up to --max-read-rate. Only applies to local images and not to --read-mode mmap.")
+	parser.add_argument("--max-network-rate", metavar = "rate", type = baseint_unit, help = "Limit the rate at which a remote image is transferred, in bytes per second. Can use an SI or binary suffix. Unlimited by default.")
+	parser.add_argument("--throttle-file", metavar = "filename", help = "Change the rate limits while running: this file is checked for changes once per second and may contain lines such as 'read 50 Mi' or 'network unlimited', which replace the respective limit. Limits that the file does not mention keep their value from the command line.")
 	parser.add_argument("--remote-snapdisk", metavar = "binary", default = "snapdisk.py", help = "When making a snapshot via ssh, this option gives the name of the snapdisk executable on the remote side. Defaults to %(default)s.")
 	parser.add_argument("--print-si-units", action = "store_true", help = "By default, units are printed in binary (powers of 1024); this option changes display of all data to SI prefixes (powers of 1000).")
 	parser.add_argument("--verbose", action = "count", default = 0, help = "Increase verbosity; can be specified multiple times.")
@@ -45,8 +74,21 @@ mc.register("snapshot", "Create a snapshot of a block device", genparser, action
 def genparser(parser):
 	parser.add_argument("-e", "--endpoint", metavar = "endpoint", type = EndpointDefinition.parse, default = "stdout://", help = "Specify endpoint to use. Can be stdout:// or ip://addr:port, unix://filename or tls://addr:port/keyfilename. Defaults to %(default)s.")
 	parser.add_argument("-m", "--max-chunk-size", metavar = "size", type = baseint_unit, default = "512 Mi", help = "Specify the maximum chunk size that a client may request. Can use an SI or binary suffix. Defaults to %(default)s.")
+	parser.add_argument("--read-ahead", metavar = "count", type = int, default = 4, help = "Read and hash this many chunks following the last requested one in the background. Defaults to %(default)d.")
+	parser.add_argument("--read-ahead-threads", metavar = "count", type = int, default = os.cpu_count() or 1, help = "Number of threads that read and hash chunks in the background. Defaults to %(default)d.")
+	parser.add_argument("--cache-memory", metavar = "size", type = baseint_unit, default = "1 Gi", help = "Limit the amount of memory used for chunks that were read ahead or recently requested, including those that a client may still request the data of after their hashes. Chunks that do not fit are read again when requested. Can use an SI or binary suffix. Defaults to %(default)s.")
+	parser.add_argument("--socket-buffer-size", metavar = "size", type = baseint_unit, help = "Set the send and receive buffers of the server's socket to this size. Can use an SI or binary suffix. By default, the operating system tunes the buffer sizes automatically.")
+	parser.add_argument("--read-mode", choices = [ "cached", "dontneed", "direct", "mmap" ], default = "cached", help = "How the images are read. 'cached' reads through the page cache, 'dontneed' does so as well but advises the kernel to drop the data right away so that the page cache keeps what other programs use, 'direct' bypasses the page cache entirely using O_DIRECT. 'mmap' maps regular image files into memory so that chunks are hashed without copying them; the files must not shrink meanwhile. Except for 'cached' and 'mmap', chunk data is not sent by sendfile. Can be one of %(choices)s, defaults to %(default)s.")
+	parser.add_argument("--skip-free-blocks", action = "store_true", help = "All images hold ext2, ext3 or ext4 file systems; chunks that consist of free blocks only are reported as zero chunks without reading them. Restoring the snapshot then yields zeros in place of the stale data that was there.")
+	parser.add_argument("--max-read-rate", metavar = "rate", type = baseint_unit, help = "Limit the rate at which the served images are read, in bytes per second and in total, so that snapshotting a disk in use affects its other users predictably. Can use an SI or binary suffix. Unlimited by default.")
+	parser.add_argument("--read-latency-target", metavar = "ms", type = float, help = "Adapt the read rate to the load of the disk: whenever reading a piece of 1 MiB takes longer than this many milliseconds, the rate is halved, afterwards it slowly recovers up to --max-read-rate. Not possible with --read-mode mmap.")
+	parser.add_argument("--max-network-rate", metavar = "rate", type = baseint_unit, help = "Limit the rate at which data is transferred to and from all clients, in bytes per second and in total. Chunk data is then not sent by sendfile. Can use an SI or binary suffix. Unlimited by default.")
+	parser.add_argument("--throttle-file", metavar = "filename", help = "Change the rate limits while running: this file is checked for changes once per second and may contain lines such as 'read 50 Mi' or 'network unlimited', which replace the respective limit. Limits that the file does not mention keep their value from the command line.")
+	parser.add_argument("--no-sendfile", action = "store_true", help = "On ip:// and unix:// endpoints, chunk data is by default sent directly from the image by the kernel (sendfile). This option sends the data that was read for hashing instead.")
 	parser.add_argument("--verbose", action = "count", default = 0, help = "Increase verbosity; can be specified multiple times.")
-	parser.add_argument("src", help = "Source image; must be a local file or block device.")
+	parser.add_argument("--max-clients", metavar = "count", type = int, help = "Keep running and serve clients until interrupted instead of exiting after the first one. Up to this many clients are served at the same time, they share the read ahead caches of the images; further clients wait until one of them has disconnected. Only possible with ip://, unix:// and tls:// endpoints.")
+	parser.add_argument("--client-timeout", metavar = "secs", type = float, default = 600, help = "When serving several clients, disconnect a client whose connection made no progress for this many seconds. Defaults to %(default)d seconds.")
+	parser.add_argument("src", nargs = "+", help = "Source image; must be a local file or block device. Several images can be served, each of them either given as a filename (in which case it is named by the filename's basename) or as name=filename. Clients select an image by appending ?image=name to the URI, by default the first image is used.")
 mc.register("serve", "Start a snapshot server that serves an image", genparser, action = ActionServe)
 
 def genparser(parser):
@@ -55,4 +97,29 @@ def genparser(parser):
 	parser.add_argument("client_keyfile", help = "Keyfile to be used in the snapdisk client.")
 mc.register("genkey", "Generates a server and client key for use with TLS", genparser, action = ActionGenKey)
 
+def genparser(parser):
+	parser.add_argument("--pack-size", metavar = "size", type = baseint_unit, default = "1 Gi", help = "Size after which a new pack file is started. Can use an SI or binary suffix. Defaults to %(default)s.")
+	parser.add_argument("--verbose", action = "count", default = 0, help = "Increase verbosity; can be specified multiple times.")
+	parser.add_argument("target", help = "Snapshot directory whose chunk store should be migrated.")
+mc.register("migrate-store", "Migrate a chunk store from one file per chunk to pack files", genparser, action = ActionMigrateStore)
+
+def genparser(parser):
+	parser.add_argument("-f", "--force", action = "store_true", help = "Overwrite the destination file if it already exists.")
+	parser.add_argument("--verbose", action = "count", default = 0, help = "Increase verbosity; can be specified multiple times.")
+	parser.add_argument("src", help = "Snapshot file to convert. A .json snapshot is converted into the binary .snap format and vice versa.")
+mc.register("convert-snapshot", "Convert a snapshot file between the JSON and the binary format", genparser, action = ActionConvertSnapshot)
+
+def genparser(parser):
+	parser.add_argument("-p", "--progress-period", metavar = "size", type = baseint_unit, default = "10 Gi", help = "Print the progress whenever this much data has been restored. Can use an SI or binary suffix, defaults to %(default)s.")
+	parser.add_argument("-t", "--threads", metavar = "count", type = int, default = os.cpu_count() or 1, help = "Load, decompress, verify and write chunks using this many threads. Defaults to %(default)d.")
+	parser.add_argument("--pipeline-memory", metavar = "size", type = baseint_unit, default = "1 Gi", help = "Limit the amount of chunk data that may be in flight at any time. Can use an SI or binary suffix. Defaults to %(default)s.")
+	parser.add_argument("--compare", action = "store_true", help = "Read the target first and leave chunks that it already contains untouched, which saves writes (and wear on SSDs) when restoring onto an older state of the same image.")
+	parser.add_argument("--write-zeros", action = "store_true", help = "By default, zero chunks are restored by punching holes into a target file or by having a block device zero out the range (which many SSDs do without writing). This option always writes zeros instead.")
+	parser.add_argument("-f", "--force", action = "store_true", help = "Overwrite the target if it already exists. Always required when restoring onto a block device.")
+	parser.add_argument("--print-si-units", action = "store_true", help = "By default, units are printed in binary (powers of 1024); this option changes display of all data to SI prefixes (powers of 1000).")
+	parser.add_argument("--verbose", action = "count", default = 0, help = "Increase verbosity; can be specified multiple times.")
+	parser.add_argument("src", help = "Snapshot file (.snap) to restore; its chunks are taken from the chunk store in the same directory.")
+	parser.add_argument("dst", help = "Target block device or image file.")
+mc.register("restore", "Restore a snapshot onto a block device or into an image file", genparser, action = ActionRestore)
+
 mc.run(sys.argv[1:])
@@ -0,0 +1,83 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import unittest
+from snapdisk.BinaryEncoding import BinaryEncoding, BinaryEncodingException
+from snapdisk.HashFunctions import HashFunctions
+
+class BinaryEncodingTests(unittest.TestCase):
+	def _chunk_record(self, hash_function, offset, zero = False):
+		return {
+			"offset":			offset,
+			"hash":				None if zero else HashFunctions.hexdigest(hash_function, b"%d" % (offset)),
+			"hash_function":	hash_function,
+			"size":				4096,
+			"zero":				zero,
+		}
+
+	def _assert_roundtrip(self, cmd, request, response):
+		encoded = BinaryEncoding.encode_request(request)
+		self.assertIsNotNone(encoded)
+		self.assertEqual(BinaryEncoding.decode(encoded), request)
+		encoded = BinaryEncoding.encode_response(cmd, response)
+		self.assertIsNotNone(encoded)
+		self.assertEqual(BinaryEncoding.decode(encoded), response)
+
+	def test_chunk_hash(self):
+		for hash_function in HashFunctions.available():
+			for zero in [ False, True ]:
+				request = { "cmd": "get_chunk_hash", "offset": 1 << 40, "length": 4096, "hash_function": hash_function, "detect_zero": zero }
+				response = self._chunk_record(hash_function, 1 << 40, zero = zero)
+				response["status"] = "ok"
+				self._assert_roundtrip("get_chunk_hash", request, response)
+
+	def test_chunk_hashes(self):
+		for hash_function in HashFunctions.available():
+			request = { "cmd": "get_chunk_hashes", "offset": 0, "length": 4096, "count": 3, "hash_function": hash_function, "detect_zero": True }
+			response = { "chunks": [ self._chunk_record(hash_function, i * 4096, zero = (i == 1)) for i in range(3) ], "status": "ok" }
+			self._assert_roundtrip("get_chunk_hashes", request, response)
+
+	def test_chunk_data(self):
+		for hash_function in HashFunctions.available():
+			for (compression, level, threshold) in [ (None, None, None), ("gz", 6, 0.9), ("zst", -5, 1.0) ]:
+				request = { "cmd": "get_chunk_data", "offset": 8192, "length": 4096, "hash_function": hash_function, "compression": compression, "compress_level": level, "compress_threshold": threshold, "detect_zero": False }
+				response = { "offset": 8192, "hash": HashFunctions.hexdigest(hash_function, b"data"), "hash_function": hash_function, "size": 4096, "compression": compression, "status": "ok" }
+				self._assert_roundtrip("get_chunk_data", request, response)
+
+	def test_hash_functions_known(self):
+		# Every hash function can be encoded, none other
+		for hash_function in HashFunctions.available():
+			self.assertIsNotNone(BinaryEncoding.encode_request({ "cmd": "get_chunk_hash", "offset": 0, "length": 1, "hash_function": hash_function }))
+		self.assertIsNone(BinaryEncoding.encode_request({ "cmd": "get_chunk_hash", "offset": 0, "length": 1, "hash_function": "md5" }))
+
+	def test_json_fallback(self):
+		self.assertIsNone(BinaryEncoding.encode_request({ "cmd": "get_image_metadata" }))
+		self.assertIsNone(BinaryEncoding.encode_request({ "cmd": "get_chunk_data", "offset": 0, "length": 1, "hash_function": HashFunctions.Default, "hashed_data": True }))
+		self.assertIsNone(BinaryEncoding.encode_request({ "cmd": "get_chunk_data", "offset": 0, "length": 1, "hash_function": HashFunctions.Default, "compression": "unknown" }))
+		self.assertIsNone(BinaryEncoding.encode_response("get_chunk_hash", { "status": "error", "text": "failed" }))
+		self.assertIsNone(BinaryEncoding.encode_response("quit", { "status": "ok" }))
+
+	def test_malformed(self):
+		encoded = BinaryEncoding.encode_request({ "cmd": "get_chunk_hash", "offset": 0, "length": 1, "hash_function": HashFunctions.Default })
+		for data in [ encoded[:-1], b"\x02" + encoded[1:], encoded[:1] + b"\x7f" + encoded[2:], b"" ]:
+			with self.assertRaises(BinaryEncodingException):
+				BinaryEncoding.decode(data)
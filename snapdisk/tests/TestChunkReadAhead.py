@@ -0,0 +1,108 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import os
+import tempfile
+import unittest
+import weakref
+import threading
+import collections
+from snapdisk.DiskImage import DiskImage
+from snapdisk.ChunkReadAhead import ChunkReadAhead
+
+class CountingDiskImage(DiskImage):
+	def __init__(self, *args, **kwargs):
+		DiskImage.__init__(self, *args, **kwargs)
+		self.reads = collections.Counter()
+		self.chunks = weakref.WeakSet()
+		self._reads_lock = threading.Lock()
+
+	def get_chunk_at(self, offset, chunk_size = None, hash_function = None, detect_zero = True):
+		with self._reads_lock:
+			self.reads[offset] += 1
+		chunk = DiskImage.get_chunk_at(self, offset, chunk_size = chunk_size, hash_function = hash_function, detect_zero = detect_zero)
+		self.chunks.add(chunk)
+		return chunk
+
+class ChunkReadAheadTests(unittest.TestCase):
+	_CHUNK_SIZE = 4096
+	_CHUNK_COUNT = 64
+
+	def setUp(self):
+		self._tmpdir = tempfile.TemporaryDirectory()
+		self._image_filename = "%s/image" % (self._tmpdir.name)
+		with open(self._image_filename, "wb") as f:
+			f.write(os.urandom(self._CHUNK_SIZE * self._CHUNK_COUNT))
+
+	def tearDown(self):
+		self._tmpdir.cleanup()
+
+	def _get(self, read_ahead, chunk_no, data_request = False):
+		chunk = read_ahead.get_chunk(chunk_no * self._CHUNK_SIZE, self._CHUNK_SIZE, "sha384", client = self, data_request = data_request)
+		self.assertEqual(len(chunk), self._CHUNK_SIZE)
+		return chunk
+
+	def _pipelined_client(self, image, read_ahead, hash_window):
+		# Like a remote client with a window of hash requests in flight, whose
+		# data requests arrive only after the hashes of the window that follows
+		read_ahead.register_client(self, hash_window = hash_window)
+		for chunk_no in range(self._CHUNK_COUNT + hash_window - 1):
+			if chunk_no < self._CHUNK_COUNT:
+				self._get(read_ahead, chunk_no)
+			data_chunk_no = chunk_no - hash_window + 1
+			if (data_chunk_no >= 0) and (data_chunk_no % 3 == 0):
+				self._get(read_ahead, data_chunk_no, data_request = True)
+				self._get(read_ahead, data_chunk_no, data_request = True)
+			yield
+		read_ahead.release_client(self)
+
+	def test_pipelined_client_reads_once(self):
+		hash_window = 9
+		memory = (hash_window + 4 + 1) * self._CHUNK_SIZE
+		with CountingDiskImage(self._image_filename, chunk_size = self._CHUNK_SIZE) as image, ChunkReadAhead(image, read_ahead = 4, threads = 2, memory = memory) as read_ahead:
+			for step in self._pipelined_client(image, read_ahead, hash_window):
+				pass
+		self.assertEqual(image.reads, { chunk_no * self._CHUNK_SIZE: 1 for chunk_no in range(self._CHUNK_COUNT) })
+
+	def test_memory_is_hard_limit(self):
+		# A window larger than the memory allows costs reads, not memory
+		memory_chunks = 3
+		with CountingDiskImage(self._image_filename, chunk_size = self._CHUNK_SIZE) as image, ChunkReadAhead(image, read_ahead = 4, threads = 2, memory = memory_chunks * self._CHUNK_SIZE) as read_ahead:
+			for step in self._pipelined_client(image, read_ahead, hash_window = 1000):
+				self.assertLessEqual(len(image.chunks), memory_chunks + 1)
+		self.assertEqual(set(image.reads), set(chunk_no * self._CHUNK_SIZE for chunk_no in range(self._CHUNK_COUNT)))
+		self.assertGreater(sum(image.reads.values()), self._CHUNK_COUNT)
+
+	def test_memory_bound(self):
+		with CountingDiskImage(self._image_filename, chunk_size = self._CHUNK_SIZE) as image, ChunkReadAhead(image, read_ahead = 2, memory = 8 * self._CHUNK_SIZE) as read_ahead:
+			read_ahead.register_client(self, hash_window = 4)
+			for chunk_no in range(32):
+				self._get(read_ahead, chunk_no)
+			# Only what fits in memory was read ahead
+			self.assertLessEqual(sum(image.reads.values()), 32 + 2)
+
+			# Chunks of more than a window ago were evicted, recent ones not
+			self._get(read_ahead, 28, data_request = True)
+			self.assertEqual(image.reads[28 * self._CHUNK_SIZE], 1)
+			self._get(read_ahead, 0, data_request = True)
+			self.assertEqual(image.reads[0], 2)
+			read_ahead.release_client(self)
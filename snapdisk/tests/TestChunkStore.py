@@ -0,0 +1,151 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import tempfile
+import unittest
+from snapdisk.ChunkStore import ChunkStore, ChunkStoreLayout, ChunkStoreException
+from snapdisk.HashFunctions import HashFunctions
+from snapdisk.Codecs import Codecs
+
+class ChunkStoreTests(unittest.TestCase):
+	def setUp(self):
+		self._tmpdir = tempfile.TemporaryDirectory()
+		self._target = self._tmpdir.name
+
+	def tearDown(self):
+		self._tmpdir.cleanup()
+
+	@staticmethod
+	def _chunks(count, compressible = False):
+		chunks = { }
+		for i in range(count):
+			data = (b"chunk %d " % (i)) * 1000 if compressible else os.urandom(5000 + i)
+			chunks[HashFunctions.hexdigest(HashFunctions.Default, data)] = data
+		return chunks
+
+	def _assert_contains(self, chunk_store, chunks):
+		for (hash_value, data) in chunks.items():
+			self.assertIn(hash_value, chunk_store)
+			self.assertEqual(chunk_store.load(hash_value), data)
+
+	def _roundtrip(self, layout):
+		chunks = self._chunks(10)
+		chunks.update(self._chunks(5, compressible = True))
+		compression = Codecs.create("gz", threshold = 0.95)
+		with ChunkStore(self._target, layout = layout, max_pack_size = 20000) as chunk_store:
+			for (hash_value, data) in chunks.items():
+				self.assertNotIn(hash_value, chunk_store)
+				self.assertIsNotNone(chunk_store.store(hash_value, data, compression = compression))
+			self._assert_contains(chunk_store, chunks)
+		with ChunkStore(self._target) as chunk_store:
+			self.assertEqual(chunk_store.layout, layout)
+			self.assertEqual(len(chunk_store), len(chunks))
+			self._assert_contains(chunk_store, chunks)
+		return chunks
+
+	def test_loose_roundtrip(self):
+		self._roundtrip(ChunkStoreLayout.Loose)
+
+	def test_pack_roundtrip(self):
+		self._roundtrip(ChunkStoreLayout.Pack)
+		pack_dir = "%s/chunks/packs" % (self._target)
+		pack_files = os.listdir(pack_dir)
+		self.assertGreater(len(pack_files), 1)
+		for pack_file in pack_files:
+			self.assertLessEqual(os.stat("%s/%s" % (pack_dir, pack_file)).st_size, 20000 + 5100)
+
+	def test_rebuild_index(self):
+		for layout in ChunkStoreLayout:
+			with self.subTest(layout = layout):
+				chunks = self._roundtrip(layout)
+				os.unlink("%s/chunks/index" % (self._target))
+				with ChunkStore(self._target) as chunk_store:
+					self._assert_contains(chunk_store, chunks)
+				self.tearDown()
+				self.setUp()
+
+	def test_torn_records(self):
+		chunks = self._roundtrip(ChunkStoreLayout.Pack)
+		with open("%s/chunks/index" % (self._target), "ab") as f:
+			f.write(b"torn")
+		last_pack = "%s/chunks/packs/%s" % (self._target, sorted(os.listdir("%s/chunks/packs" % (self._target)))[-1])
+		with open(last_pack, "ab") as f:
+			f.write(b"SDPE unfinished entry")
+		more_chunks = self._chunks(3)
+		with ChunkStore(self._target) as chunk_store:
+			for (hash_value, data) in more_chunks.items():
+				chunk_store.store(hash_value, data)
+		with ChunkStore(self._target) as chunk_store:
+			self.assertEqual(len(chunk_store), len(chunks) + len(more_chunks))
+			self._assert_contains(chunk_store, chunks)
+			self._assert_contains(chunk_store, more_chunks)
+
+	def test_concurrent_writers(self):
+		chunks = self._chunks(4)
+		for layout in ChunkStoreLayout:
+			with self.subTest(layout = layout):
+				target = "%s/%s" % (self._target, layout.value)
+				with ChunkStore(target, layout = layout) as store1, ChunkStore(target, layout = layout) as store2:
+					for (hash_value, data) in chunks.items():
+						self.assertIsNotNone(store1.store(hash_value, data))
+						# Only noticed when trying to store the chunk
+						self.assertNotIn(hash_value, store2)
+						self.assertIsNone(store2.store(hash_value, data))
+						self.assertEqual(store2.load(hash_value), data)
+				index_size = os.stat("%s/chunks/index" % (target)).st_size
+				with ChunkStore(target) as chunk_store:
+					self.assertEqual(len(chunk_store), len(chunks))
+					self.assertEqual(index_size, os.stat(chunk_store.index_filename).st_size)
+
+	def test_migrate(self):
+		chunks = self._roundtrip(ChunkStoreLayout.Loose)
+		self.assertEqual(ChunkStore.migrate_to_pack(self._target), len(chunks))
+		self.assertEqual(sorted(os.listdir("%s/chunks" % (self._target))), [ "index", "packs" ])
+		with ChunkStore(self._target) as chunk_store:
+			self.assertEqual(chunk_store.layout, ChunkStoreLayout.Pack)
+			self._assert_contains(chunk_store, chunks)
+
+	def test_partially_migrated(self):
+		# A migration that was interrupted right after creating the pack
+		# directory leaves loose chunks in a pack store
+		chunks = self._roundtrip(ChunkStoreLayout.Loose)
+		os.mkdir("%s/chunks/packs" % (self._target))
+		more_chunks = self._chunks(3)
+		with ChunkStore(self._target) as chunk_store:
+			self.assertEqual(chunk_store.layout, ChunkStoreLayout.Pack)
+			self._assert_contains(chunk_store, chunks)
+			for (hash_value, data) in more_chunks.items():
+				chunk_store.store(hash_value, data)
+		os.unlink("%s/chunks/index" % (self._target))
+		with ChunkStore(self._target) as chunk_store:
+			self._assert_contains(chunk_store, chunks)
+			self._assert_contains(chunk_store, more_chunks)
+		self.assertEqual(ChunkStore.migrate_to_pack(self._target), len(chunks))
+		with ChunkStore(self._target) as chunk_store:
+			self.assertEqual(len(chunk_store), len(chunks) + len(more_chunks))
+			self._assert_contains(chunk_store, chunks)
+			self._assert_contains(chunk_store, more_chunks)
+
+	def test_layout_mismatch(self):
+		self._roundtrip(ChunkStoreLayout.Loose)
+		with self.assertRaises(ChunkStoreException):
+			ChunkStore(self._target, layout = ChunkStoreLayout.Pack)
@@ -0,0 +1,97 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import random
+import unittest
+from snapdisk.ContentDefinedChunker import ContentDefinedChunker
+
+class ContentDefinedChunkerTests(unittest.TestCase):
+	@staticmethod
+	def _blocks(data, block_size):
+		for offset in range(0, len(data), block_size):
+			yield data[offset : offset + block_size]
+
+	@staticmethod
+	def _test_data(length):
+		# Random data interspersed with runs of zeros and of a constant byte
+		rng = random.Random(1234)
+		parts = [ ]
+		while sum(len(part) for part in parts) < length:
+			part_length = rng.randint(1, 256 * 1024)
+			kind = rng.random()
+			if kind < 0.2:
+				parts.append(bytes(part_length))
+			elif kind < 0.3:
+				parts.append(bytes([ 0x55 ]) * part_length)
+			else:
+				parts.append(rng.randbytes(part_length))
+		return b"".join(parts)[ : length]
+
+	def test_roundtrip(self):
+		data = self._test_data(4 * 1024 * 1024)
+		chunker = ContentDefinedChunker(avg_size = 16384)
+		chunks = list(chunker.split(self._blocks(data, chunker.read_size)))
+		self.assertEqual(b"".join(chunks), data)
+		for chunk in chunks[ : -1]:
+			self.assertTrue(chunker.min_size <= len(chunk) <= chunker.max_size)
+		self.assertTrue(0 < len(chunks[-1]) <= chunker.max_size)
+
+	def test_independent_of_read_size(self):
+		data = self._test_data(2 * 1024 * 1024)
+		chunker = ContentDefinedChunker(avg_size = 8192)
+		reference = [ len(chunk) for chunk in chunker.split(self._blocks(data, chunker.read_size)) ]
+		for block_size in [ 17, 1000, 65536, 777777 ]:
+			self.assertEqual([ len(chunk) for chunk in chunker.split(self._blocks(data, block_size)) ], reference)
+
+	def test_workers(self):
+		data = self._test_data(3 * 1024 * 1024)
+		chunker = ContentDefinedChunker(avg_size = 8192)
+		reference = list(chunker.split(self._blocks(data, 65536)))
+		self.assertEqual(list(chunker.split(self._blocks(data, 65536), workers = 3)), reference)
+
+	def test_chunks_larger_than_reads(self):
+		data = os.urandom(3 * 1024 * 1024)
+		chunker = ContentDefinedChunker(avg_size = 1024 * 1024, min_size = 512 * 1024, max_size = 2 * 1024 * 1024)
+		chunks = list(chunker.split(self._blocks(data, 100000)))
+		self.assertEqual(b"".join(chunks), data)
+		self.assertTrue(all(len(chunk) >= 100000 for chunk in chunks[ : -1]))
+
+	def test_zero_run(self):
+		# Constant data has no cut candidates, it is cut at the maximum size
+		chunker = ContentDefinedChunker(avg_size = 4096)
+		chunks = list(chunker.split(self._blocks(bytes(100000), 30000)))
+		self.assertEqual([ len(chunk) for chunk in chunks[ : -1] ], [ chunker.max_size ] * (len(chunks) - 1))
+		self.assertEqual(sum(len(chunk) for chunk in chunks), 100000)
+
+	def test_shift_resistance(self):
+		# Inserting data only changes the chunks around the insertion
+		data = self._test_data(1024 * 1024)
+		chunker = ContentDefinedChunker(avg_size = 8192)
+		original = set(chunker.split(self._blocks(data, 65536)))
+		shifted = list(chunker.split(self._blocks(data[ : 500000] + b"inserted" + data[500000 : ], 65536)))
+		self.assertGreater(sum(1 for chunk in shifted if chunk in original), len(shifted) - 4)
+
+	def test_invalid_sizes(self):
+		with self.assertRaises(ValueError):
+			ContentDefinedChunker(avg_size = 4096, min_size = 8192)
+		with self.assertRaises(ValueError):
+			ContentDefinedChunker(avg_size = 16)
@@ -0,0 +1,141 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import os
+import re
+import shutil
+import tempfile
+import unittest
+import subprocess
+from snapdisk.DiskImage import DiskImage
+from snapdisk.ExtFilesystem import ExtFilesystem, ExtFilesystemException
+from snapdisk.SnapshotWriter import SnapshotWriter, SnapshotMode
+from snapdisk.SnapshotManifest import SnapshotManifest
+from snapdisk.ChunkStore import ChunkStore
+
+@unittest.skipUnless(all(shutil.which(tool) is not None for tool in [ "mke2fs", "dumpe2fs", "debugfs", "e2fsck" ]), "e2fsprogs not installed")
+class ExtFilesystemTests(unittest.TestCase):
+	_IMAGE_SIZE = 256 * 1024 * 1024
+	_CHUNK_SIZE = 256 * 1024
+	_MKFS_OPTIONS = [
+		[ "-t", "ext2" ],
+		[ "-t", "ext3", "-b", "1024" ],
+		[ "-t", "ext4" ],
+		[ "-t", "ext4", "-b", "1024", "-O", "^flex_bg" ],
+		[ "-t", "ext4", "-b", "2048", "-O", "64bit,sparse_super2" ],
+		[ "-t", "ext4", "-O", "^sparse_super,^resize_inode" ],
+	]
+
+	def setUp(self):
+		self._tmpdir = tempfile.TemporaryDirectory()
+		self._content_dir = "%s/content" % (self._tmpdir.name)
+		os.makedirs("%s/sub" % (self._content_dir))
+		self._files = { }
+		for (name, size) in [ ("small", 1000), ("medium", 300 * 1024), ("sub/large", 3 * 1024 * 1024) ]:
+			data = os.urandom(size)
+			with open("%s/%s" % (self._content_dir, name), "wb") as f:
+				f.write(data)
+			self._files[name] = data
+
+	def tearDown(self):
+		self._tmpdir.cleanup()
+
+	def _mkfs(self, options):
+		image_filename = "%s/image" % (self._tmpdir.name)
+		with open(image_filename, "wb") as f:
+			f.truncate(self._IMAGE_SIZE)
+		subprocess.check_call([ "mke2fs", "-q", "-F", "-E", "nodiscard" ] + options + [ "-d", self._content_dir, image_filename ])
+		return image_filename
+
+	def _free_blocks(self, image_filename):
+		output = subprocess.check_output([ "dumpe2fs", image_filename ], stderr = subprocess.DEVNULL).decode()
+		free_ranges = [ ]
+		for line in output.split("\n"):
+			result = re.fullmatch(r"\s+Free blocks: (.*)", line)
+			if (result is None) or (result.group(1).strip() == ""):
+				continue
+			for free_range in result.group(1).split(","):
+				(first, _, last) = free_range.strip().partition("-")
+				free_ranges.append((int(first), int(last or first)))
+		return free_ranges
+
+	def _file_blocks(self, image_filename, name):
+		# Data blocks of the file, and for ext2/3 also its indirect blocks
+		return [ int(block) for block in subprocess.check_output([ "debugfs", "-R", "blocks /%s" % (name), image_filename ], stderr = subprocess.DEVNULL).decode().split() ]
+
+	def _file_data(self, image_filename, name):
+		dump_filename = "%s/dump" % (self._tmpdir.name)
+		subprocess.check_call([ "debugfs", "-R", "dump /%s %s" % (name, dump_filename), image_filename ], stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+		with open(dump_filename, "rb") as f:
+			return f.read()
+
+	def _snapshot_and_restore(self, image_filename):
+		target = "%s/backup" % (self._tmpdir.name)
+		restored_filename = "%s/restored" % (self._tmpdir.name)
+		with DiskImage(image_filename, chunk_size = self._CHUNK_SIZE, skip_free_blocks = True) as image, SnapshotWriter(image = image, target = target, name = "snap", mode = SnapshotMode.Overwrite) as writer:
+			writer.create()
+		with SnapshotManifest.open("%s/snap.snap" % (target)) as manifest, ChunkStore(target) as chunk_store, open(restored_filename, "wb") as f:
+			for chunk in manifest.iter_ordered_chunks():
+				if chunk.hash_value is None:
+					f.seek(chunk.length, os.SEEK_CUR)
+				else:
+					f.write(chunk_store.load(chunk.hash_value))
+			f.truncate()
+		return (writer, restored_filename)
+
+	def test_allocation(self):
+		for options in self._MKFS_OPTIONS:
+			with self.subTest(options = options):
+				image_filename = self._mkfs(options)
+				with open(image_filename, "rb") as f:
+					image_data = f.read()
+				fs = ExtFilesystem(lambda offset, length: image_data[offset : offset + length], len(image_data))
+
+				# Exactly the blocks that e2fsprogs reports as free are free
+				free = bytearray(fs.blocks_count)
+				for (first, last) in self._free_blocks(image_filename):
+					self.assertTrue(fs.is_free(first * fs.block_size, (last - first + 1) * fs.block_size), "blocks %d-%d" % (first, last))
+					free[first : last + 1] = b"\x01" * (last - first + 1)
+				for block in range(fs.blocks_count):
+					self.assertEqual(fs.is_free(block * fs.block_size, fs.block_size), free[block] == 1, "block %d" % (block))
+
+				# File contents are in blocks that are in use
+				for name in self._files:
+					self.assertEqual(self._file_data(image_filename, name), self._files[name])
+					for block in self._file_blocks(image_filename, name):
+						self.assertFalse(fs.is_free(block * fs.block_size, fs.block_size))
+
+	def test_snapshot_skips_free_blocks(self):
+		for options in self._MKFS_OPTIONS:
+			with self.subTest(options = options):
+				image_filename = self._mkfs(options)
+				(writer, restored_filename) = self._snapshot_and_restore(image_filename)
+				self.assertGreater(writer.chunks_zero, 0)
+				self.assertEqual(os.path.getsize(restored_filename), self._IMAGE_SIZE)
+				for name in self._files:
+					self.assertEqual(self._file_data(restored_filename, name), self._files[name])
+				subprocess.check_call([ "e2fsck", "-f", "-n", restored_filename ], stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+
+	def test_no_filesystem(self):
+		data = bytes(self._IMAGE_SIZE)
+		with self.assertRaises(ExtFilesystemException):
+			ExtFilesystem(lambda offset, length: data[offset : offset + length], len(data))
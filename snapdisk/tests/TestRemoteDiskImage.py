@@ -0,0 +1,101 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import os
+import socket
+import tempfile
+import unittest
+import threading
+import urllib.parse
+from snapdisk.DiskImage import DiskImage, RemoteDiskImage
+from snapdisk.DiskImageServer import DiskImageServer
+from snapdisk.ChunkReadAhead import ChunkReadAhead
+from snapdisk.Endpoints import SocketEndpoint
+from snapdisk.Certificates import Certificates
+
+class RemoteDiskImageTests(unittest.TestCase):
+	_CHUNK_SIZE = 64 * 1024
+
+	def setUp(self):
+		self._tmpdir = tempfile.TemporaryDirectory()
+		self._image_filename = "%s/image" % (self._tmpdir.name)
+		self._socket_filename = "%s/socket" % (self._tmpdir.name)
+		self._image_data = os.urandom(4 * self._CHUNK_SIZE)
+		with open(self._image_filename, "wb") as f:
+			f.write(self._image_data)
+
+	def tearDown(self):
+		self._tmpdir.cleanup()
+
+	def _serve(self, listener, sendfile):
+		endpoint = listener.accept()
+		try:
+			with DiskImage(self._image_filename, chunk_size = 1) as image, ChunkReadAhead(image) as read_ahead:
+				DiskImageServer({ "image": read_ahead }, endpoint, max_chunk_size = self._CHUNK_SIZE, sendfile = sendfile).run()
+		finally:
+			endpoint.close()
+
+	def _remote_chunks(self, sendfile = True, modify = None, listener = None, uri = None):
+		if listener is None:
+			(listener, uri) = (SocketEndpoint.listen_unix(self._socket_filename), "unix://%s" % (self._socket_filename))
+		with listener:
+			server_thread = threading.Thread(target = self._serve, args = (listener, sendfile))
+			server_thread.start()
+			try:
+				with RemoteDiskImage(urllib.parse.urlparse(uri), chunk_size = self._CHUNK_SIZE, remote_snapdisk_binary = None) as image:
+					chunks = list(image.iter_chunks())
+					if modify is not None:
+						modify()
+					return [ bytes(chunk.data) for chunk in chunks ]
+			finally:
+				server_thread.join()
+
+	def test_roundtrip(self):
+		for sendfile in [ False, True ]:
+			self.assertEqual(b"".join(self._remote_chunks(sendfile = sendfile)), self._image_data)
+
+	def test_image_changed_after_hashing(self):
+		# Data sent straight from the image no longer matches the hash that
+		# the client received; it gets the data that was hashed instead
+		def modify():
+			with open(self._image_filename, "r+b") as f:
+				f.write(os.urandom(len(self._image_data)))
+		self.assertEqual(b"".join(self._remote_chunks(modify = modify)), self._image_data)
+
+	def test_tls_stalled_handshake(self):
+		# A client that never sends its TLS handshake is accepted without
+		# waiting for it and times out once its handshake is performed, while
+		# further clients are still served
+		(server_keyfile, client_keyfile) = ("%s/server.json" % (self._tmpdir.name), "%s/client.json" % (self._tmpdir.name))
+		Certificates.create_server_client_keys(server_filename = server_keyfile, client_filename = client_keyfile)
+		listener = SocketEndpoint.listen_tls("127.0.0.1", 0, server_keyfile, backlog = 2)
+		port = listener.sock.getsockname()[1]
+		with socket.create_connection(("127.0.0.1", port)):
+			endpoint = listener.accept(handshake = False)
+			try:
+				endpoint.set_timeout(0.2)
+				with self.assertRaises(TimeoutError):
+					endpoint.handshake()
+			finally:
+				endpoint.close()
+			chunks = self._remote_chunks(listener = listener, uri = "tls://127.0.0.1:%d/%s" % (port, client_keyfile))
+		self.assertEqual(b"".join(chunks), self._image_data)
@@ -0,0 +1,132 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import json
+import datetime
+import tempfile
+import unittest
+from snapdisk.SnapshotManifest import SnapshotManifest, SnapshotManifestException
+from snapdisk.HashFunctions import HashFunctions
+
+class SnapshotManifestTests(unittest.TestCase):
+	_META = {
+		"target":			"backup",
+		"name":				"test",
+		"disk_size":		10 * 4096 - 100,
+		"chunk_size":		4096,
+		"chunking":			{ "method": "fixed" },
+		"hash_function":	HashFunctions.Default,
+		"device_name":		"/dev/null",
+		"start_ts":			"2024-01-02T03:04:05Z",
+	}
+
+	def setUp(self):
+		self._tmpdir = tempfile.TemporaryDirectory()
+		self._filename = "%s/test.snap" % (self._tmpdir.name)
+
+	def tearDown(self):
+		self._tmpdir.cleanup()
+
+	@staticmethod
+	def _hash_value(index):
+		return HashFunctions.hexdigest(HashFunctions.Default, b"chunk %d" % (index))
+
+	def _chunk_length(self, index):
+		return min(self._META["chunk_size"], self._META["disk_size"] - (index * self._META["chunk_size"]))
+
+	def _write_chunks(self, manifest, indices):
+		for index in indices:
+			hash_value = None if (index % 3 == 0) else self._hash_value(index)
+			manifest.append_chunk(index, self._chunk_length(index), hash_value)
+
+	def _expected_chunks(self, indices):
+		return [ SnapshotManifest.ManifestChunk(index = index, length = self._chunk_length(index), hash_value = None if (index % 3 == 0) else self._hash_value(index)) for index in indices ]
+
+	def test_roundtrip(self):
+		end_ts = datetime.datetime(2024, 1, 2, 3, 5, 0, tzinfo = datetime.timezone.utc)
+		with SnapshotManifest.create(self._filename, self._META) as manifest:
+			self._write_chunks(manifest, range(10))
+			manifest.checkpoint(end_ts)
+		with SnapshotManifest.open(self._filename) as manifest:
+			self.assertEqual(manifest.meta, self._META)
+			self.assertEqual(manifest.end_ts, end_ts)
+			self.assertEqual(list(manifest.iter_chunks()), self._expected_chunks(range(10)))
+			self.assertEqual(manifest.stripes, [ ])
+
+	def test_uncommitted_records(self):
+		with SnapshotManifest.create(self._filename, self._META) as manifest:
+			self._write_chunks(manifest, range(4))
+			manifest.checkpoint(datetime.datetime.now(datetime.timezone.utc))
+			self._write_chunks(manifest, range(4, 6))
+		# Records after the last checkpoint, as well as a torn record, are cut
+		with open(self._filename, "ab") as f:
+			f.write(b"torn record")
+		with SnapshotManifest.open(self._filename, writable = True) as manifest:
+			self.assertEqual(list(manifest.iter_chunks()), self._expected_chunks(range(4)))
+			self._write_chunks(manifest, range(4, 10))
+			manifest.checkpoint(datetime.datetime.now(datetime.timezone.utc))
+		with SnapshotManifest.open(self._filename) as manifest:
+			self.assertEqual(list(manifest.iter_chunks()), self._expected_chunks(range(10)))
+
+	def test_never_committed(self):
+		with SnapshotManifest.create(self._filename, self._META) as manifest:
+			self._write_chunks(manifest, range(4))
+		with SnapshotManifest.open(self._filename) as manifest:
+			self.assertIsNone(manifest.end_ts)
+			self.assertEqual(list(manifest.iter_chunks()), [ ])
+
+	def test_stripes(self):
+		with SnapshotManifest.create(self._filename, self._META) as manifest:
+			manifest.append_stripe(0, 5)
+			manifest.append_stripe(5, 10)
+			# Stripes interleave their chunks in the journal
+			for index in range(5):
+				self._write_chunks(manifest, [ index + 5, index ])
+			manifest.checkpoint(datetime.datetime.now(datetime.timezone.utc))
+		with SnapshotManifest.open(self._filename) as manifest:
+			self.assertEqual(manifest.stripes, [ SnapshotManifest.Stripe(begin = 0, end = 5), SnapshotManifest.Stripe(begin = 5, end = 10) ])
+			self.assertEqual(list(manifest.iter_ordered_chunks()), self._expected_chunks(range(10)))
+
+	def test_json_roundtrip(self):
+		with SnapshotManifest.create(self._filename, self._META) as manifest:
+			manifest.append_stripe(0, 5)
+			manifest.append_stripe(5, 10)
+			self._write_chunks(manifest, [ 0, 1, 5, 6, 7 ])
+			manifest.checkpoint(datetime.datetime(2024, 1, 2, 3, 5, 0, tzinfo = datetime.timezone.utc))
+			json_dict = json.loads(json.dumps(manifest.to_json_dict()))
+		self.assertEqual(json_dict["meta"]["end_ts"], "2024-01-02T03:05:00Z")
+		self.assertEqual(json_dict["meta"]["chunk_count"], 10)
+		converted_filename = "%s/converted.snap" % (self._tmpdir.name)
+		with SnapshotManifest.from_json_dict(converted_filename, json_dict) as manifest:
+			pass
+		with SnapshotManifest.open(converted_filename) as manifest:
+			self.assertEqual(manifest.stripes, [ SnapshotManifest.Stripe(begin = 0, end = 5), SnapshotManifest.Stripe(begin = 5, end = 10) ])
+			self.assertEqual(list(manifest.iter_ordered_chunks()), self._expected_chunks([ 0, 1, 5, 6, 7 ]))
+			self.assertEqual(manifest.to_json_dict(), json_dict)
+
+	def test_invalid_file(self):
+		with open(self._filename, "wb") as f:
+			f.write(b"not a snapshot")
+		with self.assertRaises(SnapshotManifestException):
+			SnapshotManifest.open(self._filename)
+		with self.assertRaises(FileExistsError):
+			SnapshotManifest.create(self._filename, self._META)
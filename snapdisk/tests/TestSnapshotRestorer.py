@@ -0,0 +1,101 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+
+import os
+import glob
+import tempfile
+import unittest
+from snapdisk.DiskImage import DiskImage
+from snapdisk.ContentDefinedChunker import ContentDefinedChunker
+from snapdisk.SnapshotWriter import SnapshotWriter
+from snapdisk.SnapshotRestorer import SnapshotRestorer, SnapshotRestorerException
+
+class SnapshotRestorerTests(unittest.TestCase):
+	_CHUNK_SIZE = 64 * 1024
+
+	def setUp(self):
+		self._tmpdir = tempfile.TemporaryDirectory()
+		self._image_filename = "%s/image" % (self._tmpdir.name)
+		self._target = "%s/backup" % (self._tmpdir.name)
+		self._restored_filename = "%s/restored" % (self._tmpdir.name)
+		self._image_data = b"".join(os.urandom(self._CHUNK_SIZE) if (chunk_no % 3 != 1) else bytes(self._CHUNK_SIZE) for chunk_no in range(12)) + os.urandom(1000)
+		with open(self._image_filename, "wb") as f:
+			f.write(self._image_data)
+
+	def tearDown(self):
+		self._tmpdir.cleanup()
+
+	def _snapshot(self, name, chunker = None):
+		with DiskImage(self._image_filename, chunk_size = self._CHUNK_SIZE, chunker = chunker) as image, SnapshotWriter(image = image, target = self._target, name = name) as writer:
+			writer.create()
+			writer.commit()
+		return "%s/%s.snap" % (self._target, name)
+
+	def _restore(self, snapshot_filename, **kwargs):
+		with SnapshotRestorer(snapshot_filename, self._restored_filename, **kwargs) as restorer:
+			restorer.restore()
+		return restorer
+
+	def _restored_data(self):
+		with open(self._restored_filename, "rb") as f:
+			return f.read()
+
+	def test_restore(self):
+		restorer = self._restore(self._snapshot("first"), threads = 4)
+		self.assertEqual(self._restored_data(), self._image_data)
+		self.assertEqual(restorer.chunks_zero_size, 4 * self._CHUNK_SIZE)
+		self.assertEqual(restorer.chunks_written_size, len(self._image_data) - (4 * self._CHUNK_SIZE))
+
+	def test_restore_content_defined(self):
+		chunker = ContentDefinedChunker(avg_size = 16384, min_size = 4096, max_size = 65536)
+		self._restore(self._snapshot("first", chunker = chunker), threads = 2, pipeline_memory = 65536)
+		self.assertEqual(self._restored_data(), self._image_data)
+
+	def test_compare(self):
+		snapshot_filename = self._snapshot("first")
+		self._restore(snapshot_filename)
+		with open(self._restored_filename, "r+b") as f:
+			f.seek(self._CHUNK_SIZE + 10)
+			f.write(b"changed")
+			f.seek(3 * self._CHUNK_SIZE + 10)
+			f.write(b"changed")
+		restorer = self._restore(snapshot_filename, compare = True, overwrite = True)
+		self.assertEqual(self._restored_data(), self._image_data)
+		self.assertEqual(restorer.chunks_zero_size, self._CHUNK_SIZE)
+		self.assertEqual(restorer.chunks_written_size, self._CHUNK_SIZE)
+		self.assertEqual(restorer.chunks_unchanged_size, len(self._image_data) - (2 * self._CHUNK_SIZE))
+
+	def test_overwrite(self):
+		snapshot_filename = self._snapshot("first")
+		self._restore(snapshot_filename)
+		with self.assertRaises(SnapshotRestorerException):
+			self._restore(snapshot_filename)
+		with open(self._restored_filename, "wb") as f:
+			f.write(os.urandom(len(self._image_data) + 5000))
+		self._restore(snapshot_filename, overwrite = True, write_zeros = True)
+		self.assertEqual(self._restored_data(), self._image_data)
+
+	def test_missing_chunk(self):
+		snapshot_filename = self._snapshot("first")
+		os.unlink(sorted(glob.glob("%s/chunks/*/*" % (self._target)))[0])
+		with self.assertRaises(SnapshotRestorerException):
+			self._restore(snapshot_filename)
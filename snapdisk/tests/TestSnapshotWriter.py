@@ -0,0 +1,78 @@
+#	snapdisk - User-mode block device snapshotting utility
+#	Copyright (C) 2020-2020 Johannes Bauer
+#
+#	This file is part of snapdisk.
+#
+#	snapdisk is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; this program is ONLY licensed under
+#	version 3 of the License, later versions are explicitly excluded.
+#
+#	snapdisk is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with snapdisk; if not, write to the Free Software
+#	Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#	Johannes Bauer <JohannesBauer@gmx.de>
+
+import os
+import tempfile
+import unittest
+from snapdisk.DiskImage import DiskImage
+from snapdisk.SnapshotWriter import SnapshotWriter, SnapshotWriterException
+from snapdisk.SnapshotManifest import SnapshotManifest
+from snapdisk.ChunkStore import ChunkStore, ChunkStoreLayout, ChunkStoreException
+
+class SnapshotWriterTests(unittest.TestCase):
+	_CHUNK_SIZE = 64 * 1024
+
+	def setUp(self):
+		self._tmpdir = tempfile.TemporaryDirectory()
+		self._image_filename = "%s/image" % (self._tmpdir.name)
+		self._target = "%s/backup" % (self._tmpdir.name)
+		with open(self._image_filename, "wb") as f:
+			for chunk_no in range(8):
+				f.write(os.urandom(self._CHUNK_SIZE) if (chunk_no % 2 == 0) else bytes(self._CHUNK_SIZE))
+			f.write(os.urandom(1000))
+
+	def tearDown(self):
+		self._tmpdir.cleanup()
+
+	def _snapshot(self, name, **kwargs):
+		with DiskImage(self._image_filename, chunk_size = self._CHUNK_SIZE) as image, SnapshotWriter(image = image, target = self._target, name = name, **kwargs) as writer:
+			writer.create()
+		return writer
+
+	def _restored(self, name):
+		with SnapshotManifest.open("%s/%s.snap" % (self._target, name)) as manifest, ChunkStore(self._target) as chunk_store:
+			return b"".join(bytes(chunk.length) if (chunk.hash_value is None) else chunk_store.load(chunk.hash_value) for chunk in manifest.iter_ordered_chunks())
+
+	def test_roundtrip(self):
+		writer = self._snapshot("first")
+		self.assertEqual(writer.chunks_zero, 4)
+		self.assertEqual(writer.chunks_stored, 5)
+		writer = self._snapshot("second")
+		self.assertEqual(writer.chunks_deduplicated, 5)
+		with open(self._image_filename, "rb") as f:
+			image_data = f.read()
+		self.assertEqual(self._restored("first"), image_data)
+		self.assertEqual(self._restored("second"), image_data)
+
+	def test_no_snapshot_file_on_error(self):
+		# A failure must not leave an empty snapshot file behind that blocks
+		# the next attempt
+		self._snapshot("first", store_layout = ChunkStoreLayout.Loose)
+		with self.assertRaises(ChunkStoreException):
+			self._snapshot("second", store_layout = ChunkStoreLayout.Pack)
+		self.assertFalse(os.path.exists("%s/second.snap" % (self._target)))
+		self._snapshot("second")
+
+	def test_no_snapshot_file_on_invalid_parent(self):
+		with self.assertRaises(SnapshotWriterException):
+			self._snapshot("first", delta_parent = "nope")
+		self.assertFalse(os.path.exists("%s/first.snap" % (self._target)))
+		self._snapshot("first")